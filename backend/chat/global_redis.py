@@ -1,16 +1,23 @@
-import json
 from datetime import datetime
 
 import logging
 
 import redis
 import tornadoredis
+from tornado import gen
 
 from chat.models import get_milliseconds
-from chat.settings import ALL_REDIS_ROOM, REDIS_PORT, REDIS_HOST, REDIS_DB
+from chat.settings import ALL_REDIS_ROOM, REDIS_PORT, REDIS_HOST, REDIS_DB, REDIS_POOL_SIZE, MESSAGE_CACHE_SIZE, \
+	MESSAGE_CACHE_TTL, ROOM_RING_SIZE, ROOM_RING_TTL
 from chat.settings_base import ALL_ROOM_ID
+from chat.tornado import json_codec
 from chat.tornado.constants import RedisPrefix
+from chat.tornado.message_cache import MessageDtoCache
+from chat.tornado.room_ring import RoomRing
 from chat.tornado.message_creator import MessagesCreator
+from chat.tornado.presence import PresenceStore
+from chat.tornado.user_directory import UserDirectory
+from chat.tornado.pubsub import PubSubMultiplexer
 
 logger = logging.getLogger(__name__)
 
@@ -67,15 +74,44 @@ def encode_message(message, parsable):
 	@param message: message to mark
 	@return: marked message
 	"""
-	jsoned_mess = json.dumps(message)
+	jsoned_mess = json_codec.dumps(message)
 	if parsable:
 		jsoned_mess = RedisPrefix.PARSABLE_PREFIX + jsoned_mess
 	return jsoned_mess
 
 
-def remove_parsable_prefix(message):
-	if message.startswith(RedisPrefix.PARSABLE_PREFIX):
-		return message[1:]
+class AsyncRedis(object):
+	"""
+	Non-blocking redis access for the code that runs on IOLoop.
+	Every command borrows a connection from the pool and returns a Future, e.g.
+	user_id = yield async_redis.hget('sessions', session_key)
+	Replies are already decoded to str, so there's no need in shget/shgetall
+	"""
+
+	def __init__(self, host, port, selected_db, max_connections):
+		self.selected_db = selected_db
+		self.pool = tornadoredis.ConnectionPool(
+			max_connections=max_connections,
+			wait_for_available=True,
+			host=host,
+			port=port
+		)
+
+	@gen.coroutine
+	def execute(self, command, *args, **kwargs):
+		client = tornadoredis.Client(connection_pool=self.pool, selected_db=self.selected_db)
+		try:
+			result = yield gen.Task(getattr(client, command), *args, **kwargs)
+		finally:
+			yield gen.Task(client.disconnect)  # returns connection to the pool
+		if isinstance(result, Exception):
+			raise result
+		return result
+
+	def __getattr__(self, command):
+		def command_wrapper(*args, **kwargs):
+			return self.execute(command, *args, **kwargs)
+		return command_wrapper
 
 
 def ping_online():
@@ -84,7 +120,7 @@ def ping_online():
 	async_redis_publisher.publish(ALL_ROOM_ID, message)
 
 
-# # global connection to read synchronously
+# # global connection to read synchronously, don't use it on IOLoop, only in management commands and executors
 sync_redis = redis.StrictRedis(host=REDIS_HOST, port=REDIS_PORT, db=REDIS_DB)
 patch_hget(sync_redis)
 patch_hgetall(sync_redis)
@@ -92,4 +128,16 @@ patch_smembers(sync_redis)
 # patch(sync_redis)
 # Redis connection cannot be shared between publishers and subscribers.
 async_redis_publisher = tornadoredis.Client(host=REDIS_HOST, port=REDIS_PORT, selected_db=REDIS_DB)
-patch_read(async_redis_publisher)
\ No newline at end of file
+patch_read(async_redis_publisher)
+# pool of connections to read asynchronously
+async_redis = AsyncRedis(REDIS_HOST, REDIS_PORT, REDIS_DB, REDIS_POOL_SIZE)
+# who is online, see PresenceStore
+presence = PresenceStore(async_redis)
+# users that are sent to client on connect, see UserDirectory
+user_directory = UserDirectory(async_redis)
+# serialized messages for history responses, see MessageDtoCache
+message_cache = MessageDtoCache(sync_redis, MESSAGE_CACHE_SIZE, MESSAGE_CACHE_TTL)
+# newest messages of rooms, see RoomRing
+room_ring = RoomRing(sync_redis, message_cache, ROOM_RING_SIZE, ROOM_RING_TTL)
+# single subscriber connection per process, shared by all websockets
+pubsub = PubSubMultiplexer(REDIS_HOST, REDIS_PORT, REDIS_DB)
\ No newline at end of file
@@ -0,0 +1,51 @@
+import timeit
+import zlib
+
+from django.conf import settings
+
+from chat.management.commands import benchmark_json
+from chat.tornado import json_codec
+
+
+def deflate(data, level, mem_level):
+	# the same as tornado does for a single permessage-deflate frame
+	compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS, mem_level)
+	return compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH)
+
+
+class Command(benchmark_json.Command):
+
+	help = 'Compares websocket compression levels on set_room and get_messages payloads built from database'
+
+	def add_arguments(self, parser):
+		super(Command, self).add_arguments(parser)
+		parser.add_argument(
+			'--mem-level',
+			dest='mem_level',
+			default=settings.WS_COMPRESSION_MEM_LEVEL,
+			type=int,
+		)
+
+	def handle(self, *args, **options):
+		iterations = options['iterations']
+		mem_level = options['mem_level']
+		payloads = self.get_payloads(options['messages'])
+		self.stdout.write('mem level {}, frames shorter than {} bytes are not compressed, current level is {}'.format(
+			mem_level,
+			settings.WS_COMPRESSION_MIN_SIZE,
+			settings.WS_COMPRESSION_LEVEL
+		))
+		self.stdout.write('{:<14}{:<7}{:>10}{:>12}{:>8}{:>10}'.format('payload', 'level', 'bytes', 'compressed', 'ratio', 'ms'))
+		for name, payload in payloads.items():
+			data = json_codec.dumps(payload).encode('utf-8')
+			for level in range(1, 10):
+				compressed = deflate(data, level, mem_level)
+				spent = timeit.timeit(lambda: deflate(data, level, mem_level), number=iterations)
+				self.stdout.write('{:<14}{:<7}{:>10}{:>12}{:>8.2f}{:>10.3f}'.format(
+					name,
+					level,
+					len(data),
+					len(compressed),
+					len(data) / len(compressed),
+					spent * 1000 / iterations
+				))
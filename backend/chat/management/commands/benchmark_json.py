@@ -0,0 +1,63 @@
+import timeit
+
+from django.core.management.base import BaseCommand
+
+from chat.models import UserProfile, Message, Room
+from chat.tornado import json_codec
+from chat.tornado.constants import VarNames
+from chat.tornado.message_creator import MessagesCreator
+from chat.tornado.user_directory import load_users
+
+
+class Command(BaseCommand):
+
+	help = 'Compares installed json backends on set_room and get_messages payloads built from database'
+
+	def add_arguments(self, parser):
+		parser.add_argument(
+			'--iterations',
+			dest='iterations',
+			default=100,
+			type=int,
+		)
+		parser.add_argument(
+			'--messages',
+			dest='messages',
+			default=100,
+			type=int,
+			help='Number of messages in get_messages payload',
+		)
+
+	def get_payloads(self, messages_count):
+		up = UserProfile.objects.first()
+		if up is None:
+			raise Exception("Database has no users, nothing to benchmark")
+		creator = MessagesCreator(up.id, '{:04d}:benchmrk'.format(up.id))
+		rooms = list(Room.objects.filter(users__id=up.id).values('id', 'name', 'creator_id', 'channel_id', 'p2p'))
+		users = list(load_users().values())
+		online = {user['userId']: ['{:04d}:abcdefgh'.format(user['userId'])] for user in users[:100]}
+		messages = Message.objects.order_by('-id')[:messages_count]
+		set_room = creator.set_room(rooms, 0, True, online, {}, up, [])
+		set_room[VarNames.ROOM_USERS] = users
+		return {
+			'set_room': set_room,
+			'get_messages': MessagesCreator.get_messages(messages, 1),
+		}
+
+	def handle(self, *args, **options):
+		iterations = options['iterations']
+		payloads = self.get_payloads(options['messages'])
+		self.stdout.write('Using {} by default, {} iterations'.format(json_codec.BACKEND, iterations))
+		self.stdout.write('{:<14}{:<8}{:>10}{:>14}{:>14}'.format('payload', 'backend', 'bytes', 'dumps, ms', 'loads, ms'))
+		for name, payload in payloads.items():
+			for backend, (dumps, loads) in json_codec.BACKENDS.items():
+				encoded = dumps(payload)
+				dumps_time = timeit.timeit(lambda: dumps(payload), number=iterations)
+				loads_time = timeit.timeit(lambda: loads(encoded), number=iterations)
+				self.stdout.write('{:<14}{:<8}{:>10}{:>14.3f}{:>14.3f}'.format(
+					name,
+					backend,
+					len(encoded.encode('utf-8')),
+					dumps_time * 1000 / iterations,
+					loads_time * 1000 / iterations
+				))
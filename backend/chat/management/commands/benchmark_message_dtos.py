@@ -0,0 +1,59 @@
+import timeit
+
+from django.core.management.base import BaseCommand
+from django.db.models import Count
+
+from chat.models import Message, Image, MessageMention, Room
+from chat.tornado.message_creator import MessagesCreator
+
+
+def models_to_dtos_per_message(messages):
+	"""
+	Previous implementation: full models, and every message scans all images and mentions
+	"""
+	ids = [message.id for message in messages if message.symbol]
+	images = list(Image.objects.filter(message_id__in=ids)) if ids else []
+	mentions = list(MessageMention.objects.filter(message_id__in=ids)) if ids else []
+	return [MessagesCreator.create_message(
+		message,
+		MessagesCreator.prepare_img_video(images, message.id),
+		{tag.symbol: tag.user_id for tag in mentions if tag.message_id == message.id}
+	) for message in messages]
+
+
+class Command(BaseCommand):
+
+	help = 'Compares building message dtos per message and in batch on pages of the room with most files'
+
+	def add_arguments(self, parser):
+		parser.add_argument(
+			'--iterations',
+			dest='iterations',
+			default=100,
+			type=int,
+		)
+		parser.add_argument(
+			'--messages',
+			dest='messages',
+			default=100,
+			type=int,
+			help='Number of messages in a page',
+		)
+
+	def handle(self, *args, **options):
+		iterations = options['iterations']
+		room = Room.objects.annotate(files=Count('message__image')).order_by('-files').first()
+		if room is None:
+			raise Exception("Database has no rooms, nothing to benchmark")
+		messages = list(Message.objects.filter(room_id=room.id).order_by('-id')[:options['messages']])
+		if models_to_dtos_per_message(messages) != MessagesCreator.message_models_to_dtos(messages):
+			raise Exception("Implementations return different dtos")
+		self.stdout.write('Room {}, {} messages, {} files, {} iterations'.format(
+			room.id,
+			len(messages),
+			Image.objects.filter(message__in=messages).count(),
+			iterations
+		))
+		for name, build in (('per message', models_to_dtos_per_message), ('batch', MessagesCreator.message_models_to_dtos)):
+			spent = timeit.timeit(lambda: build(messages), number=iterations)
+			self.stdout.write('{:<14}{:>10.3f} ms per page'.format(name, spent * 1000 / iterations))
@@ -12,4 +12,6 @@ class Command(BaseCommand):
 
 	def handle(self, *args, **options):
 		from chat.global_redis import sync_redis
-		sync_redis.delete(RedisPrefix.ONLINE_VAR)
\ No newline at end of file
+		connections = list(sync_redis.scan_iter(match=RedisPrefix.ONLINE_CONNECTIONS_PREFIX + '*'))
+		connections.extend(sync_redis.scan_iter(match=RedisPrefix.ROOM_ONLINE_PREFIX + '*'))
+		sync_redis.delete(RedisPrefix.ONLINE_VAR, RedisPrefix.ONLINE_VERSION_VAR, *connections)
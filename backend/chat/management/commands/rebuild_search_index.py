@@ -0,0 +1,43 @@
+from django.core.management.base import BaseCommand
+
+from chat.models import Message, MessageSearchWord
+from chat.tornado.message_search import get_words
+
+
+class Command(BaseCommand):
+
+	help = 'Fills search index from all existing messages, the old index is dropped'
+
+	def add_arguments(self, parser):
+		parser.add_argument(
+			'--batch',
+			dest='batch',
+			default=1000,
+			type=int,
+			help='Number of messages read per query',
+		)
+
+	def handle(self, *args, **options):
+		batch = options['batch']
+		MessageSearchWord.objects.all().delete()
+		last_id = 0
+		messages_count = 0
+		words_count = 0
+		while True:
+			messages = list(Message.objects.filter(
+				id__gt=last_id,
+				deleted=False,
+				content__isnull=False
+			).order_by('id').values_list('id', 'room_id', 'content')[:batch])
+			if not messages:
+				break
+			words = [
+				MessageSearchWord(word=word, message_id=message_id, room_id=room_id)
+				for message_id, room_id, content in messages
+				for word in get_words(content)
+			]
+			MessageSearchWord.objects.bulk_create(words, batch_size=batch)
+			last_id = messages[-1][0]
+			messages_count += len(messages)
+			words_count += len(words)
+			self.stdout.write('Indexed {} messages, {} words'.format(messages_count, words_count))
@@ -9,9 +9,11 @@ from tornado.ioloop import IOLoop, PeriodicCallback
 from tornado.web import Application, StaticFileHandler
 from chat.global_redis import ping_online
 from chat.tornado.http_handler import HttpHandler
+from chat.tornado.message_handler import MessagesHandler
 import logging
 
 from chat.tornado.static_file_handler import PychatStaticFileHandler
+from chat.tornado import ws_compression
 
 TORNADO_SSL_OPTIONS = getattr(settings, "TORNADO_SSL_OPTIONS", None)
 from chat.tornado.tornado_handler import TornadoHandler
@@ -75,6 +77,10 @@ class Command(BaseCommand):
 			PeriodicCallback(ping_online, settings.PING_INTERVAL).start()
 		else:
 			logger.info("Skipping pinger for this instance")
+		# pushes delayed to the end of their window are kept in db, any process can post them
+		PeriodicCallback(MessagesHandler.push_notifier.post_due, settings.PUSH_NOTIFICATION_DUE_INTERVAL).start()
+		if settings.WS_COMPRESSION_LEVEL is not None and settings.WS_COMPRESSION_REPORT_INTERVAL:
+			PeriodicCallback(ws_compression.stats.report, settings.WS_COMPRESSION_REPORT_INTERVAL).start()
 		signal.signal(signal.SIGTERM, self.sig_handler)
 		# This will also catch KeyboardInterrupt exception
 		IOLoop.instance().start()
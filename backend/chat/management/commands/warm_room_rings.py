@@ -0,0 +1,40 @@
+from django.core.management.base import BaseCommand
+from django.db.models import Count
+
+from chat.models import Message, get_milliseconds
+
+
+class Command(BaseCommand):
+
+	help = 'Loads newest messages of the busiest rooms into redis, so the first clients after deploy don\'t query db'
+
+	def add_arguments(self, parser):
+		parser.add_argument(
+			'--rooms',
+			dest='rooms',
+			default=100,
+			type=int,
+			help='Number of rooms to warm up',
+		)
+		parser.add_argument(
+			'--days',
+			dest='days',
+			default=7,
+			type=int,
+			help='Rooms are ordered by number of messages sent during that many last days',
+		)
+
+	def handle(self, *args, **options):
+		from chat.global_redis import room_ring
+		since = get_milliseconds() - options['days'] * 24 * 60 * 60 * 1000
+		rooms = Message.objects.filter(time__gt=since) \
+			.values('room_id') \
+			.annotate(messages=Count('id')) \
+			.order_by('-messages')[:options['rooms']]
+		built = 0
+		for room in rooms:
+			if room_ring.build(room['room_id']) is None:
+				self.stdout.write('Room {} is already in redis, skipping'.format(room['room_id']))
+			else:
+				built += 1
+		self.stdout.write('Warmed up {} rooms'.format(built))
@@ -22,7 +22,7 @@ from django.db.models import \
 	TextField, \
 	IntegerField, \
 	FloatField, \
-	SmallIntegerField, CheckConstraint, Q, F, ImageField
+	SmallIntegerField, CheckConstraint, Q, F, ImageField, Index
 
 from chat.log_filters import id_generator
 from chat.settings import GENDERS, JS_CONSOLE_LOGS, ALL_ROOM_ID
@@ -290,10 +290,21 @@ class Message(Model):
 	deleted = BooleanField(default=False)
 	message_status = CharField(max_length=1, null=False, default=MessageStatus.on_server.value)
 	thread_messages_count = IntegerField(default=0, null=False)
+	# id and time of the newest message in thread, set if thread_messages_count > 0
+	thread_last_reply_id = IntegerField(null=True, blank=True)
+	thread_last_reply_time = BigIntegerField(null=True, blank=True)
 	parent_message = ForeignKey('self', CASCADE, null=True, blank=True)
 	giphy = URLField(null=True, blank=True)
 	updated_at = BigIntegerField(default=get_milliseconds, null=False)
 
+	class Meta:  # pylint: disable=C1001
+		indexes = [
+			# pages of room history and thread replies are loaded by id
+			Index(fields=['room', 'parent_message', 'id']),
+			# syncHistory reads changes after (updated_at, id) cursor of every room
+			Index(fields=['room', 'updated_at', 'id']),
+		]
+
 	@property
 	def status(self):
 		return self.MessageStatus(self.message_status)
@@ -327,11 +338,31 @@ class MessageMention(Model):
 		unique_together = ('user', 'symbol', 'message')
 
 
+class MessageSearchWord(Model):
+	"""
+	Inverted index of Message.content, a row per unique word of a message.
+	Room is copied from the message, so search in a room only reads the index
+	"""
+	word = CharField(null=False, max_length=32)
+	message = ForeignKey(Message, CASCADE, null=False)
+	room = ForeignKey(Room, CASCADE, null=True)
+
+	class Meta:  # pylint: disable=C1001
+		unique_together = ('message', 'word')
+		indexes = [Index(fields=['room', 'word', 'message'])]
+
+
 from django.db.models.signals import post_save
 
 def save_profile(sender, instance, created, **kwargs):
 	if created and instance.parent_message:
-		Message.objects.filter(id=instance.parent_message_id).update(thread_messages_count=F('thread_messages_count') + 1)
+		# updated_at is bumped, so syncHistory and message cache see the new thread state
+		Message.objects.filter(id=instance.parent_message_id).update(
+			updated_at=get_milliseconds(),
+			thread_messages_count=F('thread_messages_count') + 1,
+			thread_last_reply_id=instance.id,
+			thread_last_reply_time=instance.time
+		)
 
 post_save.connect(save_profile, sender=Message)
 
@@ -396,12 +427,24 @@ class RoomUsers(Model):
 
 
 class SubscriptionMessages(Model):
-	message = ForeignKey(Message, CASCADE, null=False)
+	"""
+	Notification of subscription about new messages in a room, a single one per room.
+	New messages replace @message and increase @count until client receives it
+	"""
+	message = ForeignKey(Message, CASCADE, null=False)  # the newest one
 	subscription = ForeignKey(Subscription, CASCADE, null=False)
+	room = ForeignKey(Room, CASCADE, null=True)
 	received = BooleanField(null=False, default=False)
+	count = IntegerField(null=False, default=1)
+	pushed = BigIntegerField(null=True)  # when push was sent, or will be sent if @delayed
+	delayed = BooleanField(null=False, default=False)  # push at the end of the window wasn't sent yet
 
 	class Meta:  # pylint: disable=C1001
-		unique_together = ("message", "subscription")
+		unique_together = ("subscription", "room")
+		indexes = [
+			# PushNotifier.claim_due looks for delayed pushes whose window has ended
+			Index(fields=['delayed', 'pushed']),
+		]
 		db_table = ''.join((User._meta.app_label, '_subscription_message'))
 
 
@@ -44,6 +44,8 @@ EMAIL_SUBJECT_PREFIX = '[Pychat] '
 REDIS_PORT = 6379
 REDIS_HOST ='localhost'
 REDIS_DB = 0
+# max number of connections that tornado process uses for non-blocking redis commands
+REDIS_POOL_SIZE = 32
 
 
 LOGGING = {
@@ -76,9 +78,71 @@ GIPHY_REGEX = r"^\s*\/giphy (.+)"
 AUTH_USER_MODEL = 'chat.User'
 
 FIREBASE_URL = 'https://fcm.googleapis.com/fcm/send'
+# new messages are collected for that many milliseconds, then offline users get a single push per subscription
+PUSH_NOTIFICATION_DELAY = 1000
+# milliseconds, a subscription gets at most one push per room in that window, the rest are counted as "N new messages"
+PUSH_NOTIFICATION_WINDOW = 60000
+# milliseconds, how often every process looks in db for delayed pushes whose window has ended
+PUSH_NOTIFICATION_DUE_INTERVAL = 5000
+# messages waiting for push, the ones above are dropped
+PUSH_NOTIFICATION_QUEUE_SIZE = 10000
+# failed pushes are retried after PUSH_NOTIFICATION_BACKOFF ms, and every next retry waits twice as much
+PUSH_NOTIFICATION_RETRIES = 5
+PUSH_NOTIFICATION_BACKOFF = 1000
 
 CONCURRENT_THREAD_WORKERS = 10
 
+# (requests, seconds) sliding window of http methods with @rate_limit, counted per ip and per username
+HTTP_RATE_LIMITS = {
+	'auth': (10, 60),
+	'register': (5, 600),
+	'send_restore_password': (3, 600),
+	'validate_user': (60, 60),
+	'validate_email': (60, 60),
+}
+
+# addresses of reverse proxies (nginx) that set X-Real-IP, clients that connect directly can't spoof their ip with it
+TRUSTED_PROXIES = ('127.0.0.1', '::1')
+
+# websocket actions that query database run in thread pools, so a slow query doesn't block the IOLoop.
+# searchMessages, syncHistory and loadMessages use a separate pool
+WS_DB_THREAD_WORKERS = 10
+WS_DB_HEAVY_THREAD_WORKERS = 4
+# if that many actions are already waiting for a thread, new ones are rejected
+WS_DB_MAX_QUEUE_SIZE = 1000
+WS_DB_HEAVY_MAX_QUEUE_SIZE = 200
+# milliseconds message statuses are collected for, before they are saved with a single update per room
+WS_MESSAGE_STATUS_DELAY = 30
+# milliseconds, showIType of a user in a room is published at most once per interval.
+# Should be a bit less than SHOW_I_TYPING_INTERVAL of frontend, which sends it every 5s while user types
+SHOW_I_TYPE_INTERVAL = 4000
+# milliseconds clients show that user is typing after an event, None leaves it to client
+SHOW_I_TYPE_EXPIRE = 7500
+
+# (burst, tokens per second) of websocket actions, see chat/tornado/anti_spam.py for action classes.
+# Limits are checked for every connection and for all connections of a user in a single process,
+# a class that's missing is not limited
+ANTI_SPAM_LIMITS = {
+	'messages': (20, 2),
+	'searches': (10, 1),
+	'webrtc': (100, 20),
+	'other': (200, 20),
+}
+ANTI_SPAM_USER_LIMITS = {
+	'messages': (40, 4),
+	'searches': (20, 2),
+	'webrtc': (200, 40),
+	'other': (400, 40),
+}
+
+# permessage-deflate for websockets, None disables compression
+WS_COMPRESSION_LEVEL = 6
+WS_COMPRESSION_MEM_LEVEL = 8
+# frames shorter than that many bytes are sent uncompressed
+WS_COMPRESSION_MIN_SIZE = 512
+# how often compression ratio and time are logged, milliseconds. 0 disables reports
+WS_COMPRESSION_REPORT_INTERVAL = 600000
+
 # Database
 # https://docs.djangoproject.com/en/1.6/ref/settings/#databases
 # pip install PyMySQL
@@ -118,6 +182,14 @@ DEFAULT_CHARSET = 'utf-8'
 PROJECT_DIR = os.path.dirname(os.path.realpath(project_module.__file__))
 
 MESSAGES_PER_SEARCH = 10
+# max messages in a single syncHistory response, client asks for the next chunk if there's more
+SYNC_HISTORY_CHUNK_SIZE = 200
+# serialized messages kept in memory of every tornado process, and seconds they live in redis
+MESSAGE_CACHE_SIZE = 20000
+MESSAGE_CACHE_TTL = 7 * 24 * 60 * 60
+# newest messages of a room kept in redis for the first page of history, and seconds they live if nobody reads them
+ROOM_RING_SIZE = 50
+ROOM_RING_TTL = 24 * 60 * 60
 AUTH_PROFILE_MODULE = 'chat.UserProfile'
 
 
@@ -2,11 +2,17 @@ import json
 import ssl
 from random import randint
 from random import random
-from threading import Thread
+from threading import Thread, Event, current_thread
 from time import sleep
+from unittest import skipIf
+from unittest.mock import Mock, patch
 
 from django.conf import settings
-from django.test import TestCase
+from django.core.exceptions import ValidationError
+from django.test import TestCase, override_settings
+from tornado import gen
+from tornado.concurrent import Future
+from tornado.ioloop import IOLoop
 from websocket import create_connection
 
 # class ModelTest(TestCase):
@@ -48,15 +54,28 @@ from websocket import create_connection
 # 		elem = driver.find_element_by_id("userNameLabel")
 # 		self.assertRegexpMatches(elem.text, "^[a-zA-Z-_0-9]{1,16}$")
 # 		driver.close()
-from chat.global_redis import sync_redis
-from chat.models import UserProfile
+from chat.global_redis import sync_redis, AsyncRedis
+from chat.models import UserProfile, Room, Message, Subscription, SubscriptionMessages, get_milliseconds
 from chat.socials import GoogleAuth
-from chat.tornado.constants import VarNames, Actions
+from chat.tornado import json_codec, msgpack_codec, presence, user_directory
+from chat.tornado.anti_spam import TokenBucket, AntiSpam
+from chat.tornado.constants import VarNames, Actions, RedisPrefix
+from chat.tornado.db_executor import DbExecutor, on_io_loop
+from chat.tornado.message_cache import MessageDtoCache
+from chat.tornado.message_handler import MessagesHandler
+from chat.tornado.message_search import get_words, index_message, search, MAX_WORD_LENGTH
+from chat.tornado.message_status import MessageStatusAggregator
+from chat.tornado.method_dispatcher import MethodDispatcher, RATE_LIMIT_SCRIPT
+from chat.tornado.pubsub import PubSubMultiplexer
+from chat.tornado.push_notifications import PushNotifier
+from chat.tornado.room_ring import RoomRing
+from chat.tornado.user_directory import UserDirectory
+from chat.utils import encode_cursor, decode_cursor, paginate_by_id
 
 
 class RegisterTest(TestCase):
 
-    def test_animals_can_speak(self):
+	def test_animals_can_speak(self):
 		user_profile = UserProfile(
 			 name='test',
 			 surname='test',
@@ -66,6 +85,693 @@ class RegisterTest(TestCase):
 		gauth = GoogleAuth()
 		gauth.download_http_photo('https://lh4.googleusercontent.com/-CuLSUOTQ4Kw/AAAAAAAAAAI/AAAAAAAAANQ/VlgHrqehE90/s96-c/photo.jpg', user_profile)
 
+class TokenBucketTest(TestCase):
+
+	def test_burst(self):
+		bucket = TokenBucket(3, 1)
+		now = bucket.updated
+		self.assertTrue(all(bucket.take(now) for i in range(3)))
+		self.assertFalse(bucket.take(now))
+
+	def test_refill(self):
+		bucket = TokenBucket(2, 4)
+		now = bucket.updated
+		bucket.take(now)
+		bucket.take(now)
+		self.assertFalse(bucket.take(now))
+		self.assertTrue(bucket.take(now + 0.25))
+		# doesn't grow above capacity after a long pause
+		bucket.take(now + 100)
+		self.assertTrue(bucket.take(now + 100))
+		self.assertFalse(bucket.take(now + 100))
+
+
+class AntiSpamTest(TestCase):
+
+	@override_settings(ANTI_SPAM_LIMITS={'messages': (2, 0.001)}, ANTI_SPAM_USER_LIMITS={'messages': (3, 0.001)})
+	def test_user_buckets(self):
+		first = AntiSpam()
+		second = AntiSpam()
+		first.set_user(1)
+		second.set_user(1)
+		first.check_spam(Actions.PRINT_MESSAGE)
+		first.check_spam(Actions.PRINT_MESSAGE)
+		# bucket of the connection is empty
+		self.assertRaises(ValidationError, first.check_spam, Actions.PRINT_MESSAGE)
+		second.check_spam(Actions.PRINT_MESSAGE)
+		# bucket of the user is shared by both connections
+		self.assertRaises(ValidationError, second.check_spam, Actions.PRINT_MESSAGE)
+		# actions without limits are not counted
+		second.check_spam(Actions.PING)
+		self.assertEqual(second.spammed, 1)
+		first.release()
+		self.assertIn(1, AntiSpam.user_buckets)
+		second.release()
+		self.assertNotIn(1, AntiSpam.user_buckets)
+
+
+class PubSubMultiplexerTest(TestCase):
+
+	def setUp(self):
+		with patch('chat.tornado.pubsub.Client'):
+			self.pubsub = PubSubMultiplexer('localhost', 6379, 0)
+		self.redis = self.pubsub.redis
+
+	def test_subscribes_once_per_channel(self):
+		first, second = Mock(), Mock()
+		self.pubsub.subscribe([1, 'u1'], first)
+		self.pubsub.subscribe([1], second)
+		self.pubsub.subscribe([1], second)
+		self.redis.subscribe.assert_called_once_with(['1', 'u1'])
+		self.pubsub.unsubscribe([1], second)
+		self.redis.unsubscribe.assert_not_called()
+		# handler that isn't subscribed doesn't release somebody else's reference
+		self.pubsub.unsubscribe([1], second)
+		self.redis.unsubscribe.assert_not_called()
+		self.pubsub.unsubscribe([1, 'u1'], first)
+		self.redis.unsubscribe.assert_called_once_with(['1', 'u1'])
+		self.assertEqual(dict(self.pubsub.subscribers), {})
+
+	def test_dispatch(self):
+		first, second, other = Mock(), Mock(), Mock()
+		self.pubsub.subscribe([1], first)
+		self.pubsub.subscribe([1], second)
+		self.pubsub.subscribe([2], other)
+		body = '{}{{"{}": "{}"}}'.format(RedisPrefix.PARSABLE_PREFIX, VarNames.EVENT, Actions.PING)
+		self.pubsub.on_pub_sub_message(Mock(kind='message', channel='1', body=body))
+		frame = first.on_pub_sub_message.call_args[0][0]
+		# decoded once and shared
+		self.assertIs(second.on_pub_sub_message.call_args[0][0], frame)
+		self.assertEqual(frame.parsed, {VarNames.EVENT: Actions.PING})
+		other.on_pub_sub_message.assert_not_called()
+
+	def test_disconnect(self):
+		handler = Mock()
+		self.pubsub.subscribe([1, 2], handler)
+		with patch('chat.tornado.pubsub.Client'):
+			self.pubsub.on_pub_sub_message(Mock(kind='disconnect'))
+		handler.close.assert_called_once_with(1012, "Redis connection lost")
+		self.assertEqual(dict(self.pubsub.subscribers), {})
+
+
+class AsyncRedisTest(TestCase):
+
+	def setUp(self):
+		self.client = Mock()
+		self.client.disconnect.side_effect = lambda callback: callback()
+		self.async_redis = AsyncRedis('localhost', 6379, 0, 2)
+
+	def execute(self, command, *args):
+		with patch('chat.global_redis.tornadoredis.Client', return_value=self.client):
+			return IOLoop.current().run_sync(lambda: getattr(self.async_redis, command)(*args))
+
+	def test_reply(self):
+		self.client.hget.side_effect = lambda key, field, callback: callback('value')
+		self.assertEqual(self.execute('hget', 'key', 'field'), 'value')
+		self.client.hget.assert_called_once()
+		# connection goes back to the pool
+		self.client.disconnect.assert_called_once()
+
+	def test_error(self):
+		self.client.get.side_effect = lambda key, callback: callback(ValueError('wrong type'))
+		self.assertRaises(ValueError, self.execute, 'get', 'key')
+		self.client.disconnect.assert_called_once()
+
+
+class DbExecutorTest(TestCase):
+
+	@staticmethod
+	def wait(futures):
+		@gen.coroutine
+		def wait_all():
+			yield futures
+			yield gen.moment  # lets on_done callbacks run
+		return IOLoop.current().run_sync(wait_all)
+
+	def test_queue_limit(self):
+		executor = DbExecutor('test', 1, 2)
+		release = Event()
+		futures = [executor.submit(release.wait) for i in range(2)]
+		self.assertRaises(ValidationError, executor.submit, release.wait)
+		release.set()
+		self.wait(futures)
+		self.assertEqual(executor.queue_size, 0)
+		self.wait([executor.submit(release.wait)])
+
+	@patch('chat.tornado.db_executor.close_old_connections')
+	def test_recycles_connections(self, close_old_connections):
+		executor = DbExecutor('test', 1, 10)
+		calls_before = []
+
+		def fail():
+			calls_before.append(close_old_connections.call_count)
+			raise ValueError()
+		future = executor.submit(fail)
+		self.assertRaises(ValueError, self.wait, [future])
+		# checked before the task, and closed after it even if it failed
+		self.assertEqual(calls_before, [1])
+		self.assertEqual(close_old_connections.call_count, 2)
+
+	def test_on_io_loop(self):
+		executor = DbExecutor('test', 1, 10)
+		threads = []
+		done = Event()
+
+		@on_io_loop
+		def publish():
+			threads.append(current_thread())
+			done.set()
+
+		self.wait([executor.submit(publish)])
+		IOLoop.current().run_sync(lambda: gen.sleep(0))
+		self.assertTrue(done.is_set())
+		self.assertEqual(threads, [current_thread()])
+
+
+class RedisScriptTest(TestCase):
+	"""
+	Runs lua scripts of the stores that use async redis through sync_redis, on keys that are deleted after the test
+	"""
+
+	def setUp(self):
+		self.keys = set()
+
+	def tearDown(self):
+		if self.keys:
+			sync_redis.delete(*self.keys)
+
+	def key(self, name):
+		key = 'test:{}:{}'.format(self.__class__.__name__, name)
+		self.keys.add(key)
+		return key
+
+	@staticmethod
+	def eval(script, keys, args):
+		return sync_redis.eval(script, len(keys), *keys, *args)
+
+	@classmethod
+	def decode(cls, reply):
+		if isinstance(reply, bytes):
+			return reply.decode('utf-8')
+		if isinstance(reply, list):
+			return [cls.decode(item) for item in reply]
+		return reply
+
+	@staticmethod
+	def resolved(result):
+		future = Future()
+		future.set_result(result)
+		return future
+
+	def async_redis(self):
+		"""
+		Evaluates scripts synchronously and replies with strings like tornadoredis does
+		"""
+		async_redis = Mock()
+		async_redis.eval.side_effect = lambda script, keys, args: self.resolved(self.decode(self.eval(script, keys, args)))
+		return async_redis
+
+
+class PresenceTest(RedisScriptTest):
+
+	def setUp(self):
+		super(PresenceTest, self).setUp()
+		self.online = self.key('online')
+		self.versions = self.key('versions')
+
+	def user_keys(self, user_id, room_ids=()):
+		return [self.online, self.versions, self.key('connections:%s' % user_id)] + \
+			[self.key('room:%s' % room_id) for room_id in room_ids]
+
+	def add(self, user_id, connection_id, room_ids=()):
+		return self.eval(presence.ADD_CONNECTION_SCRIPT, self.user_keys(user_id, room_ids), [user_id, connection_id])
+
+	def remove(self, user_id, connection_id, room_ids=()):
+		return self.eval(presence.REMOVE_CONNECTION_SCRIPT, self.user_keys(user_id, room_ids), [user_id, connection_id])
+
+	def tabs(self, user_id):
+		return int(sync_redis.hget(self.online, user_id) or 0)
+
+	def test_tabs(self):
+		self.add(1, 'a')
+		self.add(1, 'b')
+		# the same connection is counted once
+		res = self.add(1, 'a')
+		self.assertEqual(sorted(res[1:]), [b'a', b'b'])
+		self.assertEqual(self.tabs(1), 2)
+		self.remove(1, 'a')
+		self.assertEqual(self.tabs(1), 1)
+		# removing a connection twice doesn't close another tab
+		self.remove(1, 'a')
+		self.assertEqual(self.tabs(1), 1)
+		res = self.remove(1, 'b')
+		self.assertEqual(res[1:], [])
+		self.assertFalse(sync_redis.hexists(self.online, 1))
+
+	def test_versions(self):
+		self.assertEqual(self.add(1, 'a')[0], 1)
+		self.assertEqual(self.add(1, 'b')[0], 2)
+		self.assertEqual(self.remove(1, 'a')[0], 3)
+		self.add(2, 'c')
+		keys = [self.versions, self.key('connections:1'), self.key('connections:2'), self.key('connections:3')]
+		users = self.eval(presence.GET_CONNECTIONS_SCRIPT, keys, [1, 2, 3])
+		self.assertEqual(users, [[b'3', b'b'], [b'1', b'c'], [None]])
+
+	def test_rooms_online(self):
+		self.add(1, 'a', [10, 11])
+		self.add(1, 'b', [10, 11])
+		self.add(2, 'c', [10])
+		self.remove(1, 'a', [10, 11])
+		rooms = self.eval(presence.GET_ROOMS_ONLINE_SCRIPT, [self.key('room:10'), self.key('room:11')], [])
+		self.assertEqual([sorted(users) for users in rooms], [[b'1', b'2'], [b'1']])
+		# user leaves rooms' online only with the last tab
+		self.remove(1, 'b', [10, 11])
+		rooms = self.eval(presence.GET_ROOMS_ONLINE_SCRIPT, [self.key('room:10'), self.key('room:11')], [])
+		self.assertEqual(rooms, [[b'2'], []])
+
+	def test_online_change_is_published_to_rooms_only(self):
+		handler = MessagesHandler()
+		handler.channels = [1, 2, 'u1', 'ws1']
+		handler.raw_publish = Mock()
+		handler.publish_online_change({VarNames.EVENT: Actions.LOGIN, VarNames.USER_ID: 1})
+		self.assertEqual(sorted(c[0][1] for c in handler.raw_publish.call_args_list), [1, 2])
+
+
+class UserDirectoryTest(RedisScriptTest):
+
+	def setUp(self):
+		super(UserDirectoryTest, self).setUp()
+		self.directory = UserDirectory(self.async_redis())
+		self.directory.keys = [self.key('base'), self.key('version'), self.key('changes'), self.key('users')]
+
+	def build(self, users):
+		with patch.object(MessagesHandler.heavy_db_executor, 'submit', return_value=self.resolved(users)):
+			IOLoop.current().run_sync(self.directory.build)
+
+	def test_build(self):
+		self.build({1: {VarNames.USER_ID: 1}, 2: {VarNames.USER_ID: 2}})
+		self.assertEqual(set(self.directory.users), {1, 2})
+		self.assertEqual(self.directory.version, self.directory.base)
+		res = self.decode(self.eval(user_directory.GET_USERS_SCRIPT, self.directory.keys, [0]))
+		self.assertEqual(res[0], str(self.directory.base))
+		self.assertEqual(sorted(res[2::3]), ['1', '2'])
+
+	def test_build_from_older_data_is_rejected(self):
+		keys = self.directory.keys
+		self.assertEqual(self.eval(user_directory.BUILD_SCRIPT, keys, [100, 1, '{}']), b'100')
+		self.assertIsNone(self.eval(user_directory.BUILD_SCRIPT, keys, [50, 2, '{}']))
+		self.assertEqual(sync_redis.hkeys(keys[3]), [b'1'])
+
+	def test_build_reads_newer_directory(self):
+		# another process started the query later, but wrote first
+		base = get_milliseconds() + 60000
+		self.eval(user_directory.BUILD_SCRIPT, self.directory.keys, [base, 1, '{}'])
+		self.build({2: {VarNames.USER_ID: 2}})
+		self.assertEqual(self.directory.base, base)
+		self.assertEqual(list(self.directory.users), [1])
+
+	def get_users(self, since=None):
+		return IOLoop.current().run_sync(lambda: self.directory.get_users(since))
+
+	def test_diff_since_version(self):
+		self.build({1: {VarNames.USER_ID: 1}, 2: {VarNames.USER_ID: 2}})
+		base = self.directory.version
+		IOLoop.current().run_sync(lambda: self.directory.patch({VarNames.USER_ID: 2, 'sex': 'Female'}))
+		version, users, full = self.get_users(base)
+		self.assertEqual((version, full), (base + 1, False))
+		self.assertEqual([json.loads(user) for user in users], [{VarNames.USER_ID: 2, 'sex': 'Female'}])
+		# client that is up to date receives nothing
+		self.assertEqual(self.get_users(base + 1), (base + 1, [], False))
+		# unknown version gets everything
+		version, users, full = self.get_users(base - 1)
+		self.assertTrue(full)
+		self.assertEqual(len(users), 2)
+
+	def test_patch_before_build(self):
+		self.assertIsNone(self.eval(user_directory.PATCH_SCRIPT, self.directory.keys, [1, '{}']))
+
+	def test_older_refresh_is_ignored(self):
+		self.directory.apply(['5', '7', '1', '7', '{"a": 2}'])
+		self.directory.apply(['5', '6', '1', '6', '{"a": 1}'])
+		self.assertEqual(self.directory.version, 7)
+		self.assertEqual(self.directory.users, {1: '{"a": 2}'})
+
+
+class JsonCodecTest(TestCase):
+
+	def test_backends(self):
+		message = {VarNames.CONTENT: 'привет </script>', VarNames.ONLINE: {5: ['a']}, 'n': [1, 2.5, None, True]}
+		for name, (dumps, loads) in json_codec.BACKENDS.items():
+			encoded = dumps(message)
+			self.assertIsInstance(encoded, str, name)
+			# int keys become strings, like stdlib does
+			self.assertEqual(loads(encoded), dict(message, **{VarNames.ONLINE: {'5': ['a']}}), name)
+			self.assertEqual(loads(encoded.encode('utf-8')), loads(encoded), name)
+
+	def test_dumps_with_list(self):
+		items = [json_codec.dumps({'id': 1}), json_codec.dumps({'id': 2})]
+		self.assertEqual(
+			json_codec.loads(json_codec.dumps_with_list({'a': 1}, 'users', items)),
+			{'a': 1, 'users': [{'id': 1}, {'id': 2}]}
+		)
+		self.assertEqual(json_codec.loads(json_codec.dumps_with_list({}, 'users', [])), {'users': []})
+
+
+@skipIf(msgpack_codec.msgpack is None, 'msgpack is not installed')
+class MsgpackCodecTest(TestCase):
+
+	def test_round_trip(self):
+		message = {
+			VarNames.EVENT: Actions.PRINT_MESSAGE,
+			VarNames.ROOM_ID: 1,
+			VarNames.CONTENT: 'hello',
+			VarNames.ONLINE: {5: ['a', 'b']},
+			'unknown': [{VarNames.USER_ID: 3}],
+		}
+		compacted = msgpack_codec.compact(message)
+		self.assertNotIn(VarNames.EVENT, compacted)
+		self.assertEqual(msgpack_codec.decode(msgpack_codec.encode(message)), dict(message, **{
+			VarNames.ONLINE: {'5': ['a', 'b']}
+		}))
+
+	def test_broken_frame(self):
+		self.assertRaises(ValueError, msgpack_codec.decode, b'\xc1')
+
+
+class MessageSearchTest(TestCase):
+
+	def test_get_words(self):
+		self.assertEqual(get_words('Hello, hello world! Привет'), ['hello', 'world', 'привет'])
+		self.assertEqual(get_words(None), [])
+		self.assertEqual(get_words('a' * 100), ['a' * MAX_WORD_LENGTH])
+
+	def test_search(self):
+		user = UserProfile.objects.create(username='test', email='test@mail.ru')
+		room = Room.objects.create(name='test')
+		ids = []
+		for content in ('hello world', 'hello there', 'world peace'):
+			message = Message.objects.create(sender=user, room=room, content=content)
+			index_message(message.id, room.id, content, True)
+			ids.append(message.id)
+		self.assertEqual([m.id for m in search(room.id, 'hello', 10)], [ids[1], ids[0]])
+		# the last word is being typed
+		self.assertEqual([m.id for m in search(room.id, 'hello wor', 10)], [ids[0]])
+		self.assertEqual([m.id for m in search(room.id, 'hello', 10, before_id=ids[1])], [ids[0]])
+		index_message(ids[0], room.id, 'bye')
+		self.assertEqual([m.id for m in search(room.id, 'hello', 10)], [ids[1]])
+
+
+class PaginationTest(TestCase):
+
+	def setUp(self):
+		user = UserProfile.objects.create(username='test', email='test@mail.ru')
+		self.room = Room.objects.create(name='test')
+		self.ids = [Message.objects.create(sender=user, room=self.room, content=str(i)).id for i in range(5)]
+
+	def test_cursor(self):
+		self.assertEqual(decode_cursor(encode_cursor(before_id=10)), (10, None))
+		self.assertEqual(decode_cursor(encode_cursor(after_id=10)), (None, 10))
+		for cursor in ('', 'b', 'x10', 'b-1', 'a1.5', 10, None):
+			self.assertRaises(ValidationError, decode_cursor, cursor)
+
+	def test_before(self):
+		query_set = Message.objects.filter(room=self.room)
+		page, cursor = paginate_by_id(query_set, 2)
+		self.assertEqual([m.id for m in page], self.ids[:-3:-1])
+		page, cursor = paginate_by_id(query_set, 2, *decode_cursor(cursor))
+		self.assertEqual([m.id for m in page], self.ids[2:0:-1])
+		page, cursor = paginate_by_id(query_set, 2, *decode_cursor(cursor))
+		self.assertEqual([m.id for m in page], self.ids[:1])
+		self.assertIsNone(cursor)
+
+	def test_after(self):
+		query_set = Message.objects.filter(room=self.room)
+		page, cursor = paginate_by_id(query_set, 3, after_id=self.ids[0])
+		self.assertEqual([m.id for m in page], self.ids[1:4])
+		page, cursor = paginate_by_id(query_set, 3, *decode_cursor(cursor))
+		self.assertEqual([m.id for m in page], self.ids[4:])
+		self.assertIsNone(cursor)
+
+
+class MessageDtoCacheTest(TestCase):
+
+	def setUp(self):
+		self.sync_redis = Mock()
+		self.sync_redis.mget.side_effect = lambda keys: [None] * len(keys)
+		self.cache = MessageDtoCache(self.sync_redis, 2, 60)
+		user = UserProfile.objects.create(username='test', email='test@mail.ru')
+		self.message = Message.objects.create(sender=user, room=Room.objects.create(name='test'), content='hi')
+
+	def test_key_changes_with_message(self):
+		key = MessageDtoCache.get_key(self.message)
+		self.message.updated_at += 1
+		self.assertNotEqual(MessageDtoCache.get_key(self.message), key)
+
+	def test_loaded_from_db_once(self):
+		first = self.cache.get_json([self.message])
+		self.assertEqual(json_codec.loads(first[0])[VarNames.CONTENT], 'hi')
+		self.sync_redis.pipeline.return_value.setex.assert_called_once()
+		self.sync_redis.mget.reset_mock()
+		self.assertEqual(self.cache.get_json([self.message]), first)
+		self.sync_redis.mget.assert_not_called()
+
+	def test_deleted_from_db(self):
+		self.message.delete()
+		self.assertEqual(self.cache.get_json_with_ids([self.message]), [])
+
+	def test_lru(self):
+		self.cache.remember({'a': '1', 'b': '2'})
+		self.cache.get_many(['a'])
+		self.cache.remember({'c': '3'})
+		# b is the least recently used
+		self.assertEqual(list(self.cache.lru), ['a', 'c'])
+		self.sync_redis.mget.side_effect = lambda keys: [b'2']
+		self.assertEqual(self.cache.get_many(['b']), {'b': '2'})
+		self.sync_redis.mget.assert_called_once_with([RedisPrefix.MESSAGE_DTO_PREFIX + 'b'])
+
+
+class RoomRingTest(RedisScriptTest):
+
+	def setUp(self):
+		super(RoomRingTest, self).setUp()
+		self.room_id = 'test'
+		self.keys.update(RoomRing.get_keys(self.room_id))
+		self.ring = RoomRing(sync_redis, Mock(), 3, 60)
+
+	def finish_build(self, *messages):
+		args = [self.ring.size, self.ring.ttl]
+		for message in messages:
+			args.extend(message)
+		self.ring.finish_build_script(keys=RoomRing.get_keys(self.room_id), args=args)
+
+	def add(self, message_id, updated_at, json):
+		self.ring.add(self.room_id, Mock(id=message_id, updated_at=updated_at), json)
+
+	def test_newest_version_wins(self):
+		self.finish_build((1, 100, '"a"'))
+		self.add(2, 100, '"b"')
+		self.add(1, 50, '"stale"')
+		self.ring.update_script(keys=RoomRing.get_keys(self.room_id), args=[1, 200, '"new"', 2, 50, '"stale"', 5, 1, '"c"'])
+		self.assertEqual(self.ring.get(self.room_id, 3), [(2, '"b"'), (1, '"new"')])
+
+	def test_edit_during_build(self):
+		sync_redis.set(RoomRing.get_keys(self.room_id)[0], 'building')
+		self.add(1, 300, '"edited"')
+		self.finish_build((1, 100, '"a"'), (2, 100, '"b"'))
+		self.assertEqual(self.ring.get(self.room_id, 3), [(2, '"b"'), (1, '"edited"')])
+
+	def test_size(self):
+		self.finish_build((1, 1, '"a"'), (2, 1, '"b"'), (3, 1, '"c"'))
+		self.add(4, 1, '"d"')
+		self.assertEqual(self.ring.get(self.room_id, 2), [(4, '"d"'), (3, '"c"')])
+		self.assertEqual([message_id for message_id, json in self.ring.get(self.room_id, 3)], [4, 3, 2])
+		self.assertIsNone(self.ring.get(self.room_id, 4))
+
+	def test_missing_dto(self):
+		self.finish_build((1, 1, '"a"'), (2, 1, '"b"'))
+		sync_redis.hdel(RoomRing.get_keys(self.room_id)[2], 1)
+		self.assertEqual(self.ring.get(self.room_id, 1), [(2, '"b"')])
+		self.assertIsNone(self.ring.get(self.room_id, 2))
+
+
+class MessageStatusAggregatorTest(TestCase):
+
+	def setUp(self):
+		self.user = UserProfile.objects.create(username='test', email='test@mail.ru')
+		self.room = Room.objects.create(name='test')
+		self.db_executor = Mock()
+		self.aggregator = MessageStatusAggregator(self.db_executor, 10)
+
+	def test_read_overrides_received(self):
+		self.aggregator.add(self.room.id, 1, Message.MessageStatus.received, [1, 2])
+		self.aggregator.add(self.room.id, 1, Message.MessageStatus.read, [2, 3])
+		self.aggregator.add(self.room.id, 2, Message.MessageStatus.received, [2])
+		self.aggregator.flush()
+		self.db_executor.submit.assert_called_once_with(self.aggregator.apply, {
+			(self.room.id, 1, Message.MessageStatus.received): {1},
+			(self.room.id, 1, Message.MessageStatus.read): {2, 3},
+			(self.room.id, 2, Message.MessageStatus.received): {2},
+		})
+		self.assertEqual(self.aggregator.pending, {})
+
+	def test_unsupported_status(self):
+		self.assertRaises(ValidationError, self.aggregator.add, self.room.id, 1, Message.MessageStatus.on_server, [1])
+
+	@patch('chat.global_redis.room_ring')
+	def test_apply(self, room_ring):
+		on_server = Message.objects.create(sender=self.user, room=self.room, updated_at=1)
+		read = Message.objects.create(
+			sender=self.user,
+			room=self.room,
+			updated_at=1,
+			message_status=Message.MessageStatus.read.value
+		)
+		self.aggregator.publish = Mock()
+		self.aggregator.apply({(self.room.id, self.user.id, Message.MessageStatus.received): {on_server.id, read.id}})
+		on_server.refresh_from_db()
+		read.refresh_from_db()
+		self.assertEqual(on_server.message_status, Message.MessageStatus.received.value)
+		self.assertGreater(on_server.updated_at, 1)
+		# statuses don't go back
+		self.assertEqual(read.message_status, Message.MessageStatus.read.value)
+		self.assertEqual(read.updated_at, 1)
+		room_ring.refresh.assert_called_once_with(self.room.id, [on_server.id])
+		event = self.aggregator.publish.call_args[0][0]
+		self.assertEqual(event[VarNames.MESSAGE_IDS], [on_server.id])
+		self.assertEqual(event[VarNames.USER_ID], self.user.id)
+		self.assertEqual(event[VarNames.EDITED_TIMES], on_server.updated_at)
+
+
+class ShowITypeTest(TestCase):
+
+	def setUp(self):
+		self.handler = MessagesHandler()
+		self.handler.user_id = 1
+		self.handler.id = '0001:test'
+		self.handler.async_redis = Mock()
+		self.handler.async_redis.set.return_value = gen.maybe_future(True)
+		self.handler.publish = Mock()
+
+	def show_i_type(self, room_id):
+		IOLoop.current().run_sync(lambda: self.handler.show_i_type({VarNames.ROOM_ID: room_id}))
+
+	def test_throttled_per_room(self):
+		self.show_i_type(1)
+		self.show_i_type(1)
+		self.show_i_type(2)
+		self.assertEqual(self.handler.async_redis.set.call_count, 2)
+		self.assertEqual([c[0][1] for c in self.handler.publish.call_args_list], [1, 2])
+
+	def test_another_tab_published(self):
+		self.handler.async_redis.set.return_value = gen.maybe_future(None)
+		self.show_i_type(1)
+		self.handler.publish.assert_not_called()
+
+
+class RateLimitTest(RedisScriptTest):
+
+	def request(self, keys, now, request_id):
+		return self.eval(RATE_LIMIT_SCRIPT, [self.key(key) for key in keys], [now, 1000, 2, request_id])
+
+	def test_sliding_window(self):
+		self.assertEqual(self.request(['ip'], 0, 'a'), 0)
+		self.assertEqual(self.request(['ip'], 100, 'b'), 0)
+		self.assertEqual(self.request(['ip'], 200, 'c'), 800)
+		# rejected requests aren't counted
+		self.assertEqual(sync_redis.zcard(self.key('ip')), 2)
+		self.assertEqual(self.request(['ip'], 1000, 'd'), 0)
+		self.assertEqual(self.request(['ip'], 1050, 'e'), 50)
+
+	def test_any_key_limits(self):
+		self.request(['ip', 'user1'], 0, 'a')
+		self.request(['ip', 'user2'], 0, 'b')
+		self.assertEqual(self.request(['ip2', 'user1'], 0, 'c'), 0)
+		self.assertEqual(self.request(['ip', 'user3'], 0, 'd'), 1000)
+		self.assertFalse(sync_redis.exists(self.key('user3')))
+
+	def client_ip(self, remote_ip):
+		request = Mock(remote_ip=remote_ip, headers={'X-Real-IP': '8.8.8.8'})
+		return MethodDispatcher.client_ip.fget(Mock(request=request))
+
+	@override_settings(TRUSTED_PROXIES=('127.0.0.1',))
+	def test_client_ip(self):
+		self.assertEqual(self.client_ip('127.0.0.1'), '8.8.8.8')
+		# header of a client that connects directly is ignored
+		self.assertEqual(self.client_ip('1.1.1.1'), '1.1.1.1')
+
+
+@patch('chat.tornado.push_notifications.IOLoop')
+@patch('chat.tornado.push_notifications.FIREBASE_API_KEY', 'key')
+class PushNotifierTest(TestCase):
+
+	def setUp(self):
+		self.notifier = PushNotifier(Mock())
+
+	def test_single_flush(self, io_loop):
+		self.notifier.add(1, 10)
+		self.notifier.add(1, 11)
+		self.notifier.add(2, 12)
+		io_loop.current.return_value.call_later.assert_called_once_with(
+			settings.PUSH_NOTIFICATION_DELAY / 1000,
+			self.notifier.flush
+		)
+		self.assertEqual(list(self.notifier.queue), [(1, 10), (1, 11), (2, 12)])
+
+	@override_settings(PUSH_NOTIFICATION_QUEUE_SIZE=2)
+	def test_queue_full(self, io_loop):
+		for message_id in range(3):
+			self.notifier.add(1, message_id)
+		self.assertEqual(list(self.notifier.queue), [(1, 0), (1, 1)])
+
+	@patch('chat.tornado.push_notifications.FIREBASE_API_KEY', None)
+	def test_disabled(self, io_loop):
+		self.notifier.add(1, 10)
+		self.assertEqual(len(self.notifier.queue), 0)
+		io_loop.current.assert_not_called()
+
+
+class PushWindowTest(TestCase):
+
+	def setUp(self):
+		self.user = UserProfile.objects.create(username='test', email='test@mail.ru')
+		self.room = Room.objects.create(name='test')
+		Subscription.objects.create(user=self.user, registration_id='reg')
+		self.messages = [Message.objects.create(sender=self.user, room=self.room).id for i in range(4)]
+
+	def save(self, message_id, now, online=()):
+		with patch('chat.tornado.push_notifications.get_milliseconds', return_value=now):
+			return PushNotifier.save_messages([(self.room.id, message_id)], {self.room.id: [self.user.id]}, {self.room.id: set(online)})
+
+	def claim(self, now):
+		with patch('chat.tornado.push_notifications.get_milliseconds', return_value=now):
+			return PushNotifier.claim_due()
+
+	def test_window(self):
+		window = settings.PUSH_NOTIFICATION_WINDOW
+		self.assertEqual(self.save(self.messages[0], 1000), ['reg'])
+		# the rest of the window is pushed once at its end
+		self.assertEqual(self.save(self.messages[1], 2000), [])
+		self.assertEqual(self.save(self.messages[2], 3000), [])
+		sub_mess = SubscriptionMessages.objects.get()
+		self.assertEqual((sub_mess.count, sub_mess.message_id), (3, self.messages[2]))
+		self.assertEqual((sub_mess.pushed, sub_mess.delayed), (1000 + window, True))
+		self.assertEqual(self.claim(window), [])
+		self.assertEqual(self.claim(1000 + window), ['reg'])
+		self.assertEqual(self.claim(1000 + window), [])
+		# next window starts when the delayed push was sent
+		self.assertEqual(self.save(self.messages[3], 1000 + 2 * window), ['reg'])
+
+	def test_received_resets_count(self):
+		self.save(self.messages[0], 1000)
+		SubscriptionMessages.objects.update(received=True)
+		self.save(self.messages[1], 2000)
+		self.assertEqual(SubscriptionMessages.objects.get().count, 1)
+
+	def test_online_user(self):
+		self.assertEqual(self.save(self.messages[0], 1000, [self.user.id]), [])
+		self.assertFalse(SubscriptionMessages.objects.exists())
+
+
 class WebSocketLoadTest(TestCase):
 
 	SITE_TO_SPAM = "127.0.0.1:8888"
@@ -3,23 +3,105 @@ import time
 from django.core.exceptions import ValidationError
 from django.conf import settings
 
+from chat.tornado.constants import Actions
+
+# action class of websocket events, see settings.ANTI_SPAM_LIMITS, events that are not here belong to 'other'
+ACTION_CLASSES = {
+	Actions.PRINT_MESSAGE: 'messages',
+	Actions.EDIT_MESSAGE: 'messages',
+	Actions.SEARCH_MESSAGES: 'searches',
+	Actions.WEBRTC: 'webrtc',
+	Actions.CLOSE_FILE_CONNECTION: 'webrtc',
+	Actions.CLOSE_CALL_CONNECTION: 'webrtc',
+	Actions.CANCEL_CALL_CONNECTION: 'webrtc',
+	Actions.ACCEPT_CALL: 'webrtc',
+	Actions.JOIN_CALL: 'webrtc',
+	Actions.ACCEPT_FILE: 'webrtc',
+	Actions.OFFER_FILE_CONNECTION: 'webrtc',
+	Actions.OFFER_CALL_CONNECTION: 'webrtc',
+	Actions.OFFER_P2P_CONNECTION: 'webrtc',
+	Actions.REPLY_FILE_CONNECTION: 'webrtc',
+	Actions.RETRY_FILE_CONNECTION: 'webrtc',
+	Actions.REPLY_CALL_CONNECTION: 'webrtc',
+	Actions.NOTIFY_CALL_ACTIVE: 'webrtc',
+}
+OTHER_CLASS = 'other'
+
+
+class TokenBucket(object):
+	"""
+	Holds up to capacity tokens, that are refilled with rate tokens per second.
+	Every action takes one, so capacity is the burst and rate is the sustained limit
+	"""
+	__slots__ = ('capacity', 'rate', 'tokens', 'updated')
+
+	def __init__(self, capacity, rate):
+		self.capacity = capacity
+		self.rate = rate
+		self.tokens = capacity
+		self.updated = time.monotonic()
+
+	def take(self, now):
+		self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+		self.updated = now
+		if self.tokens < 1:
+			return False
+		self.tokens -= 1
+		return True
+
+
+def create_buckets(limits):
+	return {action_class: TokenBucket(*limit) for action_class, limit in limits.items()}
+
 
 class AntiSpam(object):
+	"""
+	Rate limits websocket frames of a connection, by buckets of that connection and buckets that are
+	shared by all connections of the same user in this process. Checked on IOLoop before the frame
+	is dispatched, so rejected frames don't reach db or redis
+	"""
+
+	# user_id -> [number of connections, buckets]
+	user_buckets = {}
 
 	def __init__(self):
 		self.spammed = 0
-		self.info = {}
+		self.user_id = None
+		self.buckets = create_buckets(settings.ANTI_SPAM_LIMITS)
 
-	def check_spam(self, json_message):
-		message_length = len(json_message)
-		info_key = int(round(time.time() * 100))
-		self.info[info_key] = message_length
-		if message_length > settings.MAX_MESSAGE_SIZE:
+	def set_user(self, user_id):
+		self.user_id = user_id
+		entry = self.user_buckets.get(user_id)
+		if entry is None:
+			entry = self.user_buckets[user_id] = [0, create_buckets(settings.ANTI_SPAM_USER_LIMITS)]
+		entry[0] += 1
+
+	def release(self):
+		"""
+		Should be called when connection is closed, so buckets of users that went away are freed
+		"""
+		if self.user_id is None:
+			return
+		entry = self.user_buckets[self.user_id]
+		entry[0] -= 1
+		if entry[0] == 0:
+			del self.user_buckets[self.user_id]
+		self.user_id = None
+
+	def check_size(self, json_message):
+		if len(json_message) > settings.MAX_MESSAGE_SIZE:
 			self.spammed += 1
 			raise ValidationError("Message can't exceed %d symbols" % settings.MAX_MESSAGE_SIZE)
-		self.check_timed_spam()
 
-	def check_timed_spam(self):
-		# TODO implement me
-		pass
-		# raise ValidationError("You're chatting too much, calm down a bit!")
\ No newline at end of file
+	def check_spam(self, action):
+		action_class = ACTION_CLASSES.get(action, OTHER_CLASS)
+		now = time.monotonic()
+		bucket = self.buckets.get(action_class)
+		if bucket is not None and not bucket.take(now):
+			self.spammed += 1
+			raise ValidationError("You're chatting too much, calm down a bit!")
+		if self.user_id is not None:
+			bucket = self.user_buckets[self.user_id][1].get(action_class)
+			if bucket is not None and not bucket.take(now):
+				self.spammed += 1
+				raise ValidationError("You're chatting too much, calm down a bit!")
@@ -49,6 +49,8 @@ class Actions(object):
 	DELETE_CHANNEL = 'deleteChannel'
 	LEAVE_CHANNEL = 'leaveChannel'
 	CREATE_NEW_USER = 'createNewUser'
+	GET_ONLINE = 'getOnline'
+	SET_PROTOCOL_KEYS = 'setProtocolKeys'
 
 
 class VarNames(object):
@@ -60,7 +62,9 @@ class VarNames(object):
 	TIME = 'time'
 	THREAD_ID = 'threadId'
 	CONTENT = 'content'
-	SEARCH_OFFSET = 'offset'
+	SEARCH_SENDER_ID = 'senderId'
+	SEARCH_FROM_TIME = 'fromTime'
+	SEARCH_TO_TIME = 'toTime'
 	SEARCH_STRING = 'searchString'
 	FILES = 'files'
 	FILE_URL = 'url'
@@ -86,6 +90,8 @@ class VarNames(object):
 	ROOM_IDS = 'roomIds'
 	PARENT_MESSAGE = 'parentMessage'
 	THREAD_MESSAGES_COUNT = 'threadMessagesCount'
+	THREAD_LAST_REPLY_ID = 'threadLastReplyId'
+	THREAD_LAST_REPLY_TIME = 'threadLastReplyTime'
 	ROOMS = 'rooms'
 	CHANNELS = 'channels'
 	ROOM_USERS = 'users'
@@ -93,13 +99,24 @@ class VarNames(object):
 	USER_IMAGE = 'userImage'
 	CB_BY_SENDER = 'cbBySender'
 	GET_MESSAGES_COUNT = 'count'
-	EXCLUDE_IDS = 'excludeIds'
+	BEFORE_ID = 'beforeId'
+	AFTER_ID = 'afterId'
+	CURSOR = 'cursor'
+	CURSORS = 'cursors'
+	HAS_MORE = 'hasMore'
+	TYPING_EXPIRE = 'expire'
 	IS_ROOM_PRIVATE = 'private'
 	CONNECTION_ID = 'connId'
 	HANDLER_NAME = 'handler'
 	GIPHY = 'giphy'
 	SYMBOL = 'symbol'
 	ONLINE = 'online'
+	ONLINE_VERSION = 'onlineVersion'
+	ONLINE_VERSIONS = 'onlineVersions'
+	USERS_VERSION = 'usersVersion'
+	USERS_FULL = 'usersFull'
+	PROTOCOL_KEYS = 'keys'
+	PROTOCOL_ACTIONS = 'actions'
 	TIME_DIFF = 'timeDiff'
 	EDITED_TIMES = 'edited'
 	PREVIEW = 'preview'
@@ -107,9 +124,6 @@ class VarNames(object):
 	P2P = 'p2p'
 	LAST_SYNCED = 'lastSynced'
 	MESSAGE_IDS = 'messagesIds'
-	ON_SERVER_MESSAGE_IDS = 'onServerMessageIds'
-	RECEIVED_MESSAGE_IDS = 'receivedMessageIds'
-	READ_MESSAGE_IDS = 'readMessageIds'
 	MESSAGE_STATUS = 'status'
 
 
@@ -163,7 +177,21 @@ class WebRtcRedisStates:
 class RedisPrefix:
 	USER_ID_CHANNEL_PREFIX = 'u'
 	PARSABLE_PREFIX = 'p'
-	ONLINE_VAR = 'online'
+	ONLINE_VAR = 'online_users'
+	ONLINE_CONNECTIONS_PREFIX = 'online_conn:'
+	ONLINE_VERSION_VAR = 'online_version'
+	ROOM_ONLINE_PREFIX = 'room_online:'
+	USER_DIRECTORY_VAR = 'user_dir'
+	USER_DIRECTORY_BASE_VAR = 'user_dir_base'
+	USER_DIRECTORY_VERSION_VAR = 'user_dir_version'
+	USER_DIRECTORY_CHANGES_VAR = 'user_dir_changes'
+	MESSAGE_DTO_PREFIX = 'message_dto:'
+	ROOM_RING_STATE_PREFIX = 'room_ring_state:'
+	ROOM_RING_IDS_PREFIX = 'room_ring_ids:'
+	ROOM_RING_DTOS_PREFIX = 'room_ring_dtos:'
+	ROOM_RING_VERSIONS_PREFIX = 'room_ring_versions:'
+	TYPING_PREFIX = 'typing:'
+	RATE_LIMIT_PREFIX = 'rate_limit:'
 	P2P_MESSAGE_VAR = 'p2p'
 	WEBRTC_CONNECTION = 'webrtc_conn'
 	CONNECTION_ID_LENGTH = 8  # should be secure
@@ -171,13 +199,17 @@ class RedisPrefix:
 	@classmethod
 	def set_js_user_structure_flag(cls, id, name, sex, image, flag, country, region, city):
 		res = cls.set_js_user_structure(id, name, sex, image)
-		res[VarNames.LOCATION] = {
+		res[VarNames.LOCATION] = cls.set_js_location_structure(flag, country, region, city)
+		return res
+
+	@staticmethod
+	def set_js_location_structure(flag, country, region, city):
+		return {
 			IpVarNames.COUNTRY_CODE: flag,
 			IpVarNames.COUNTRY: country,
 			IpVarNames.REGION: region,
 			IpVarNames.CITY: city
 		}
-		return res
 
 	@staticmethod
 	def set_js_user_structure(id, name, sex, image):
@@ -0,0 +1,74 @@
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import wraps
+
+from django.core.exceptions import ValidationError
+from django.db import close_old_connections
+from tornado.ioloop import IOLoop
+
+logger = logging.getLogger(__name__)
+
+thread_local = threading.local()
+
+
+class DbExecutor(object):
+	"""
+	Runs websocket actions that query database in a thread pool, so a slow query
+	doesn't freeze IOLoop. Actions of a single connection are still executed in order,
+	since TornadoHandler.on_message awaits the previous frame before reading the next one.
+	"""
+
+	def __init__(self, name, max_workers, max_queue_size):
+		self.name = name
+		self.executor = ThreadPoolExecutor(max_workers=max_workers)
+		self.max_queue_size = max_queue_size
+		# only modified from IOLoop thread, so no lock needed
+		self.queue_size = 0
+
+	def submit(self, fn, *args, **kwargs):
+		"""
+		:raises ValidationError: if too many actions are waiting for a thread
+		:return: concurrent.futures.Future that can be yielded in a coroutine
+		"""
+		if self.queue_size >= self.max_queue_size:
+			logger.warning("%s executor queue is full (%d), rejecting %s", self.name, self.queue_size, fn.__name__)
+			raise ValidationError("Server is too busy, please try again later")
+		self.queue_size += 1
+		io_loop = IOLoop.current()
+		future = self.executor.submit(self.run, io_loop, fn, *args, **kwargs)
+		io_loop.add_future(future, self.on_done)
+		return future
+
+	@staticmethod
+	def run(io_loop, fn, *args, **kwargs):
+		"""
+		Every worker thread keeps its own db connection, it's checked like django does around requests,
+		so the one that was closed by mysql wait_timeout is reopened instead of failing with "server has gone away"
+		"""
+		thread_local.io_loop = io_loop
+		close_old_connections()
+		try:
+			return fn(*args, **kwargs)
+		finally:
+			close_old_connections()
+			thread_local.io_loop = None
+
+	def on_done(self, future):
+		self.queue_size -= 1
+
+
+def on_io_loop(method):
+	"""
+	Marks methods that use websocket or tornadoredis, which are not thread safe.
+	If such method is called from DbExecutor thread, it's scheduled to IOLoop instead
+	and its result is dropped.
+	"""
+	@wraps(method)
+	def wrapper(*args, **kwargs):
+		io_loop = getattr(thread_local, 'io_loop', None)
+		if io_loop:
+			io_loop.add_callback(method, *args, **kwargs)
+		else:
+			return method(*args, **kwargs)
+	return wrapper
@@ -1,6 +1,5 @@
 # -*- encoding: utf-8 -*-
 import datetime
-import json
 import re
 from concurrent.futures import ThreadPoolExecutor
 
@@ -15,22 +14,23 @@ from django.db.utils import OperationalError
 from django.template.loader import render_to_string
 from django.utils.safestring import mark_safe
 from django.utils.timezone import utc
-from redis import ConnectionError
+from tornadoredis import ConnectionError
 from tornado import ioloop
 from tornado.concurrent import run_on_executor
 
 from chat import settings
 from chat import utils, global_redis
-from chat.global_redis import sync_redis
+from chat.global_redis import async_redis
 from chat.log_filters import id_generator
-from chat.models import Issue, IssueDetails, IpAddress, UserProfile, Verification, Message, Subscription, \
+from chat.models import Issue, IssueDetails, IpAddress, UserProfile, Verification, Subscription, \
 	SubscriptionMessages, RoomUsers, Room, UploadedFile, User
 from chat.settings_base import ALL_ROOM_ID
 from chat.socials import GoogleAuth, FacebookAuth
+from chat.tornado import json_codec
 from chat.tornado.constants import Actions, RedisPrefix, VarNames, HandlerNames
 from chat.tornado.message_creator import MessagesCreator
 from chat.tornado.method_dispatcher import MethodDispatcher, require_http_method, login_required_no_redirect, \
-	add_missing_fields, extract_nginx_files, check_captcha, get_user_id
+	add_missing_fields, extract_nginx_files, check_captcha, get_user_id, rate_limit
 from chat.utils import check_user, is_blank, get_or_create_ip_model, create_thumbnail
 
 SERVER_ADDRESS = getattr(settings, "SERVER_ADDRESS", None)
@@ -59,7 +59,7 @@ class HttpHandler(MethodDispatcher):
 
 	def __generate_session__(self, user_id):
 		session = id_generator(32)
-		sync_redis.hset('sessions', session, user_id)
+		yield async_redis.hset('sessions', session, user_id)
 		return session
 
 	def __get_user_by_code(self, token, type):
@@ -259,7 +259,7 @@ class HttpHandler(MethodDispatcher):
 		except OperationalError:
 			raise ValidationError("mysql is down")
 		try:
-			sync_redis.ping()
+			yield async_redis.ping()
 		except ConnectionError:
 			raise ValidationError("redis is down")
 		return settings.VALIDATION_IS_OK
@@ -268,12 +268,13 @@ class HttpHandler(MethodDispatcher):
 	@require_http_method('POST')
 	def logout(self, registration_id):
 		session_id = self.request.headers.get('session_id')
-		sync_redis.hdel('sessions', session_id)
+		yield async_redis.hdel('sessions', session_id)
 		if registration_id is not None:
 			Subscription.objects.filter(registration_id=registration_id).delete()
 		return settings.VALIDATION_IS_OK
 
 	@require_http_method('POST')
+	@rate_limit('username')
 	@check_captcha()
 	def auth(self, username, password):
 		"""
@@ -289,8 +290,10 @@ class HttpHandler(MethodDispatcher):
 		except User.DoesNotExist:
 			raise ValidationError("User {} doesn't exist".format(username))
 
-		return MessagesCreator.get_session(self.__generate_session__(user.id))
+		session = yield from self.__generate_session__(user.id)
+		return MessagesCreator.get_session(session)
 
+	@rate_limit('username')
 	@add_missing_fields('email', 'sex')
 	# @transaction.atomic TODO, is this works in single thread?
 	def register(self, username, password, email, sex):
@@ -302,6 +305,13 @@ class HttpHandler(MethodDispatcher):
 		user_profile.save()
 		RoomUsers(user_id=user_profile.id, room_id=settings.ALL_ROOM_ID, notifications=False).save()
 
+		user = RedisPrefix.set_js_user_structure(
+			user_profile.id,
+			user_profile.username,
+			user_profile.sex,
+			None
+		)
+		yield global_redis.user_directory.patch(user)
 		user_data = {
 			VarNames.ROOMS: [{
 				VarNames.ROOM_ID: settings.ALL_ROOM_ID,
@@ -310,20 +320,16 @@ class HttpHandler(MethodDispatcher):
 			VarNames.EVENT: Actions.CREATE_NEW_USER,
 			VarNames.HANDLER_NAME: HandlerNames.ROOM,
 		}
-		user_data.update(RedisPrefix.set_js_user_structure(
-			user_profile.id,
-			user_profile.username,
-			user_profile.sex,
-			None
-		))
+		user_data.update(user)
 		global_redis.async_redis_publisher.publish(
 			settings.ALL_ROOM_ID,
-			json.dumps(user_data),
+			json_codec.dumps(user_data),
 		)
 
 		if email:
 			yield from self.__send_sign_up_email(user_profile)
-		return MessagesCreator.get_session(self.__generate_session__(user_profile.id))
+		session = yield from self.__generate_session__(user_profile.id)
+		return MessagesCreator.get_session(session)
 
 	@require_http_method('GET')
 	def confirm_email(self, token):
@@ -349,12 +355,16 @@ class HttpHandler(MethodDispatcher):
 
 	@require_http_method('POST')
 	def google_auth(self, token):
-		return (yield self.__oauth(token, GoogleAuth(self.logger)))
+		return (yield from self.__oauth(token, GoogleAuth(self.logger)))
 
-	@run_on_executor
 	def __oauth(self, token, handler):
-		user_profile, is_new = handler.generate_user_profile(token)
-		return MessagesCreator.get_oauth_session(self.__generate_session__(user_profile.id), user_profile.username, is_new)
+		user_profile, is_new = yield self.__generate_user_profile(token, handler)
+		session = yield from self.__generate_session__(user_profile.id)
+		return MessagesCreator.get_oauth_session(session, user_profile.username, is_new)
+
+	@run_on_executor
+	def __generate_user_profile(self, token, handler):
+		return handler.generate_user_profile(token)
 
 	@run_on_executor
 	def __get_oauth_identifier(self, token, handler):
@@ -362,9 +372,10 @@ class HttpHandler(MethodDispatcher):
 
 	@require_http_method('POST')
 	def facebook_auth(self, token):
-		return (yield self.__oauth(token, FacebookAuth(self.logger)))
+		return (yield from self.__oauth(token, FacebookAuth(self.logger)))
 
 	@require_http_method('POST')
+	@rate_limit('username')
 	def validate_user(self, username):
 		"""
 		Validates user during registration
@@ -393,30 +404,40 @@ class HttpHandler(MethodDispatcher):
 	@require_http_method('GET')
 	# @transaction.atomic TODO, is this works in single thread?
 	def get_firebase_playback(self):
-		registration_id = self.request.headers('HTTP_AUTH')  # TODO FCM
+		"""
+		Payloads of the last push, one per room from the newest one. Messages that came to a room since
+		client received the previous push are collapsed into "N new messages" of that room
+		"""
+		registration_id = self.request.headers.get('auth')  # TODO FCM
 		self.logger.debug('Firebase playback, id %s', registration_id)
-		query_sub_message = SubscriptionMessages.objects.filter(
+		sub_messages = list(SubscriptionMessages.objects.filter(
 			subscription__registration_id=registration_id,
 			received=False
-		).order_by('-message__time')[:1]
-		sub_message = query_sub_message[0]
-		SubscriptionMessages.objects.filter(id=sub_message.id).update(received=True)
-		message = Message.objects.select_related("sender__username", "room__name").get(id=sub_message.message_id)
-		data = {
+		).select_related('message__sender', 'message__room').order_by('-message_id'))
+		if not sub_messages:
+			# e.g. client already fetched them after the previous push
+			return []
+		SubscriptionMessages.objects.filter(id__in=[sm.id for sm in sub_messages]).update(received=True)
+		# room_id -> [newest message, number of messages], ordered from the newest room
+		rooms = {}
+		for sm in sub_messages:
+			entry = rooms.setdefault(sm.message.room_id, [sm.message, 0])
+			entry[1] += sm.count
+		return [{
 			'title': message.sender.username,
 			'options': {
-				'body': message.content,
+				'body': message.content if count == 1 else '{} new messages'.format(count),
 				'icon': '/favicon.ico',
 				'data': {
-					'id': sub_message.message_id,
+					'id': message.id,
+					'count': count,
 					'sender': message.sender.username,
 					'room': message.room.name,
 					'roomId': message.room_id
 				},
 				'requireInteraction': True
 			},
-		}
-		return data
+		} for message, count in rooms.values()]
 
 	@login_required_no_redirect
 	def change_password(self, password, old_password):
@@ -529,6 +550,7 @@ class HttpHandler(MethodDispatcher):
 		return settings.VALIDATION_IS_OK
 
 	@require_http_method('POST')
+	@rate_limit('username_or_password')
 	@check_captcha()
 	def send_restore_password(self, username_or_password):
 		try:
@@ -557,6 +579,7 @@ class HttpHandler(MethodDispatcher):
 		return message
 
 	@require_http_method('POST')
+	@rate_limit('email')
 	def validate_email(self, email):
 		"""
 		POST only, validates email during registration
@@ -577,7 +600,7 @@ class HttpHandler(MethodDispatcher):
 	# @transaction.atomic TODO, is this works in single thread?
 	@require_http_method('POST')
 	def report_issue(self, issue, browser, version):
-		user_id = get_user_id(self.request)
+		user_id = yield from get_user_id(self.request)
 		issue_object = Issue.objects.get_or_create(content=issue)[0]
 		issue_details = IssueDetails(
 			sender_id=user_id,
@@ -607,20 +630,20 @@ class HttpHandler(MethodDispatcher):
 		create_thumbnail(input_file, up)
 		up.save(update_fields=('photo', 'thumbnail'))
 		up = UserProfile.objects.values('sex', 'thumbnail', 'photo', 'username').get(id=self.user_id)
+		user = RedisPrefix.set_js_user_structure(
+			self.user_id,
+			up['username'],
+			up['sex'],
+			"{0}{1}".format(settings.MEDIA_URL, up['thumbnail']) if up['thumbnail'] else None,
+		)
+		yield global_redis.user_directory.patch(user)
 		payload = {
 			VarNames.HANDLER_NAME: HandlerNames.WS,
 			VarNames.EVENT: Actions.USER_PROFILE_CHANGED
 		}
-		payload.update(
-			RedisPrefix.set_js_user_structure(
-				self.user_id,
-				up['username'],
-				up['sex'],
-				"{0}{1}".format(settings.MEDIA_URL, up['thumbnail']) if up['thumbnail'] else None,
-			)
-		)
-		global_redis.sync_redis.publish(settings.ALL_ROOM_ID, json.dumps(payload))
-		global_redis.sync_redis.publish( RedisPrefix.generate_user(self.user_id), json.dumps({
+		payload.update(user)
+		global_redis.async_redis_publisher.publish(settings.ALL_ROOM_ID, json_codec.dumps(payload))
+		global_redis.async_redis_publisher.publish(RedisPrefix.generate_user(self.user_id), json_codec.dumps({
 			VarNames.HANDLER_NAME: HandlerNames.WS,
 			VarNames.EVENT: Actions.SET_PROFILE_IMAGE,
 			VarNames.CONTENT: "{0}{1}".format(settings.MEDIA_URL, up['photo']) if up['photo'] else None,
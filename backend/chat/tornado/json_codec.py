@@ -0,0 +1,70 @@
+"""
+Json encoding of websocket frames, pubsub messages and http responses.
+Uses orjson or ujson if one is installed, stdlib json otherwise.
+Every backend returns str from dumps and accepts str or bytes in loads.
+"""
+import json
+import logging
+
+logger = logging.getLogger(__name__)
+
+try:
+	import orjson
+except ImportError:
+	orjson = None
+
+try:
+	import ujson
+except ImportError:
+	ujson = None
+
+
+def json_dumps(obj):
+	return json.dumps(obj)
+
+
+def json_loads(data):
+	return json.loads(data)
+
+
+def orjson_dumps(obj):
+	# online dicts are keyed by user ids, stdlib converts them to strings as well
+	return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS).decode('utf-8')
+
+
+def orjson_loads(data):
+	return orjson.loads(data)
+
+
+def ujson_dumps(obj):
+	return ujson.dumps(obj, escape_forward_slashes=False)
+
+
+def ujson_loads(data):
+	return ujson.loads(data)
+
+
+# name -> (dumps, loads) of installed backends
+BACKENDS = {'json': (json_dumps, json_loads)}
+if ujson:
+	BACKENDS['ujson'] = (ujson_dumps, ujson_loads)
+if orjson:
+	BACKENDS['orjson'] = (orjson_dumps, orjson_loads)
+
+if orjson:
+	BACKEND = 'orjson'
+elif ujson:
+	BACKEND = 'ujson'
+else:
+	BACKEND = 'json'
+
+dumps, loads = BACKENDS[BACKEND]
+logger.debug("Using %s for json", BACKEND)
+
+
+def dumps_with_list(obj, key, items):
+	"""
+	Like dumps, but obj[key] is set to a list of items that are already encoded json strings
+	"""
+	head = dumps(obj)[:-1]
+	return '{}{}{}:[{}]}}'.format(head, ',' if obj else '', dumps(key), ','.join(items))
@@ -0,0 +1,109 @@
+import logging
+import threading
+from collections import OrderedDict
+
+from chat.models import Message
+from chat.tornado import json_codec
+from chat.tornado.constants import RedisPrefix
+from chat.tornado.message_creator import MessagesCreator
+
+logger = logging.getLogger(__name__)
+
+# columns needed to get messages from cache, load querysets with .only(*CACHE_KEY_FIELDS)
+CACHE_KEY_FIELDS = ('id', 'updated_at', 'message_status')
+
+
+class MessageDtoCache(object):
+	"""
+	Json of message dtos, that MessagesCreator.message_models_to_dtos returns, with files and tags.
+	Stored in process LRU and in redis with ttl. Key contains updated_at and status,
+	so edits, deletes, new thread replies and status changes just produce a new key,
+	old entries are never purged and expire on their own.
+	Used from db executor threads, so it reads redis synchronously
+	"""
+
+	def __init__(self, sync_redis, size, ttl):
+		self.sync_redis = sync_redis
+		self.size = size
+		self.ttl = ttl
+		self.lru = OrderedDict()
+		self.lock = threading.Lock()
+
+	@staticmethod
+	def get_key(message):
+		return '{}:{}:{}'.format(message.id, message.updated_at, message.message_status)
+
+	def get_json(self, messages):
+		"""
+		:param messages: messages with CACHE_KEY_FIELDS loaded
+		:return: list of json strings of messages dtos in the same order
+		"""
+		return [value for message_id, value in self.get_json_with_ids(messages)]
+
+	def get_json_with_ids(self, messages):
+		"""
+		:return: list of (message_id, json) in the same order, messages that don't exist in db anymore are skipped
+		"""
+		keys = [self.get_key(message) for message in messages]
+		found = self.get_many(keys)
+		missing_ids = [message.id for message, key in zip(messages, keys) if key not in found]
+		fresh = {}
+		if missing_ids:
+			full_messages = list(Message.objects.filter(id__in=missing_ids))
+			encoded = {}
+			for message, dto in zip(full_messages, MessagesCreator.message_models_to_dtos(full_messages)):
+				# message could have been changed after keys were read, so it's matched by id
+				fresh[message.id] = encoded[self.get_key(message)] = json_codec.dumps(dto)
+			self.set_many(encoded)
+			logger.debug("Got %d messages from cache, %d from db", len(found), len(encoded))
+		res = []
+		for message, key in zip(messages, keys):
+			value = found.get(key) or fresh.get(message.id)
+			if value is not None:
+				res.append((message.id, value))
+		return res
+
+	def get_many(self, keys):
+		found = {}
+		with self.lock:
+			for key in keys:
+				value = self.lru.get(key)
+				if value is not None:
+					self.lru.move_to_end(key)
+					found[key] = value
+		missing = [key for key in keys if key not in found]
+		if missing:
+			from_redis = {}
+			values = self.sync_redis.mget([RedisPrefix.MESSAGE_DTO_PREFIX + key for key in missing])
+			for key, value in zip(missing, values):
+				if value is not None:
+					from_redis[key] = value.decode('utf-8')
+			self.remember(from_redis)
+			found.update(from_redis)
+		return found
+
+	def put(self, message, dto):
+		"""
+		Saves dto of message that was just created, so it doesn't have to be loaded from db
+		:return: json of dto
+		"""
+		value = json_codec.dumps(dto)
+		self.set_many({self.get_key(message): value})
+		return value
+
+	def set_many(self, values):
+		if not values:
+			return
+		self.remember(values)
+		pipe = self.sync_redis.pipeline(transaction=False)
+		for key, value in values.items():
+			pipe.setex(RedisPrefix.MESSAGE_DTO_PREFIX + key, self.ttl, value)
+		pipe.execute()
+
+	def remember(self, values):
+		with self.lock:
+			for key, value in values.items():
+				self.lru[key] = value
+				self.lru.move_to_end(key)
+			while len(self.lru) > self.size:
+				self.lru.popitem(last=False)
@@ -1,7 +1,7 @@
 from chat.models import get_milliseconds
 from chat.tornado.constants import VarNames, HandlerNames, Actions, RedisPrefix, UserSettingsVarNames, \
 	UserProfileVarNames
-from chat.utils import get_message_images_videos, get_message_tags
+from chat.utils import get_message_images_videos, get_message_tags, get_media_url
 
 
 class MessagesCreator(object):
@@ -22,10 +22,16 @@ class MessagesCreator(object):
 			VarNames.HANDLER_NAME: handler
 		}
 
-	def set_room(self, rooms, users, online, up, channels):
+	def set_room(self, rooms, users_version, users_full, online, online_versions, up, channels):
+		"""
+		VarNames.ROOM_USERS is not here, encoded users from UserDirectory are added with json_codec.dumps_with_list
+		:param users_full: False if users contains only users changed since version client has
+		"""
 		return {
-			VarNames.ROOM_USERS: users,
+			VarNames.USERS_VERSION: users_version,
+			VarNames.USERS_FULL: users_full,
 			VarNames.ONLINE: online,
+			VarNames.ONLINE_VERSIONS: online_versions,
 			VarNames.ROOMS: rooms,
 			VarNames.CHANNELS: channels,
 			VarNames.HANDLER_NAME: HandlerNames.WS,
@@ -47,15 +53,24 @@ class MessagesCreator(object):
 
 	@classmethod
 	def message_models_to_dtos(cls, messages):
-		imv = get_message_images_videos(messages)
-		tags = get_message_tags(messages)
-
-		def message_to_dto(message):
-			files = cls.prepare_img_video(imv, message.id)
-			prep_tags = cls.prepare_tags(tags, message.id)
-			return cls.create_message(message, files, prep_tags)
-
-		return list(map(message_to_dto, messages))
+		"""
+		Images and mentions of all messages are read with 2 queries, only the columns needed,
+		and grouped by message in one pass
+		:type messages: list[chat.models.Message]
+		"""
+		ids = [message.id for message in messages if message.symbol]
+		files = {}
+		for image in get_message_images_videos(ids):
+			files.setdefault(image['message_id'], {})[image['symbol']] = {
+				VarNames.FILE_URL: get_media_url(image['img']),
+				VarNames.FILE_TYPE: image['type'],
+				VarNames.PREVIEW: get_media_url(image['preview']) if image['preview'] else None,
+				VarNames.IMAGE_ID: image['id']
+			}
+		tags = {}
+		for message_id, symbol, user_id in get_message_tags(ids):
+			tags.setdefault(message_id, {})[symbol] = user_id
+		return [cls.create_message(message, files.get(message.id), tags.get(message.id, {})) for message in messages]
 
 	def set_user_profile(self, js_message_id,  message):
 		return  {
@@ -97,19 +112,24 @@ class MessagesCreator(object):
 			UserProfileVarNames.SURNAME: up.surname,
 		}
 
-	def room_online_logout(self, online):
+	def room_online_logout(self, connections, version):
 		"""
+		:param connections: ws ids of current user that are still opened
 		:return: {"action": event, "content": content, "time": "20:48:57"}
 		"""
-		room_less = self.default(online, Actions.LOGOUT, HandlerNames.ROOM)
+		room_less = self.default(connections, Actions.LOGOUT, HandlerNames.ROOM)
+		room_less[VarNames.WEBRTC_OPPONENT_ID] = self.id
+		room_less[VarNames.ONLINE_VERSION] = version
 		return room_less
 
-	def room_online_login(self, online):
+	def room_online_login(self, connections, version):
 		"""
+		:param connections: ws ids of current user including this one
 		:return: {"action": event, "content": content, "time": "20:48:57"}
 		"""
-		room_less = self.default(online, Actions.LOGIN, HandlerNames.ROOM)
+		room_less = self.default(connections, Actions.LOGIN, HandlerNames.ROOM)
 		room_less[VarNames.WEBRTC_OPPONENT_ID] = self.id
+		room_less[VarNames.ONLINE_VERSION] = version
 		return room_less
 
 	@classmethod
@@ -137,6 +157,9 @@ class MessagesCreator(object):
 			res[VarNames.SYMBOL] = message.symbol
 		if message.giphy:
 			res[VarNames.GIPHY] = message.giphy
+		if message.thread_last_reply_id:
+			res[VarNames.THREAD_LAST_REPLY_ID] = message.thread_last_reply_id
+			res[VarNames.THREAD_LAST_REPLY_TIME] = message.thread_last_reply_time
 		return res
 
 	def create_send_message(self, message, event, files, tags_users):
@@ -176,14 +199,6 @@ class MessagesCreator(object):
 			VarNames.HANDLER_NAME: HandlerNames.WS,
 		}
 
-	@staticmethod
-	def prepare_tags(tags, message_id):
-		"""
-		:type message_id: int
-		:type files: list[chat.models.Image]
-		"""
-		return {tag.symbol: tag.user_id for tag in tags if tag.message_id == message_id}
-
 	@staticmethod
 	def prepare_img_video(files, message_id):
 		"""
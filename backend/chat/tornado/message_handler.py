@@ -6,23 +6,24 @@ from django.conf import settings
 from django.core.exceptions import ValidationError
 from django.db.models import Q, Max
 from tornado import gen
-from tornado.gen import Task
-from tornado.httpclient import HTTPRequest
 from tornado.ioloop import IOLoop
-from tornadoredis import Client
 
-from chat.global_redis import remove_parsable_prefix, encode_message
+from chat.global_redis import encode_message
 from chat.log_filters import id_generator
-from chat.models import Message, Room, RoomUsers, Subscription, SubscriptionMessages, MessageHistory, \
+from chat.models import Message, Room, RoomUsers, MessageHistory, \
 	UploadedFile, Image, get_milliseconds, UserProfile, Channel, User, MessageMention
-from chat.py2_3 import str_type, quote
-from chat.settings import ALL_ROOM_ID, REDIS_PORT, GIPHY_URL, GIPHY_REGEX, FIREBASE_URL, REDIS_HOST, \
-	REDIS_DB
+from chat.py2_3 import quote
+from chat.settings import ALL_ROOM_ID, GIPHY_URL, GIPHY_REGEX
 from chat.tornado.constants import VarNames, HandlerNames, Actions, RedisPrefix, WebRtcRedisStates, \
 	UserSettingsVarNames, UserProfileVarNames
+from chat.tornado import message_search, json_codec
+from chat.tornado.message_cache import CACHE_KEY_FIELDS
+from chat.tornado.message_status import MessageStatusAggregator
+from chat.tornado.push_notifications import PushNotifier
+from chat.tornado.db_executor import DbExecutor, on_io_loop
 from chat.tornado.message_creator import WebRtcMessageCreator, MessagesCreator
 from chat.utils import get_max_symbol, validate_edit_message, update_symbols, up_files_to_img, evaluate, check_user, \
-	http_client, get_max_symbol_dict, max_from_2
+	http_client, get_max_symbol_dict, max_from_2, decode_cursor, paginate_by_id, encode_cursor, get_int
 
 # from pywebpush import webpush
 
@@ -32,17 +33,18 @@ base_logger = logging.LoggerAdapter(parent_logger, {
 	'ip': '000.000.000.000'
 })
 
-# TODO https://github.com/leporo/tornado-redis#connection-pool-support
-# CONNECTION_POOL = tornadoredis.ConnectionPool(
-# max_connections=500,
-# wait_for_available=True)
-
 GIPHY_API_KEY = getattr(settings, "GIPHY_API_KEY", None)
-FIREBASE_API_KEY = getattr(settings, "FIREBASE_API_KEY", None)
 
 
 class MessagesHandler():
 
+	# actions that query database are executed in threads, heavy reads have their own pool
+	# so they don't add latency to sending messages
+	db_executor = DbExecutor('db', settings.WS_DB_THREAD_WORKERS, settings.WS_DB_MAX_QUEUE_SIZE)
+	heavy_db_executor = DbExecutor('heavy_db', settings.WS_DB_HEAVY_THREAD_WORKERS, settings.WS_DB_HEAVY_MAX_QUEUE_SIZE)
+	status_aggregator = MessageStatusAggregator(db_executor, settings.WS_MESSAGE_STATUS_DELAY)
+	push_notifier = PushNotifier(db_executor)
+
 	def __init__(self, *args, **kwargs):
 		self.closed_channels = None
 		self.message_creator = WebRtcMessageCreator(None, None)
@@ -50,15 +52,19 @@ class MessagesHandler():
 		self.webrtc_ids = {}
 		self.id = None  # child init
 		self.last_client_ping = 0
+		self.last_typing = {}  # room_id -> milliseconds showIType was published
 		self.user_id = 0  # anonymous by default
 		self.ip = None
 		from chat import global_redis
 		self.async_redis_publisher = global_redis.async_redis_publisher
-		self.sync_redis = global_redis.sync_redis
+		self.async_redis = global_redis.async_redis
+		self.pubsub = global_redis.pubsub
+		self.presence = global_redis.presence
+		self.user_directory = global_redis.user_directory
+		self.message_cache = global_redis.message_cache
+		self.room_ring = global_redis.room_ring
 		self.channels = []
 		self._logger = None
-		self.async_redis = Client(host=REDIS_HOST, port=REDIS_PORT, selected_db=REDIS_DB)
-		self.patch_tornadoredis()
 		# input websocket messages handlers
 		# The handler is determined by @VarNames.EVENT
 		self.process_ws_message = {
@@ -67,7 +73,7 @@ class MessagesHandler():
 			Actions.PRINT_MESSAGE: self.process_send_message,
 			Actions.DELETE_ROOM: self.delete_room,
 			Actions.USER_LEAVES_ROOM: self.leave_room,
-			Actions.EDIT_MESSAGE: self.edit_message,
+			Actions.EDIT_MESSAGE: self.process_edit_message,
 			Actions.CREATE_ROOM: self.create_new_room,
 			Actions.CREATE_CHANNEL: self.create_new_channel,
 			Actions.SAVE_CHANNEL_SETTINGS: self.save_channels_settings,
@@ -83,6 +89,25 @@ class MessagesHandler():
 			Actions.SYNC_HISTORY: self.sync_history,
 			Actions.SHOW_I_TYPE: self.show_i_type,
 			Actions.SET_MESSAGE_STATUS: self.set_message_status,
+			Actions.GET_ONLINE: self.get_online,
+		}
+		# Executors for @process_ws_message handlers, others are executed on IOLoop
+		self.ws_message_executors = {
+			Actions.GET_MESSAGES: self.heavy_db_executor,
+			Actions.GET_MESSAGES_BY_IDS: self.heavy_db_executor,
+			Actions.SEARCH_MESSAGES: self.heavy_db_executor,
+			Actions.SYNC_HISTORY: self.heavy_db_executor,
+			Actions.DELETE_ROOM: self.db_executor,
+			Actions.USER_LEAVES_ROOM: self.db_executor,
+			Actions.CREATE_ROOM: self.db_executor,
+			Actions.CREATE_CHANNEL: self.db_executor,
+			Actions.SAVE_CHANNEL_SETTINGS: self.db_executor,
+			Actions.SAVE_ROOM_SETTINGS: self.db_executor,
+			Actions.DELETE_CHANNEL: self.db_executor,
+			Actions.LEAVE_CHANNEL: self.db_executor,
+			Actions.SET_USER_PROFILE: self.db_executor,
+			Actions.SET_SETTINGS: self.db_executor,
+			Actions.INVITE_USER: self.db_executor,
 		}
 		# Handlers for redis messages, if handler returns true - message won't be sent to client
 		# The handler is determined by @VarNames.EVENT
@@ -98,34 +123,20 @@ class MessagesHandler():
 			Actions.PING: self.process_ping_message,
 		}
 
-	def patch_tornadoredis(self):  # TODO remove this
-		fabric = type(self.async_redis.connection.readline)
-		self.async_redis.connection.old_read = self.async_redis.connection.readline
-
-		def new_read(new_self, callback=None):
-			try:
-				return new_self.old_read(callback=callback)
-			except Exception as e:
-				return
-				current_online = self.get_online_from_redis()
-				self.logger.error(e)
-				self.logger.error(
-					"Exception info: "
-					"self.id: %s ;;; "
-					"self.connected = '%s';;; "
-					"Redis default channel online = '%s';;; "
-					"self.channels = '%s';;; "
-					"self.closed_channels  = '%s';;;",
-					self.id, self.connected, current_online, self.channels, self.closed_channels
-				)
-				raise e
-
-		self.async_redis.connection.readline = fabric(new_read, self.async_redis.connection)
-
 	@property
 	def channel(self):
 		return RedisPrefix.generate_user(self.user_id)
 
+	def execute_ws_message(self, message):
+		"""
+		:return: future if handler is a coroutine or runs in executor, otherwise None
+		"""
+		action = message[VarNames.EVENT]
+		executor = self.ws_message_executors.get(action)
+		if executor:
+			return executor.submit(self.process_ws_message[action], message)
+		return self.process_ws_message[action](message)
+
 	@property
 	def connected(self):
 		raise NotImplemented
@@ -134,208 +145,168 @@ class MessagesHandler():
 	def connected(self, value):
 		raise NotImplemented
 
-	@gen.engine
 	def listen(self, channels):
-		yield Task(
-			self.async_redis.subscribe, channels)
-		self.async_redis.listen(self.on_pub_sub_message)
+		self.pubsub.subscribe(channels, self)
 
 	@property
 	def logger(self):
 		return self._logger if self._logger else base_logger
 
-	@gen.engine
 	def add_channel(self, channel):
 		self.channels.append(channel)
-		yield Task(self.async_redis.subscribe, (channel,))
-
-	def get_online_from_redis(self):
-		return self.get_online_and_status_from_redis()[1]
-
-	def get_dict_users_from_redis(self):
-		online = self.sync_redis.ssmembers(RedisPrefix.ONLINE_VAR)
-		self.logger.debug('!! redis online: %s', online)
-		result = self.parse_redis_online_into_dict_set(online) if online else {}
-		return result
+		self.pubsub.subscribe((channel,), self)
 
-	@staticmethod
-	def parse_redis_online_into_dict_set(online):
+	@property
+	def room_ids(self):
 		"""
-		:rtype : Dict[int, set]
+		self.channels also contains user channel and ws id, which are strings
 		"""
-		result = {}
-		for decoded in online:  # py2 iteritems
-			user_id = decoded.split(':')[0]
-			result.setdefault(int(user_id), []).append(decoded)
-		return result
+		return [channel for channel in self.channels if isinstance(channel, int)]
+
+	def get_room_members(self):
+		return set(RoomUsers.objects.filter(room_id__in=self.room_ids).values_list('user_id', flat=True))
 
-	def get_online_and_status_from_redis(self):
+	def publish_online_change(self, message):
 		"""
-		:rtype : (bool, list)
+		Only users that share a room with current one are interested in their online.
+		User can be in a few rooms with the same person, so client drops duplicates by VarNames.ONLINE_VERSION
 		"""
-		online = self.sync_redis.ssmembers(RedisPrefix.ONLINE_VAR)
-		self.logger.debug('!! redis online: %s', online)
-		return self.parse_redis_online(online) if online else (False, [])
+		jsoned_mess = encode_message(message, False)
+		for room_id in self.room_ids:
+			self.raw_publish(jsoned_mess, room_id)
 
-	def parse_redis_online(self, online):
+	@gen.coroutine
+	def get_online(self, in_message):
 		"""
-		:rtype : (bool, list)
+		Full online of users sharing a room with current one.
+		Client asks for it when it detects that some online events were missed
 		"""
-		result = set()
-		user_is_online = False
-		for decoded in online:  # py2 iteritems
-			user_id = int(decoded.split(':')[0])
-			if user_id == self.user_id and decoded != self.id:
-				user_is_online = True
-			result.add(user_id)
-		return user_is_online, list(result)
+		user_ids = yield self.db_executor.submit(self.get_room_members)
+		online, versions = yield self.presence.get_connections(user_ids)
+		self.ws_write({
+			VarNames.CONTENT: online,
+			VarNames.ONLINE_VERSIONS: versions,
+			VarNames.JS_MESSAGE_ID: in_message[VarNames.JS_MESSAGE_ID],
+			VarNames.HANDLER_NAME: HandlerNames.NULL
+		})
 
 	def publish(self, message, channel, parsable=False):
 		jsoned_mess = encode_message(message, parsable)
 		self.raw_publish(jsoned_mess, channel)
 
+	@on_io_loop
 	def raw_publish(self, jsoned_mess, channel):
 		self.logger.debug('<%s> %s', channel, jsoned_mess)
 		self.async_redis_publisher.publish(channel, jsoned_mess)
 
-	def on_pub_sub_message(self, message):
+	def on_pub_sub_message(self, frame):
 		"""
 		All pubsub messages are automatically sent to client.
-		:param message:
-		:return:
+		:type frame: chat.tornado.pubsub.PubSubFrame
+		frame.parsed is a dict decoded by PubSubMultiplexer or None if message isn't parsable.
+		It's shared between all websockets of the process, so it should never be modified
 		"""
-		data = message.body
-		if isinstance(data, str_type):  # not subscribe event
-			prefixless_str = remove_parsable_prefix(data)
-			if prefixless_str:
-				dict_message = json.loads(prefixless_str)
-				res = self.process_pubsub_message[dict_message[VarNames.EVENT]](dict_message)
-				if not res:
-					self.ws_write(prefixless_str)
-			else:
-				self.ws_write(data)
+		if frame.parsed is not None:
+			res = self.process_pubsub_message[frame.parsed[VarNames.EVENT]](frame.parsed)
+			if res:
+				return
+		self.ws_write_frame(frame)
 
 	def ws_write(self, message):
 		raise NotImplementedError('WebSocketHandler implements')
 
-	def search_giphy(self, message, query, cb):
+	def ws_write_frame(self, frame):
+		raise NotImplementedError('WebSocketHandler implements')
+
+	@gen.coroutine
+	def search_giphy(self, query):
+		"""
+		:return: url of the gif or None if giphy didn't find anything or is unavailable
+		"""
 		self.logger.debug("!! Asking giphy for: %s", query)
-		def on_giphy_reply(response):
-			try:
-				self.logger.debug("!! Got giphy response: " + str(response.body))
-				res =  json.loads(response.body)
-				giphy = res['data'][0]['images']['downsized_medium']['url']
-			except:
-				giphy = None
-			cb(message, giphy)
 		url = GIPHY_URL.format(GIPHY_API_KEY, quote(query, safe=''))
-		http_client.fetch(url, callback=on_giphy_reply)
-
+		response = yield http_client.fetch(url, raise_error=False)
+		try:
+			self.logger.debug("!! Got giphy response: " + str(response.body))
+			res =  json.loads(response.body)
+			return res['data'][0]['images']['downsized_medium']['url']
+		except:
+			return None
+
+	@on_io_loop
 	def notify_offline(self, channel, message_id):
-		if FIREBASE_API_KEY is None:
-			return
-		online = self.get_online_from_redis()
-		if channel == ALL_ROOM_ID:
-			return
-		offline_users = RoomUsers.objects.filter(room_id=channel, notifications=True).exclude(user_id__in=online).values_list('user_id')
-		subscriptions = Subscription.objects.filter(user__in=offline_users, inactive=False)
-		if len(subscriptions) == 0:
-			return
-		new_sub_mess =[SubscriptionMessages(message_id=message_id, subscription_id=r.id) for r in subscriptions]
-		reg_ids =[r.registration_id for r in subscriptions]
-		SubscriptionMessages.objects.bulk_create(new_sub_mess)
-		self.post_firebase(list(reg_ids))
-
-	def post_firebase(self, reg_ids):
-		def on_reply(response):
-			try:
-				self.logger.debug("!! FireBase response: " + str(response.body))
-				response_obj = json.loads(response.body)
-				delete = []
-				for index, elem in enumerate(response_obj['results']):
-					if elem.get('error') in ['NotRegistered', 'InvalidRegistration']:
-						delete.append(reg_ids[index])
-				if len(delete) > 0:
-					self.logger.info("Deactivating subscriptions: %s", delete)
-					Subscription.objects.filter(registration_id__in=delete).update(inactive=True)
-			except Exception as e:
-				self.logger.error("Unable to parse response" + str(e))
-				pass
-
-		headers = {"Content-Type": "application/json", "Authorization": "key=%s" % FIREBASE_API_KEY}
-		body = json.dumps({"registration_ids": reg_ids})
-		self.logger.debug("!! post_fire_message %s", body)
-
-		# TODO
-		# webpush(subscription_info,
-		# 		  data,
-		# 		  vapid_private_key="Private Key or File Path[1]",
-		# 		  vapid_claims={"sub": "mailto:YourEmailAddress"})
-
-		r = HTTPRequest(FIREBASE_URL, method="POST", headers=headers, body=body)
-		http_client.fetch(r, callback=on_reply)
+		if channel != ALL_ROOM_ID:
+			self.push_notifier.add(channel, message_id)
 
 	def isGiphy(self, content):
 		if GIPHY_API_KEY is not None and content is not None:
 			giphy_match = re.search(GIPHY_REGEX, content)
 			return giphy_match.group(1) if giphy_match is not None else None
 
+	@gen.coroutine
 	def process_send_message(self, message):
 		"""
+		Giphy is fetched on IOLoop, the message is saved after it, both are awaited by on_message,
+		so messages of a connection keep their order and errors are replied to the client
 		:type message: dict
 		"""
-		content = message.get(VarNames.CONTENT)
-		giphy_match = self.isGiphy(content)
-
-		# @transaction.atomic mysql has gone away
-		def send_message(message, giphy=None):
-			if message[VarNames.TIME_DIFF] < 0:
-				raise ValidationError("Back to the future?")
-			tags_users = message[VarNames.MESSAGE_TAGS]
-			files = UploadedFile.objects.filter(id__in=message.get(VarNames.FILES), user_id=self.user_id)
-			symbol = max_from_2(get_max_symbol(files), get_max_symbol_dict(tags_users))
-			channel = message[VarNames.ROOM_ID]
-			js_id = message[VarNames.JS_MESSAGE_ID]
-			parent_message_id = message[VarNames.PARENT_MESSAGE]
-			if parent_message_id:
-				parent_room_id = Message.objects.get(id=parent_message_id).room_id
-				if parent_room_id not in self.channels:
-					raise ValidationError("You don't have access to this room message")
-			message_db = Message(
-				sender_id=self.user_id,
-				content=message[VarNames.CONTENT],
-				symbol=symbol,
-				parent_message_id=parent_message_id,
-				giphy=giphy,
-				room_id=channel
-			)
-			message_db.time -= message[VarNames.TIME_DIFF]
-			res_files = []
-			message_db.save()
-
-			if tags_users:
-				mes_ment = [MessageMention(
-					user_id=userId,
-					message_id=message_db.id,
-					symbol=symb,
-				) for symb, userId in tags_users.items()]
-				MessageMention.objects.bulk_create(mes_ment)
-			if files:
-				images = up_files_to_img(files, message_db.id)
-				res_files = MessagesCreator.prepare_img_video(images, message_db.id)
-			prepared_message = self.message_creator.create_send_message(
-				message_db,
-				Actions.PRINT_MESSAGE,
-				res_files,
-				tags_users
-			)
-			prepared_message[VarNames.JS_MESSAGE_ID] = js_id
-			self.publish(prepared_message, channel)
-			self.notify_offline(channel, message_db.id)
+		giphy = None
+		giphy_match = self.isGiphy(message.get(VarNames.CONTENT))
 		if giphy_match is not None:
-			self.search_giphy(message, giphy_match, send_message)
+			giphy = yield self.search_giphy(giphy_match)
+		yield self.db_executor.submit(self.send_message, message, giphy)
+
+	# @transaction.atomic mysql has gone away
+	def send_message(self, message, giphy=None):
+		if message[VarNames.TIME_DIFF] < 0:
+			raise ValidationError("Back to the future?")
+		tags_users = message[VarNames.MESSAGE_TAGS]
+		files = UploadedFile.objects.filter(id__in=message.get(VarNames.FILES), user_id=self.user_id)
+		symbol = max_from_2(get_max_symbol(files), get_max_symbol_dict(tags_users))
+		channel = message[VarNames.ROOM_ID]
+		js_id = message[VarNames.JS_MESSAGE_ID]
+		parent_message_id = message[VarNames.PARENT_MESSAGE]
+		if parent_message_id:
+			parent_room_id = Message.objects.get(id=parent_message_id).room_id
+			if parent_room_id not in self.channels:
+				raise ValidationError("You don't have access to this room message")
+		message_db = Message(
+			sender_id=self.user_id,
+			content=message[VarNames.CONTENT],
+			symbol=symbol,
+			parent_message_id=parent_message_id,
+			giphy=giphy,
+			room_id=channel
+		)
+		message_db.time -= message[VarNames.TIME_DIFF]
+		res_files = []
+		message_db.save()
+		message_search.index_message(message_db.id, channel, message_db.content, created=True)
+
+		if tags_users:
+			mes_ment = [MessageMention(
+				user_id=userId,
+				message_id=message_db.id,
+				symbol=symb,
+			) for symb, userId in tags_users.items()]
+			MessageMention.objects.bulk_create(mes_ment)
+		if files:
+			images = up_files_to_img(files, message_db.id)
+			res_files = MessagesCreator.prepare_img_video(images, message_db.id)
+		message_json = self.message_cache.put(message_db, MessagesCreator.create_message(message_db, res_files, tags_users))
+		if parent_message_id:
+			self.room_ring.refresh(channel, [parent_message_id])
 		else:
-			send_message(message)
+			self.room_ring.add(channel, message_db, message_json)
+		prepared_message = self.message_creator.create_send_message(
+			message_db,
+			Actions.PRINT_MESSAGE,
+			res_files,
+			tags_users
+		)
+		prepared_message[VarNames.JS_MESSAGE_ID] = js_id
+		self.publish(prepared_message, channel)
+		self.notify_offline(channel, message_db.id)
 
 	def save_channels_settings(self, message):
 		channel_id = message[VarNames.CHANNEL_ID]
@@ -635,20 +606,24 @@ class MessagesHandler():
 		)
 		self.publish(self.message_creator.set_user_profile(in_message[VarNames.JS_MESSAGE_ID], message), self.channel)
 		if userprofile.sex_str != sex or userprofile.username != un:
+			user = RedisPrefix.set_js_user_structure(
+				self.user_id,
+				un,
+				settings.GENDERS_STR[sex],
+				userprofile.thumbnail.url if userprofile.thumbnail else None,
+			)
+			self.patch_user_directory(user)
 			payload = {
 				VarNames.HANDLER_NAME: HandlerNames.WS,
 				VarNames.EVENT: Actions.USER_PROFILE_CHANGED
 			}
-			payload.update(
-				RedisPrefix.set_js_user_structure(
-					self.user_id,
-					un,
-					settings.GENDERS_STR[sex],
-					userprofile.thumbnail.url if userprofile.thumbnail else None,
-				)
-			)
+			payload.update(user)
 			self.publish(payload, settings.ALL_ROOM_ID)
 
+	@on_io_loop
+	def patch_user_directory(self, user):
+		return self.user_directory.patch(user)
+
 	def invite_user(self, message):
 		room_id = message[VarNames.ROOM_ID]
 		if room_id not in self.channels:
@@ -797,37 +772,48 @@ class MessagesHandler():
 	def delete_room(self, message):
 		self.do_room_action(message[VarNames.ROOM_ID], message[VarNames.JS_MESSAGE_ID], Actions.DELETE_ROOM)
 
-	def edit_message(self, data):
+	@gen.coroutine
+	def process_edit_message(self, data):
+		"""
+		Same as process_send_message, giphy is fetched before the edit is saved
+		"""
+		giphy = None
+		giphy_match = self.isGiphy(data[VarNames.CONTENT])
+		if giphy_match is not None:
+			giphy = yield self.search_giphy(giphy_match)
+		yield self.db_executor.submit(self.edit_message, data, giphy_match, giphy)
+
+	def edit_message(self, data, giphy_match, giphy):
 		message = Message.objects.get(id=data[VarNames.MESSAGE_ID])
 		validate_edit_message(self.user_id, message)
 		message.content = data[VarNames.CONTENT]
 		MessageHistory(message=message, content=message.content, giphy=message.giphy).save()
 
-		giphy_match = self.isGiphy(data[VarNames.CONTENT])
 		if message.content is None:
 			Message.objects.filter(id=data[VarNames.MESSAGE_ID]).update(
 				deleted=True,
 				updated_at=get_milliseconds(),
 				content=None
 			)
+			message_search.index_message(message.id, message.room_id, None)
+			self.room_ring.refresh(message.room_id, [message.id])
 			self.publish(self.message_creator.create_send_message(message, Actions.DELETE_MESSAGE, None, {}), message.room_id)
 		elif giphy_match is not None:
-			self.edit_message_giphy(giphy_match, message)
+			self.edit_message_giphy(message, giphy)
 		else:
 			self.edit_message_edit(data, message)
 
-	def edit_message_giphy(self, giphy_match, message):
-		def edit_glyphy(message, giphy):
-			Message.objects.filter(id=message.id).update(
-				content=message.content,
-				symbol=message.symbol,
-				giphy=giphy,
-				updated_at=get_milliseconds()
-			)
-			message.giphy = giphy
-			self.publish(self.message_creator.create_send_message(message, Actions.EDIT_MESSAGE, None, {}), message.room_id)
-
-		self.search_giphy(message, giphy_match, edit_glyphy)
+	def edit_message_giphy(self, message, giphy):
+		Message.objects.filter(id=message.id).update(
+			content=message.content,
+			symbol=message.symbol,
+			giphy=giphy,
+			updated_at=get_milliseconds()
+		)
+		message_search.index_message(message.id, message.room_id, message.content)
+		self.room_ring.refresh(message.room_id, [message.id])
+		message.giphy = giphy
+		self.publish(self.message_creator.create_send_message(message, Actions.EDIT_MESSAGE, None, {}), message.room_id)
 
 	def edit_message_edit(self, data, message):
 		action = Actions.EDIT_MESSAGE
@@ -861,17 +847,21 @@ class MessagesHandler():
 		else:
 			prep_files = None
 		Message.objects.filter(id=message.id).update(content=message.content, symbol=message.symbol, giphy=None, updated_at=get_milliseconds())
+		message_search.index_message(message.id, message.room_id, message.content)
+		self.room_ring.refresh(message.room_id, [message.id])
 		self.publish(self.message_creator.create_send_message(message, action, prep_files, tags), message.room_id)
 
 	def send_client_new_channel(self, message):
 		room_id = message[VarNames.ROOM_ID]
 		self.add_channel(room_id)
+		self.presence.join_room(self.user_id, room_id)
 
 	def send_client_delete_group(self, message):
 		channel_id = message[VarNames.CHANNEL_ID]
 		room_ids = message[VarNames.ROOM_IDS]
-		self.async_redis.unsubscribe(room_ids)
+		self.pubsub.unsubscribe(room_ids, self)
 		self.channels = [x for x in self.channels if x not in room_ids]
+		self.presence.leave_rooms(self.user_id, room_ids)
 		channels = {
 			VarNames.EVENT: Actions.DELETE_CHANNEL,
 			VarNames.ROOM_IDS: room_ids,
@@ -913,8 +903,9 @@ class MessagesHandler():
 
 	def send_client_delete_room(self, message):
 		room_id = message[VarNames.ROOM_ID]
-		self.async_redis.unsubscribe((room_id,))
+		self.pubsub.unsubscribe((room_id,), self)
 		self.channels.remove(room_id)
+		self.presence.leave_rooms(self.user_id, (room_id,))
 		channels = {
 			VarNames.EVENT: Actions.DELETE_ROOM,
 			VarNames.ROOM_ID: room_id,
@@ -930,131 +921,163 @@ class MessagesHandler():
 		"""
 		ids = data[VarNames.MESSAGE_IDS]
 		room_id = data[VarNames.ROOM_ID]
-		messages = Message.objects.filter(room_id=room_id, id__in=ids)
-		response = self.message_creator.get_messages(messages, data[VarNames.JS_MESSAGE_ID])
-		self.ws_write(response)
+		messages = Message.objects.filter(room_id=room_id, id__in=ids).only(*CACHE_KEY_FIELDS)
+		self.ws_write_messages(messages, {
+			VarNames.JS_MESSAGE_ID: data[VarNames.JS_MESSAGE_ID],
+			VarNames.HANDLER_NAME: HandlerNames.NULL
+		})
 
 	def process_get_messages(self, data):
 		"""
 		:type data: dict
 		"""
-		exclude_ids = data[VarNames.EXCLUDE_IDS]
-		# this method needs to accept ids of message, because messages on the client can be not-ordered
-		# lets say we loaded a message for a thread , so it's single
-		# or someone joined from offline and he synced message in the top.
-		thread_id = data[VarNames.THREAD_ID]
+		# messages on the client can be not-ordered, lets say we loaded a message for a thread, so it's single
+		# so client passes cursor from previous page, or an id it wants messages before/after.
+		# Pages go from newest to oldest, afterId=0 loads from the oldest message, e.g. the start of a thread
+		thread_id = get_int(data, VarNames.THREAD_ID)
 		room_id = data[VarNames.ROOM_ID]
-		if thread_id:
-			messages = Message.objects.filter(room_id=room_id, parent_message__id=thread_id)
+		count = get_int(data, VarNames.GET_MESSAGES_COUNT, 10)
+		if count > 100:
+			raise ValidationError("Can't load that many messages")
+		if data.get(VarNames.CURSOR):
+			before_id, after_id = decode_cursor(data[VarNames.CURSOR])
 		else:
-			count = int(data.get(VarNames.GET_MESSAGES_COUNT, 10))
-			if count > 100:
-				raise ValidationError("Can't load that many messages")
-			messages = Message.objects.filter(
-				Q(room_id=room_id) & Q(parent_message__id=thread_id) & ~Q(id__in=exclude_ids)
-			).order_by('-pk')[:count]
-
-		response = self.message_creator.get_messages(messages, data[VarNames.JS_MESSAGE_ID])
-		self.ws_write(response)
+			before_id, after_id = get_int(data, VarNames.BEFORE_ID), get_int(data, VarNames.AFTER_ID)
+		if thread_id is None and before_id is None and after_id is None:
+			# the first page is the most requested one, it's kept in redis.
+			# Ring returns a short page only when the room has no older messages, otherwise it's read from db
+			page = self.room_ring.get(room_id, count)
+			if page is not None:
+				self.ws_write(json_codec.dumps_with_list({
+					VarNames.CURSOR: encode_cursor(before_id=page[-1][0]) if len(page) == count else None,
+					VarNames.JS_MESSAGE_ID: data[VarNames.JS_MESSAGE_ID],
+					VarNames.HANDLER_NAME: HandlerNames.NULL
+				}, VarNames.CONTENT, [message_json for message_id, message_json in page]))
+				return
+		# thread_id None means messages of the room that are not in threads
+		messages, cursor = paginate_by_id(
+			Message.objects.filter(room_id=room_id, parent_message_id=thread_id).only(*CACHE_KEY_FIELDS),
+			count,
+			before_id,
+			after_id
+		)
+		self.ws_write_messages(messages, {
+			VarNames.CURSOR: cursor,
+			VarNames.JS_MESSAGE_ID: data[VarNames.JS_MESSAGE_ID],
+			VarNames.HANDLER_NAME: HandlerNames.NULL
+		})
 
 	def search_messages(self, data):
-		offset = data[VarNames.SEARCH_OFFSET] #// room, offset
-		messages = Message.objects.filter(
-			content__icontains=data[VarNames.SEARCH_STRING],
-			room_id=data[VarNames.ROOM_ID] # access permissions is already checked on top level by ROOM_ID
-		).order_by('-id')[offset:offset + settings.MESSAGES_PER_SEARCH]
+		if not isinstance(data.get(VarNames.SEARCH_STRING), str):
+			raise ValidationError("Search string is missing")
+		messages = message_search.search(
+			data[VarNames.ROOM_ID],  # access permissions is already checked on top level by ROOM_ID
+			data[VarNames.SEARCH_STRING],
+			settings.MESSAGES_PER_SEARCH,
+			before_id=get_int(data, VarNames.BEFORE_ID),
+			sender_id=get_int(data, VarNames.SEARCH_SENDER_ID),
+			from_time=get_int(data, VarNames.SEARCH_FROM_TIME),
+			to_time=get_int(data, VarNames.SEARCH_TO_TIME)
+		)
 
-		content =  MessagesCreator.message_models_to_dtos(messages)
-		self.ws_write({
-			VarNames.CONTENT: content,
+		self.ws_write_messages(messages, {
 			VarNames.JS_MESSAGE_ID: data[VarNames.JS_MESSAGE_ID],
 			VarNames.HANDLER_NAME: HandlerNames.NULL
 		})
 
+	def ws_write_messages(self, messages, response):
+		"""
+		Sends response with content set to dtos of messages, taken from message cache
+		:param messages: messages with CACHE_KEY_FIELDS loaded
+		"""
+		content = self.message_cache.get_json(messages)
+		self.ws_write(json_codec.dumps_with_list(response, VarNames.CONTENT, content))
+
+	@gen.coroutine
 	def show_i_type(self, message):
-		self.publish({
-			VarNames.ROOM_ID: message[VarNames.ROOM_ID],
+		"""
+		Forwards at most one event per SHOW_I_TYPE_INTERVAL for every user in a room,
+		the rest are dropped here or by redis key if user types from another tab
+		"""
+		room_id = message[VarNames.ROOM_ID]
+		now = get_milliseconds()
+		if now - self.last_typing.get(room_id, 0) < settings.SHOW_I_TYPE_INTERVAL:
+			return
+		self.last_typing[room_id] = now
+		first = yield self.async_redis.set(
+			'{}{}:{}'.format(RedisPrefix.TYPING_PREFIX, room_id, self.user_id),
+			self.id,
+			pexpire=settings.SHOW_I_TYPE_INTERVAL,
+			only_if_not_exists=True
+		)
+		if not first:
+			return
+		event = {
+			VarNames.ROOM_ID: room_id,
 			VarNames.USER_ID: self.user_id,
 			VarNames.EVENT: Actions.SHOW_I_TYPE,
 			VarNames.HANDLER_NAME: HandlerNames.ROOM # because ws-message doesnt exist in p2p
-		}, message[VarNames.ROOM_ID])
+		}
+		if settings.SHOW_I_TYPE_EXPIRE is not None:
+			event[VarNames.TYPING_EXPIRE] = settings.SHOW_I_TYPE_EXPIRE
+		self.publish(event, room_id)
 
 	@property
 	def channels_only_rooms(self):
 		return list(filter(lambda a: isinstance(a, int), self.channels))
 
 	def set_message_status(self, payload):
-		to_status = Message.MessageStatus.from_dto(payload[VarNames.MESSAGE_STATUS])
-		if to_status == Message.MessageStatus.received:
-			ids_list = list(Message.objects.filter(
-				id__in=payload[VarNames.MESSAGE_IDS],
-				room_id=payload[VarNames.ROOM_ID],
-				message_status=Message.MessageStatus.on_server.value
-			).values_list('id', flat=True))
-		elif to_status == Message.MessageStatus.read:
-			ids_list = list(Message.objects.filter(
-				id__in=payload[VarNames.MESSAGE_IDS],
-				room_id=payload[VarNames.ROOM_ID],
-				message_status__in=(Message.MessageStatus.on_server.value, Message.MessageStatus.received.value)
-			).values_list('id', flat=True))
-		else:
-			raise Exception("Unsupported status")
-		if ids_list:
-			Message.objects.filter(id__in=ids_list).update(
-				message_status=to_status.value
-			)
-			self.publish(
-				{
-					VarNames.ROOM_ID: payload[VarNames.ROOM_ID],
-					VarNames.HANDLER_NAME: HandlerNames.WS_MESSAGE,
-					VarNames.EVENT: Actions.SET_MESSAGE_STATUS,
-					VarNames.MESSAGE_STATUS: to_status.dto,
-					VarNames.MESSAGE_IDS: ids_list,
-					VarNames.USER_ID: self.user_id,
-				},
-				payload[VarNames.ROOM_ID],
-			)
+		"""
+		Status is saved and published by aggregator a few milliseconds later along with statuses from other users
+		"""
+		self.status_aggregator.add(
+			payload[VarNames.ROOM_ID],
+			self.user_id,
+			Message.MessageStatus.from_dto(payload[VarNames.MESSAGE_STATUS]),
+			payload[VarNames.MESSAGE_IDS]
+		)
 
 	def sync_history(self, in_message):
+		"""
+		Returns messages created, edited or deleted after cursor of every room.
+		Cursor is [updated_at, id] of the last message client has seen in the room,
+		rooms without cursor are synced since lastSynced milliseconds ago.
+		Messages are sorted by cursor, so if response is cut at SYNC_HISTORY_CHUNK_SIZE,
+		client continues from returned cursors.
+		Status changes bump updated_at, so messages that were received or read are returned as well,
+		see MessageStatusAggregator for that contract
+		"""
 		room_ids = in_message[VarNames.ROOM_IDS]
-		message_ids = in_message[VarNames.MESSAGE_IDS]
 		if not set(room_ids).issubset(self.channels):
 			raise ValidationError("This is not a messages in the room you are in")
-
-		messages = Message.objects.filter(
-			Q(room_id__in=room_ids)
-			& ~Q(id__in=message_ids)
-			& (
-				Q(updated_at__gt=get_milliseconds() - in_message[VarNames.LAST_SYNCED]) |
-				# If none user have received this message, return them as well
-				Q(message_status=Message.MessageStatus.on_server.value)
-			)
-		)
-
-		if in_message[VarNames.ON_SERVER_MESSAGE_IDS]:
-			on_server_to_received_ids = list(Message.objects.filter(
-				Q(room_id__in=room_ids)
-				& Q(id__in=in_message[VarNames.ON_SERVER_MESSAGE_IDS])
-				& Q(message_status=Message.MessageStatus.received.value)
-			).values_list('id', flat=True))
-		else:
-			on_server_to_received_ids = []
-
-		if in_message[VarNames.RECEIVED_MESSAGE_IDS] or in_message[VarNames.ON_SERVER_MESSAGE_IDS]:
-			ids_to_search = in_message[VarNames.RECEIVED_MESSAGE_IDS] + in_message[VarNames.ON_SERVER_MESSAGE_IDS] 
-			read_ids = list(Message.objects.filter(
-				Q(room_id__in=room_ids)
-				& Q(id__in=ids_to_search)
-				& Q(message_status=Message.MessageStatus.read.value)
-			).values_list('id', flat=True))
+		# json object keys are strings
+		cursors = {}
+		for room_id, cursor in in_message[VarNames.CURSORS].items():
+			if not str(room_id).isdigit() or not isinstance(cursor, list) or len(cursor) != 2 \
+					or not all(isinstance(c, int) for c in cursor):
+				raise ValidationError("Invalid cursor of room %s" % room_id)
+			cursors[int(room_id)] = cursor
+		synced_since = get_milliseconds() - in_message[VarNames.LAST_SYNCED]
+
+		changed = Q()
+		for room_id in room_ids:
+			updated_at, message_id = cursors.get(room_id, (synced_since, 0))
+			changed |= Q(room_id=room_id, updated_at__gt=updated_at)
+			changed |= Q(room_id=room_id, updated_at=updated_at, id__gt=message_id)
+		if room_ids:
+			messages = list(Message.objects.filter(changed).only('room', *CACHE_KEY_FIELDS).order_by(
+				'updated_at',
+				'id'
+			)[:settings.SYNC_HISTORY_CHUNK_SIZE])
 		else:
-			read_ids = []
-
-		content = MessagesCreator.message_models_to_dtos(messages)
-		self.ws_write({
-			VarNames.CONTENT: content,
-			VarNames.RECEIVED_MESSAGE_IDS: on_server_to_received_ids,
-			VarNames.READ_MESSAGE_IDS: read_ids,
+			messages = []
+		next_cursors = {}
+		for message in messages:
+			next_cursors[message.room_id] = [message.updated_at, message.id]
+
+		self.ws_write_messages(messages, {
+			VarNames.CURSORS: next_cursors,
+			VarNames.HAS_MORE: len(messages) == settings.SYNC_HISTORY_CHUNK_SIZE,
 			VarNames.JS_MESSAGE_ID: in_message[VarNames.JS_MESSAGE_ID],
 			VarNames.HANDLER_NAME: HandlerNames.NULL
 		})
@@ -1088,19 +1111,19 @@ class WebRtcMessageHandler(MessagesHandler):
 
 	def set_opponent_notify_call(self, message):
 		connection_id = message[VarNames.CONNECTION_ID]
-		self.sync_redis.hset(connection_id, self.id, WebRtcRedisStates.OFFERED)
+		self.async_redis_publisher.hset(connection_id, self.id, WebRtcRedisStates.OFFERED)
 
 	def set_opponent_call_channel(self, message):
 		connection_id = message[VarNames.CONNECTION_ID]
 		if message[VarNames.WEBRTC_OPPONENT_ID] == self.id:
 			return True
-		self.sync_redis.hset(connection_id, self.id, WebRtcRedisStates.OFFERED)
+		self.async_redis_publisher.hset(connection_id, self.id, WebRtcRedisStates.OFFERED)
 
 	def set_opponent_p2p_channel(self, message):
 		connection_id = message[VarNames.CONNECTION_ID]
 		if message[VarNames.WEBRTC_OPPONENT_ID] == self.id:
 			return True
-		self.sync_redis.hset(connection_id, self.id, WebRtcRedisStates.READY)
+		self.async_redis_publisher.hset(connection_id, self.id, WebRtcRedisStates.READY)
 
 	def create_webrtc_connection(self, in_message, connection_id):
 		room_id = in_message[VarNames.ROOM_ID]
@@ -1124,20 +1147,22 @@ class WebRtcMessageHandler(MessagesHandler):
 		connection_id = id_generator(RedisPrefix.CONNECTION_ID_LENGTH)
 		self.create_webrtc_connection(in_message, connection_id)
 
+	@gen.coroutine
 	def retry_file_connection(self, in_message):
 		connection_id = in_message[VarNames.CONNECTION_ID]
 		opponent_ws_id = in_message[VarNames.WEBRTC_OPPONENT_ID]
-		sender_ws_id = self.sync_redis.shget(RedisPrefix.WEBRTC_CONNECTION, connection_id)
+		sender_ws_id = yield self.async_redis.hget(RedisPrefix.WEBRTC_CONNECTION, connection_id)
 		if sender_ws_id == self.id:
 			self.publish(self.message_creator.retry_file(connection_id), opponent_ws_id)
 		else:
 			raise ValidationError("Invalid channel status.")
 
+	@gen.coroutine
 	def reply_file_connection(self, in_message):
 		connection_id = in_message[VarNames.CONNECTION_ID]
-		sender_ws_id = self.sync_redis.shget(RedisPrefix.WEBRTC_CONNECTION, connection_id)
-		sender_ws_status = self.sync_redis.shget(connection_id, sender_ws_id)
-		self_ws_status = self.sync_redis.shget(connection_id, self.id)
+		sender_ws_id = yield self.async_redis.hget(RedisPrefix.WEBRTC_CONNECTION, connection_id)
+		sender_ws_status = yield self.async_redis.hget(connection_id, sender_ws_id)
+		self_ws_status = yield self.async_redis.hget(connection_id, self.id)
 		if sender_ws_status == WebRtcRedisStates.READY and self_ws_status == WebRtcRedisStates.OFFERED:
 			self.async_redis_publisher.hset(connection_id, self.id, WebRtcRedisStates.RESPONDED)
 			self.publish(self.message_creator.reply_webrtc(
@@ -1149,10 +1174,11 @@ class WebRtcMessageHandler(MessagesHandler):
 		else:
 			raise ValidationError("Invalid channel status.")
 
+	@gen.coroutine
 	def notify_call_active(self, in_message):
 		# check connectionid , roomId is checked on_message
 		if in_message[VarNames.CONNECTION_ID]:
-			self_channel_status = self.sync_redis.shget(in_message[VarNames.CONNECTION_ID], self.id)
+			self_channel_status = yield self.async_redis.hget(in_message[VarNames.CONNECTION_ID], self.id)
 			if self_channel_status not in [WebRtcRedisStates.READY, WebRtcRedisStates.OFFERED, WebRtcRedisStates.RESPONDED]:
 				raise ValidationError(f"Invalid status to to send this message {self_channel_status}")
 		self.publish({
@@ -1165,7 +1191,7 @@ class WebRtcMessageHandler(MessagesHandler):
 		}, in_message[VarNames.WEBRTC_OPPONENT_ID], True)
 
 	def reply_call_connection(self, in_message):
-		self.send_call_answer(
+		return self.send_call_answer(
 			in_message,
 			WebRtcRedisStates.RESPONDED,
 			Actions.REPLY_CALL_CONNECTION,
@@ -1173,14 +1199,15 @@ class WebRtcMessageHandler(MessagesHandler):
 			HandlerNames.WEBRTC_TRANSFER
 		)
 
+	@gen.coroutine
 	def proxy_webrtc(self, in_message):
 		"""
 		:type in_message: dict
 		"""
 		connection_id = in_message[VarNames.CONNECTION_ID]
 		channel = in_message.get(VarNames.WEBRTC_OPPONENT_ID)
-		self_channel_status = self.sync_redis.shget(connection_id, self.id)
-		opponent_channel_status = self.sync_redis.shget(connection_id, channel)
+		self_channel_status = yield self.async_redis.hget(connection_id, self.id)
+		opponent_channel_status = yield self.async_redis.hget(connection_id, channel)
 		if not (self_channel_status == WebRtcRedisStates.READY and opponent_channel_status == WebRtcRedisStates.READY):
 			raise ValidationError('Error in connection status, your status is {} while opponent is {}'.format(
 				self_channel_status, opponent_channel_status
@@ -1196,24 +1223,25 @@ class WebRtcMessageHandler(MessagesHandler):
 		)
 		self.publish(in_message, channel)
 
+	@gen.coroutine
 	def close_file_connection(self, in_message):
 		connection_id = in_message[VarNames.CONNECTION_ID]
 		opponent_id = in_message.get(VarNames.WEBRTC_OPPONENT_ID, None)
-		self_channel_status = self.sync_redis.shget(connection_id, self.id)
+		self_channel_status = yield self.async_redis.hget(connection_id, self.id)
 		if not self_channel_status:
 			raise Exception("Access Denied")
 		if self_channel_status != WebRtcRedisStates.CLOSED:
-			sender_id = self.sync_redis.shget(RedisPrefix.WEBRTC_CONNECTION, connection_id)
+			sender_id = yield self.async_redis.hget(RedisPrefix.WEBRTC_CONNECTION, connection_id)
 			if sender_id == self.id:
 				message = self.message_creator.get_close_file_sender_message(connection_id)
 				self.async_redis_publisher.hset(connection_id, opponent_id, WebRtcRedisStates.CLOSED)
 				self.publish(message, opponent_id)
 			else:
-				self.close_file_receiver(connection_id, in_message, sender_id)
+				yield self.close_file_receiver(connection_id, in_message, sender_id)
 				self.async_redis_publisher.hset(connection_id, self.id, WebRtcRedisStates.CLOSED)
 
 	def close_call_connection(self, in_message):
-		self.send_call_answer(
+		return self.send_call_answer(
 			in_message,
 			WebRtcRedisStates.CLOSED,
 			Actions.CLOSE_CALL_CONNECTION,
@@ -1222,7 +1250,7 @@ class WebRtcMessageHandler(MessagesHandler):
 		)
 
 	def cancel_call_connection(self, in_message):
-		self.send_call_answer(
+		return self.send_call_answer(
 			in_message,
 			WebRtcRedisStates.CLOSED,
 			Actions.CANCEL_CALL_CONNECTION,
@@ -1230,8 +1258,9 @@ class WebRtcMessageHandler(MessagesHandler):
 			HandlerNames.WEBRTC_TRANSFER
 		)
 
+	@gen.coroutine
 	def close_file_receiver(self, connection_id, in_message, sender_id):
-		sender_status = self.sync_redis.shget(connection_id, sender_id)
+		sender_status = yield self.async_redis.hget(connection_id, sender_id)
 		if not sender_status:
 			raise Exception("Access denied")
 		if sender_status != WebRtcRedisStates.CLOSED:
@@ -1241,12 +1270,13 @@ class WebRtcMessageHandler(MessagesHandler):
 				VarNames.CONTENT: in_message[VarNames.CONTENT]
 			}, sender_id)
 
+	@gen.coroutine
 	def accept_file(self, in_message):
 		connection_id = in_message[VarNames.CONNECTION_ID]
 		content = in_message[VarNames.CONTENT]
-		sender_ws_id = self.sync_redis.shget(RedisPrefix.WEBRTC_CONNECTION, connection_id)
-		sender_ws_status = self.sync_redis.shget(connection_id, sender_ws_id)
-		self_ws_status = self.sync_redis.shget(connection_id, self.id)
+		sender_ws_id = yield self.async_redis.hget(RedisPrefix.WEBRTC_CONNECTION, connection_id)
+		sender_ws_status = yield self.async_redis.hget(connection_id, sender_ws_id)
+		self_ws_status = yield self.async_redis.hget(connection_id, self.id)
 		if sender_ws_status == WebRtcRedisStates.READY \
 				and self_ws_status in [WebRtcRedisStates.RESPONDED, WebRtcRedisStates.READY]:
 			self.async_redis_publisher.hset(connection_id, self.id, WebRtcRedisStates.READY)
@@ -1255,23 +1285,24 @@ class WebRtcMessageHandler(MessagesHandler):
 			raise ValidationError("Invalid channel status")
 
 	def accept_call(self, in_message):
-		self.establish_response_connection(in_message, WebRtcRedisStates.RESPONDED)
+		return self.establish_response_connection(in_message, WebRtcRedisStates.RESPONDED)
 
 	def join_call(self, in_message):
-		self.establish_response_connection(in_message, WebRtcRedisStates.OFFERED)
+		return self.establish_response_connection(in_message, WebRtcRedisStates.OFFERED)
 
 	# todo
-	# we can use channel_status = self.sync_redis.shgetall(connection_id)
+	# we can use channel_status = yield self.async_redis.hgetall(connection_id)
 	# and then self.async_redis_publisher.hset(connection_id, self.id, WebRtcRedisStates.READY)
 	# if we shgetall and only then do async hset
 	# we can catch an issue when 2 concurrent users accepted the call
 	# but we didn't  send them ACCEPT_CALL as they both were in status 'offered'
+	@gen.coroutine
 	def establish_response_connection(self, in_message, allowed_status):
 		connection_id = in_message[VarNames.CONNECTION_ID]
-		self_status = self.sync_redis.shget(connection_id, self.id)
+		self_status = yield self.async_redis.hget(connection_id, self.id)
 		if self_status != allowed_status:
 			raise ValidationError("Invalid channel status")
-		conn_users = self.sync_redis.shgetall(connection_id)
+		conn_users = yield self.async_redis.hgetall(connection_id)
 		self.publish_call_answer(
 			conn_users,
 			connection_id,
@@ -1281,10 +1312,11 @@ class WebRtcMessageHandler(MessagesHandler):
 			{}
 		)
 
+	@gen.coroutine
 	def send_call_answer(self, in_message, status_set, reply_action, allowed_state, message_handler):
 		connection_id = in_message[VarNames.CONNECTION_ID]
 		content = in_message.get(VarNames.CONTENT)  # cancel call can skip browser
-		conn_users = self.sync_redis.shgetall(connection_id)
+		conn_users = yield self.async_redis.hgetall(connection_id)
 		if conn_users[self.id] in allowed_state:
 			self.publish_call_answer(conn_users, connection_id, message_handler, reply_action, status_set, content)
 		else:
@@ -0,0 +1,71 @@
+"""
+Search of messages by words. Every message is split into words that are saved into
+MessageSearchWord when it's sent or edited, search reads that index instead of scanning
+Message.content. All words of a query must be present in a message, the last one is
+matched as a prefix since the query is being typed. Results go from newest to oldest,
+next page starts below the smallest id of the previous one.
+"""
+import re
+
+from chat.models import Message, MessageSearchWord
+from chat.tornado.message_cache import CACHE_KEY_FIELDS
+
+WORD_REGEX = re.compile(r'\w+', re.UNICODE)
+# longer words are cut, the same happens to query words, so they still match
+MAX_WORD_LENGTH = MessageSearchWord._meta.get_field('word').max_length
+# every word adds a subquery
+MAX_QUERY_WORDS = 6
+
+
+def get_words(content):
+	"""
+	:return: unique lowercase words of the content in order they appear
+	"""
+	if not content:
+		return []
+	words = []
+	for word in WORD_REGEX.findall(content.lower()):
+		word = word[:MAX_WORD_LENGTH]
+		if word not in words:
+			words.append(word)
+	return words
+
+
+def index_message(message_id, room_id, content, created=False):
+	"""
+	Replaces words of the message in index. Should be called after every change of Message.content
+	:param created: message is new, so it doesn't have old words to remove
+	"""
+	if not created:
+		MessageSearchWord.objects.filter(message_id=message_id).delete()
+	words = get_words(content)
+	if words:
+		MessageSearchWord.objects.bulk_create([
+			MessageSearchWord(word=word, message_id=message_id, room_id=room_id) for word in words
+		])
+
+
+def search(room_id, query, count, before_id=None, sender_id=None, from_time=None, to_time=None):
+	"""
+	:param before_id: id of the oldest message from previous page
+	:param from_time: milliseconds, inclusive
+	:param to_time: milliseconds, inclusive
+	:return: queryset of at most count messages ordered by id desc, only with fields for MessageDtoCache
+	"""
+	words = get_words(query)[:MAX_QUERY_WORDS]
+	messages = Message.objects.only(*CACHE_KEY_FIELDS).filter(room_id=room_id, deleted=False)
+	for i, word in enumerate(words):
+		if i == len(words) - 1:
+			found = MessageSearchWord.objects.filter(room_id=room_id, word__startswith=word)
+		else:
+			found = MessageSearchWord.objects.filter(room_id=room_id, word=word)
+		messages = messages.filter(id__in=found.values('message_id'))
+	if before_id is not None:
+		messages = messages.filter(id__lt=before_id)
+	if sender_id is not None:
+		messages = messages.filter(sender_id=sender_id)
+	if from_time is not None:
+		messages = messages.filter(time__gte=from_time)
+	if to_time is not None:
+		messages = messages.filter(time__lte=to_time)
+	return messages.order_by('-id')[:count]
@@ -0,0 +1,95 @@
+import logging
+
+from django.core.exceptions import ValidationError
+from tornado.ioloop import IOLoop
+
+from chat.models import Message, get_milliseconds
+from chat.tornado.constants import VarNames, HandlerNames, Actions
+from chat.tornado.db_executor import on_io_loop
+
+logger = logging.getLogger(__name__)
+
+# statuses message can be changed from
+FROM_STATUSES = {
+	Message.MessageStatus.received: (Message.MessageStatus.on_server.value,),
+	Message.MessageStatus.read: (Message.MessageStatus.on_server.value, Message.MessageStatus.received.value),
+}
+
+
+class MessageStatusAggregator(object):
+	"""
+	When a message is sent to a busy room, every recipient marks it received and then read almost at once.
+	Status changes from all connections of the process are collected for delay milliseconds,
+	and then every room gets a single UPDATE and a single setMessageStatus event per user and status.
+	Status change bumps Message.updated_at, it's the sync version of a message, not an edit counter:
+	syncHistory returns messages changed after the client's (updated_at, id) cursor, so offline clients
+	get new statuses from it. The event carries the new updated_at as VarNames.EDITED_TIMES,
+	so the client that got it online moves its cursor as well.
+	"""
+
+	def __init__(self, db_executor, delay):
+		self.db_executor = db_executor
+		self.delay = delay
+		# (room_id, user_id, Message.MessageStatus) -> set of message ids, only modified from IOLoop thread
+		self.pending = {}
+		self.flush_timeout = None
+
+	def add(self, room_id, user_id, status, message_ids):
+		"""
+		Should be called from IOLoop thread
+		:param user_id: who received or read the messages
+		:type status: Message.MessageStatus
+		"""
+		if status not in FROM_STATUSES:
+			raise ValidationError("Unsupported status")
+		self.pending.setdefault((room_id, user_id, status), set()).update(message_ids)
+		if self.flush_timeout is None:
+			self.flush_timeout = IOLoop.current().call_later(self.delay / 1000, self.flush)
+
+	def flush(self):
+		pending = self.pending
+		self.pending = {}
+		self.flush_timeout = None
+		for (room_id, user_id, status), message_ids in pending.items():
+			# read message is received as well
+			if status == Message.MessageStatus.received:
+				message_ids -= pending.get((room_id, user_id, Message.MessageStatus.read), set())
+		try:
+			self.db_executor.submit(self.apply, pending)
+		except ValidationError:
+			logger.error("Dropping statuses of %d messages, db executor is busy", sum(map(len, pending.values())))
+
+	def apply(self, pending):
+		from chat import global_redis
+		# received goes first, so messages that are read in the same batch end up read
+		for (room_id, user_id, status), message_ids in sorted(pending.items(), key=lambda item: item[0][2] == Message.MessageStatus.read):
+			if not message_ids:
+				continue
+			ids_list = list(Message.objects.filter(
+				id__in=message_ids,
+				room_id=room_id,
+				message_status__in=FROM_STATUSES[status]
+			).values_list('id', flat=True))
+			if not ids_list:
+				continue
+			updated_at = get_milliseconds()
+			Message.objects.filter(id__in=ids_list, message_status__in=FROM_STATUSES[status]).update(
+				message_status=status.value,
+				updated_at=updated_at
+			)
+			global_redis.room_ring.refresh(room_id, ids_list)
+			self.publish({
+				VarNames.ROOM_ID: room_id,
+				VarNames.HANDLER_NAME: HandlerNames.WS_MESSAGE,
+				VarNames.EVENT: Actions.SET_MESSAGE_STATUS,
+				VarNames.MESSAGE_STATUS: status.dto,
+				VarNames.MESSAGE_IDS: ids_list,
+				VarNames.USER_ID: user_id,
+				VarNames.EDITED_TIMES: updated_at,
+			}, room_id)
+		logger.debug("Applied %d status changes", len(pending))
+
+	@on_io_loop
+	def publish(self, message, channel):
+		from chat import global_redis
+		global_redis.async_redis_publisher.publish(channel, global_redis.encode_message(message, False))
@@ -16,9 +16,11 @@ from tornado import gen
 from tornado.httpclient import HTTPRequest
 
 from chat import settings
-from chat.global_redis import sync_redis
-from chat.models import get_random_path
+from chat.global_redis import async_redis
+from chat.models import get_random_path, get_milliseconds
 from chat.py2_3 import str_type
+from chat.tornado import json_codec
+from chat.tornado.constants import RedisPrefix
 import mimetypes
 from chat.utils import http_client, create_id
 
@@ -87,10 +89,13 @@ def check_captcha(field='g-recaptcha-response'):
 
 
 def get_user_id(request):
+	"""
+	Generator, use it with yield from
+	"""
 	session_id = request.headers.get('session_id')
 	if session_id is None:
 		return None
-	user_id_raw = sync_redis.hget('sessions', session_id)
+	user_id_raw = yield async_redis.hget('sessions', session_id)
 	if user_id_raw is None:
 		return None
 	return int(user_id_raw)
@@ -98,14 +103,19 @@ def get_user_id(request):
 
 def login_required_no_redirect(func):
 	def wrapper(self, *a, **ka):
-		self.user_id = get_user_id(self.request)
+		self.user_id = yield from get_user_id(self.request)
 		self.logger = logging.LoggerAdapter(parent_logger, {
 			'id': create_id(self.user_id, self.id),
 			'ip': self.client_ip
 		})
 		if self.user_id is None:
 			raise tornado.web.HTTPError(403, 'Missing or expired session_id header')
-		return func(self, *a, **ka)
+		result = func(self, *a, **ka)
+		if isinstance(result, GeneratorType):
+			result = yield from result
+		return result
+	wrapper.__doc__ = func.__doc__
+	wrapper.__name__ = func.__name__
 	return wrapper
 
 
@@ -195,7 +205,7 @@ def json_response(function):
 	def wrap_function(self, *args, **kwargs):
 		result = function(self, *args, **kwargs)
 		if not isinstance(result, str_type):
-			result = json.dumps(result)
+			result = json_codec.dumps(result)
 		self.finish(result)
 
 	return wrap_function
@@ -216,6 +226,68 @@ def require_http_method(method):
 
 	return method_wrapper
 
+
+# KEYS: zsets of request times, one per ip/username; ARGV: now ms, window ms, limit, unique request id
+# returns 0 and records the request if every key is below the limit, otherwise ms until the oldest one expires
+RATE_LIMIT_SCRIPT = """
+local now = tonumber(ARGV[1])
+local window = tonumber(ARGV[2])
+local limit = tonumber(ARGV[3])
+local retry = 0
+for i = 1, #KEYS do
+	redis.call('ZREMRANGEBYSCORE', KEYS[i], '-inf', now - window)
+	if redis.call('ZCARD', KEYS[i]) >= limit then
+		local oldest = redis.call('ZRANGE', KEYS[i], 0, 0, 'WITHSCORES')
+		retry = math.max(retry, tonumber(oldest[2]) + window - now, 1)
+	end
+end
+if retry > 0 then
+	return retry
+end
+for i = 1, #KEYS do
+	redis.call('ZADD', KEYS[i], now, ARGV[4])
+	redis.call('PEXPIRE', KEYS[i], window)
+end
+return 0
+"""
+
+
+def rate_limit(field=None):
+	"""
+	Sliding window limit from settings.HTTP_RATE_LIMITS by method name, shared by all nodes via redis.
+	Requests are counted per client ip and per value of @field, e.g. username, if it's passed
+	:raises ValidationError: if either of them exceeded the limit
+	"""
+
+	def method_wrapper(f):
+		def wrap(self, *args, **kwargs):
+			limit = settings.HTTP_RATE_LIMITS.get(f.__name__)
+			if limit:
+				count, seconds = limit
+				prefix = '{}{}:'.format(RedisPrefix.RATE_LIMIT_PREFIX, f.__name__)
+				keys = [prefix + 'ip:' + self.client_ip]
+				if field and kwargs.get(field):
+					keys.append(prefix + field + ':' + kwargs[field].lower())
+				retry = yield async_redis.eval(
+					RATE_LIMIT_SCRIPT,
+					keys,
+					[get_milliseconds(), seconds * 1000, count, self.id]
+				)
+				if retry:
+					self.logger.warning('Rate limit of %s exceeded for %s', f.__name__, keys)
+					raise ValidationError('Too many attempts, try again in {} seconds'.format(int(retry) // 1000 + 1))
+			result = f(self, *args, **kwargs)
+			if isinstance(result, GeneratorType):
+				result = yield from result
+			return result
+
+		wrap.__doc__ = f.__doc__
+		wrap.__name__ = f.__name__
+		return wrap
+
+	return method_wrapper
+
+
 parent_logger = logging.getLogger(__name__)
 class MethodDispatcher(tornado.web.RequestHandler):
 	"""
@@ -226,6 +298,10 @@ class MethodDispatcher(tornado.web.RequestHandler):
 
 	@property
 	def client_ip(self):
+		# behind nginx remote_ip is always 127.0.0.1, the real one is in the header.
+		# It's only trusted from the proxy, otherwise a client could get a fresh rate limit per request
+		if self.request.remote_ip in settings.TRUSTED_PROXIES:
+			return self.request.headers.get("X-Real-IP") or self.request.remote_ip
 		return self.request.remote_ip
 
 
@@ -254,7 +330,7 @@ class MethodDispatcher(tornado.web.RequestHandler):
 					if isinstance(result, GeneratorType):
 						result = yield from result
 					if not isinstance(result, str):
-						result = json.dumps(result)
+						result = json_codec.dumps(result)
 					self.finish(result)
 				except ValidationError as e:
 					self.set_status(409)
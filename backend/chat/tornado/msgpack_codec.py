@@ -0,0 +1,107 @@
+"""
+Optional MessagePack websocket subprotocol. Dict keys known from constants are replaced
+with negative integer ids, values of VarNames.EVENT with ids of Actions. Ids are generated from
+constants, so server sends the table in the first frame and client uses it for both directions.
+Integer keys (e.g. user ids in online dict) are sent as strings, the same way json does.
+Browser decoders turn map keys into strings, that's why ids are negative: "-3" is never a real key.
+Requires msgpack package, otherwise only json is served.
+"""
+import logging
+
+from chat.tornado.constants import VarNames, Actions, IpVarNames, UserSettingsVarNames, UserProfileVarNames, \
+	HandlerNames
+
+logger = logging.getLogger(__name__)
+
+try:
+	import msgpack
+except ImportError:
+	msgpack = None
+
+if msgpack is not None and msgpack.version < (1, 0):
+	# strict_map_key and the current raw/str defaults appeared in 1.0
+	logger.warning("msgpack %s is too old, 1.0 or newer is required, serving json only", msgpack.version)
+	msgpack = None
+
+SUBPROTOCOL = 'pychat.msgpack.v1'
+
+
+def get_constants(*classes):
+	values = set()
+	for cls in classes:
+		for name, value in vars(cls).items():
+			if not name.startswith('_') and isinstance(value, str):
+				values.add(value)
+	return sorted(values)
+
+
+KEYS = get_constants(VarNames, IpVarNames, UserSettingsVarNames, UserProfileVarNames)
+ACTIONS = get_constants(Actions)
+KEY_IDS = {key: -i - 1 for i, key in enumerate(KEYS)}
+ACTION_IDS = {action: i for i, action in enumerate(ACTIONS)}
+
+
+def compact(obj):
+	if isinstance(obj, dict):
+		res = {}
+		for key, value in obj.items():
+			if key == VarNames.EVENT:
+				value = ACTION_IDS.get(value, value)
+			else:
+				value = compact(value)
+			if isinstance(key, int):
+				key = str(key)
+			res[KEY_IDS.get(key, key)] = value
+		return res
+	if isinstance(obj, (list, tuple)):
+		return [compact(value) for value in obj]
+	return obj
+
+
+def expand(obj):
+	if isinstance(obj, dict):
+		res = {}
+		for key, value in obj.items():
+			if isinstance(key, int) and key < 0:
+				key = KEYS[-key - 1]
+			if key == VarNames.EVENT:
+				if isinstance(value, int):
+					value = ACTIONS[value]
+			else:
+				value = expand(value)
+			res[key] = value
+		return res
+	if isinstance(obj, list):
+		return [expand(value) for value in obj]
+	return obj
+
+
+def encode(message):
+	"""
+	:type message: dict
+	:rtype: bytes
+	"""
+	return msgpack.packb(compact(message), use_bin_type=True)
+
+
+def decode(data):
+	"""
+	:type data: bytes
+	:raises ValueError: if frame is broken or contains unknown ids
+	"""
+	try:
+		return expand(msgpack.unpackb(data, raw=False, strict_map_key=False))
+	except Exception as e:
+		raise ValueError("Unable to decode msgpack frame: %s" % e)
+
+
+def keys_message():
+	"""
+	First frame of the connection, it's not compacted since client doesn't have the table yet
+	"""
+	return msgpack.packb({
+		VarNames.EVENT: Actions.SET_PROTOCOL_KEYS,
+		VarNames.HANDLER_NAME: HandlerNames.WS,
+		VarNames.PROTOCOL_KEYS: KEYS,
+		VarNames.PROTOCOL_ACTIONS: ACTIONS,
+	}, use_bin_type=True)
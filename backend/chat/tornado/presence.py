@@ -0,0 +1,179 @@
+import logging
+
+from tornado import gen
+
+from chat.tornado.constants import RedisPrefix
+
+logger = logging.getLogger(__name__)
+
+# KEYS: online users hash, versions hash, connections set of the user, online sets of user's rooms...;
+# ARGV: user_id, connection id
+# returns {version, connections ids...}
+ADD_CONNECTION_SCRIPT = """
+if redis.call('SADD', KEYS[3], ARGV[2]) == 1 then
+	redis.call('HINCRBY', KEYS[1], ARGV[1], 1)
+end
+for i = 4, #KEYS do
+	redis.call('SADD', KEYS[i], ARGV[1])
+end
+local result = redis.call('SMEMBERS', KEYS[3])
+table.insert(result, 1, redis.call('HINCRBY', KEYS[2], ARGV[1], 1))
+return result
+"""
+
+# KEYS: online users hash, versions hash, connections set of the user, online sets of user's rooms...;
+# ARGV: user_id, connection id
+# returns {version, connections ids that are left...}
+REMOVE_CONNECTION_SCRIPT = """
+if redis.call('SREM', KEYS[3], ARGV[2]) == 1 then
+	if redis.call('HINCRBY', KEYS[1], ARGV[1], -1) <= 0 then
+		redis.call('HDEL', KEYS[1], ARGV[1])
+		for i = 4, #KEYS do
+			redis.call('SREM', KEYS[i], ARGV[1])
+		end
+	end
+end
+local result = redis.call('SMEMBERS', KEYS[3])
+table.insert(result, 1, redis.call('HINCRBY', KEYS[2], ARGV[1], 1))
+return result
+"""
+
+# KEYS: versions hash, connections sets of users; ARGV: users ids
+# returns {version or false, connections ids...} for every user
+GET_CONNECTIONS_SCRIPT = """
+local result = {}
+for i, user_id in ipairs(ARGV) do
+	local user = redis.call('SMEMBERS', KEYS[i + 1])
+	table.insert(user, 1, redis.call('HGET', KEYS[1], user_id))
+	result[i] = user
+end
+return result
+"""
+
+# KEYS: online sets of rooms
+# returns {online users ids...} for every room
+GET_ROOMS_ONLINE_SCRIPT = """
+local result = {}
+for i = 1, #KEYS do
+	result[i] = redis.call('SMEMBERS', KEYS[i])
+end
+return result
+"""
+
+
+class PresenceStore(object):
+	"""
+	Keeps online in redis per user instead of a single set of all connections:
+	 - RedisPrefix.ONLINE_VAR hash: user_id -> number of opened tabs
+	 - RedisPrefix.ONLINE_CONNECTIONS_PREFIX + user_id set: ids of user's websockets
+	 - RedisPrefix.ONLINE_VERSION_VAR hash: user_id -> number of online changes of the user,
+	  clients use it to drop duplicated events and to detect missed ones
+	 - RedisPrefix.ROOM_ONLINE_PREFIX + room_id set: ids of room members that are online,
+	  so offline members of a room are found without reading online of everybody else
+	All of them are updated by a single lua script, so they never disagree.
+	"is user online" and "how many tabs" are O(1), "which of these users are online" is O(k)
+	"""
+
+	def __init__(self, async_redis):
+		self.async_redis = async_redis
+
+	@staticmethod
+	def connections_key(user_id):
+		return RedisPrefix.ONLINE_CONNECTIONS_PREFIX + str(user_id)
+
+	@staticmethod
+	def room_online_key(room_id):
+		return RedisPrefix.ROOM_ONLINE_PREFIX + str(room_id)
+
+	@classmethod
+	def user_keys(cls, user_id, room_ids):
+		keys = [RedisPrefix.ONLINE_VAR, RedisPrefix.ONLINE_VERSION_VAR, cls.connections_key(user_id)]
+		keys.extend(cls.room_online_key(room_id) for room_id in room_ids)
+		return keys
+
+	@gen.coroutine
+	def add_connection(self, user_id, connection_id, room_ids):
+		"""
+		:param room_ids: rooms of the user, user is added to their online
+		:return: (version, connections ids of the user including this one)
+		"""
+		keys = self.user_keys(user_id, room_ids)
+		res = yield self.async_redis.eval(ADD_CONNECTION_SCRIPT, keys, [user_id, connection_id])
+		return int(res[0]), res[1:]
+
+	@gen.coroutine
+	def remove_connection(self, user_id, connection_id, room_ids):
+		"""
+		:param room_ids: rooms of the user, user is removed from their online if this was the last connection
+		:return: (version, connections ids of the user that are still opened)
+		"""
+		keys = self.user_keys(user_id, room_ids)
+		res = yield self.async_redis.eval(REMOVE_CONNECTION_SCRIPT, keys, [user_id, connection_id])
+		return int(res[0]), res[1:]
+
+	def join_room(self, user_id, room_id):
+		"""
+		Should be called when online user is added to a room
+		"""
+		return self.async_redis.sadd(self.room_online_key(room_id), user_id)
+
+	def leave_rooms(self, user_id, room_ids):
+		"""
+		Should be called when online user leaves rooms, or they are deleted
+		"""
+		for room_id in room_ids:
+			self.async_redis.srem(self.room_online_key(room_id), user_id)
+
+	@gen.coroutine
+	def is_online(self, user_id):
+		online = yield self.async_redis.hexists(RedisPrefix.ONLINE_VAR, user_id)
+		return bool(online)
+
+	@gen.coroutine
+	def count_tabs(self, user_id):
+		tabs = yield self.async_redis.hget(RedisPrefix.ONLINE_VAR, user_id)
+		return int(tabs) if tabs else 0
+
+	@gen.coroutine
+	def get_online_users(self, user_ids):
+		"""
+		:return: subset of user_ids that have at least one opened tab
+		:rtype : set
+		"""
+		if not user_ids:
+			return set()
+		tabs = yield self.async_redis.hmget(RedisPrefix.ONLINE_VAR, list(user_ids))
+		return {int(user_id) for user_id, count in tabs.items() if count}
+
+	@gen.coroutine
+	def get_rooms_online(self, room_ids):
+		"""
+		:return: room_id -> set of its members that are online, O(online members of these rooms)
+		:rtype : Dict[int, set]
+		"""
+		room_ids = list(room_ids)
+		if not room_ids:
+			return {}
+		keys = [self.room_online_key(room_id) for room_id in room_ids]
+		rooms = yield self.async_redis.eval(GET_ROOMS_ONLINE_SCRIPT, keys, [])
+		return {room_id: {int(user_id) for user_id in users} for room_id, users in zip(room_ids, rooms)}
+
+	@gen.coroutine
+	def get_connections(self, user_ids):
+		"""
+		:return: (connections ids of users that are online, versions of users)
+		:rtype : (Dict[int, list], Dict[int, int])
+		"""
+		user_ids = list(user_ids)
+		if not user_ids:
+			return {}, {}
+		keys = [RedisPrefix.ONLINE_VERSION_VAR] + [self.connections_key(user_id) for user_id in user_ids]
+		users = yield self.async_redis.eval(GET_CONNECTIONS_SCRIPT, keys, user_ids)
+		online = {}
+		versions = {}
+		for user_id, user in zip(user_ids, users):
+			if user[0] is not None:
+				versions[user_id] = int(user[0])
+			if len(user) > 1:
+				online[user_id] = user[1:]
+		return online, versions
@@ -0,0 +1,153 @@
+import logging
+from collections import defaultdict
+
+from tornado import gen
+from tornado.gen import Task
+from tornadoredis import Client
+
+from chat.tornado import json_codec, msgpack_codec
+from chat.tornado.constants import RedisPrefix
+
+logger = logging.getLogger(__name__)
+
+
+class PubSubFrame(object):
+	"""
+	Pubsub message in formats websockets send it, each one is encoded once per process,
+	when the first websocket that uses it asks for it
+	"""
+	__slots__ = ('raw', 'parsed', '_msgpack')
+
+	def __init__(self, raw, parsed):
+		self.raw = raw
+		self.parsed = parsed
+		self._msgpack = None
+
+	def msgpack(self):
+		if self._msgpack is None:
+			message = self.parsed if self.parsed is not None else json_codec.loads(self.raw)
+			self._msgpack = msgpack_codec.encode(message)
+		return self._msgpack
+
+
+class PubSubMultiplexer(object):
+	"""
+	Holds a single redis subscriber connection per tornado process.
+	Every websocket registers itself for the channels it's interested in,
+	redis SUBSCRIBE/UNSUBSCRIBE are only sent when the first handler
+	subscribes to a channel or the last one leaves it.
+	Incoming messages are dispatched locally to every handler of the channel.
+	Messages marked with RedisPrefix.PARSABLE_PREFIX are decoded once here
+	instead of once per handler.
+	"""
+
+	def __init__(self, host, port, selected_db):
+		self.host = host
+		self.port = port
+		self.selected_db = selected_db
+		# channel name -> set of handlers, subscribing the same handler twice doesn't add a reference
+		self.subscribers = defaultdict(set)
+		self.redis = None
+		self.subscribing = None
+		self.create_client()
+
+	def create_client(self):
+		self.redis = Client(host=self.host, port=self.port, selected_db=self.selected_db)
+		self.subscribing = None
+
+	@staticmethod
+	def channel_name(channel):
+		# redis returns channel names as strings, while rooms ids are ints
+		return str(channel)
+
+	def subscribe(self, channels, handler):
+		"""
+		:param channels: list of channels handler listens to
+		:param handler: object that has on_pub_sub_message(frame) method, frame is PubSubFrame
+		"""
+		new_channels = []
+		for channel in channels:
+			name = self.channel_name(channel)
+			handlers = self.subscribers[name]
+			if not handlers:
+				new_channels.append(name)
+			handlers.add(handler)
+		if new_channels:
+			self.redis_subscribe(new_channels)
+
+	def unsubscribe(self, channels, handler):
+		"""
+		Removes handler from channels, skips channels handler is not subscribed to
+		"""
+		empty_channels = []
+		for channel in channels:
+			name = self.channel_name(channel)
+			handlers = self.subscribers.get(name)
+			if not handlers or handler not in handlers:
+				continue
+			handlers.discard(handler)
+			if not handlers:
+				del self.subscribers[name]
+				empty_channels.append(name)
+		if empty_channels:
+			self.redis.unsubscribe(empty_channels)
+
+	@gen.coroutine
+	def redis_subscribe(self, channels):
+		if not self.redis.subscribed:
+			# listen loop is not started yet. Wait until the first subscribe is
+			# confirmed, otherwise 2 listen loops would read the same connection
+			if self.subscribing is None:
+				self.subscribing = Task(self.redis.subscribe, channels)
+				yield self.subscribing
+				self.subscribing = None
+				logger.info("Starting pubsub listen loop")
+				self.redis.listen(self.on_pub_sub_message)
+				return
+			yield self.subscribing
+		self.redis.subscribe(channels)
+
+	def on_pub_sub_message(self, message):
+		if message.kind == 'disconnect':
+			self.on_disconnect()
+			return
+		if message.kind != 'message':
+			return
+		handlers = self.subscribers.get(message.channel)
+		if not handlers:
+			return
+		try:
+			frame = PubSubFrame(*self.decode(message.body))
+		except ValueError as e:
+			logger.error("Unable to decode pubsub message %.1000s: %s", message.body, e)
+			return
+		for handler in list(handlers):
+			try:
+				handler.on_pub_sub_message(frame)
+			except Exception as e:
+				# one broken handler shouldn't stop the loop for the whole process
+				logger.exception("Error while processing pubsub message %.1000s: %s", message.body, e)
+
+	@staticmethod
+	def decode(body):
+		"""
+		:return: (message without parsable prefix, decoded dict or None if message is not parsable)
+		"""
+		if body.startswith(RedisPrefix.PARSABLE_PREFIX):
+			raw = body[len(RedisPrefix.PARSABLE_PREFIX):]
+			return raw, json_codec.loads(raw)
+		return body, None
+
+	def on_disconnect(self):
+		"""
+		Redis connection has been lost, all subscriptions are gone with it.
+		Close every websocket, so clients reconnect and subscribe to a fresh connection
+		"""
+		handlers = set()
+		for channel_handlers in self.subscribers.values():
+			handlers.update(channel_handlers)
+		logger.error("Redis pubsub connection lost, closing %d websockets", len(handlers))
+		self.subscribers = defaultdict(set)
+		self.create_client()
+		for handler in handlers:
+			handler.close(1012, "Redis connection lost")
@@ -0,0 +1,229 @@
+import json
+import logging
+from collections import deque
+
+from django.conf import settings
+from django.db import transaction
+from tornado import gen
+from tornado.httpclient import HTTPRequest
+from tornado.ioloop import IOLoop
+
+from chat.models import RoomUsers, Subscription, SubscriptionMessages, get_milliseconds
+from chat.utils import http_client
+
+logger = logging.getLogger(__name__)
+
+FIREBASE_API_KEY = getattr(settings, "FIREBASE_API_KEY", None)
+# fcm rejects requests with more registration ids
+FCM_MAX_REGISTRATION_IDS = 1000
+# per registration id errors, that fcm asks to retry
+FCM_RETRY_ERRORS = ('Unavailable', 'InternalServerError')
+FCM_DELETE_ERRORS = ('NotRegistered', 'InvalidRegistration')
+
+
+class PushNotifier(object):
+	"""
+	Sends firebase pushes to offline users of rooms that got new messages.
+	Messages are queued by MessagesHandler.notify_offline and drained every PUSH_NOTIFICATION_DELAY ms,
+	so sending a message doesn't wait for push bookkeeping. Pushes have no payload, the client asks
+	get_firebase_playback for it, so every subscription gets a single push per batch,
+	no matter how many messages it has.
+	A subscription gets at most one push per room in PUSH_NOTIFICATION_WINDOW, messages that come
+	later within the window are counted in SubscriptionMessages and pushed when it ends.
+	Pushes at the end of windows are marked in db by SubscriptionMessages.delayed, every process
+	posts the due ones each PUSH_NOTIFICATION_DUE_INTERVAL, so they survive restarts
+	"""
+
+	def __init__(self, db_executor):
+		self.db_executor = db_executor
+		# (room_id, message_id), only modified from IOLoop thread
+		self.queue = deque()
+		self.flush_timeout = None
+
+	def add(self, room_id, message_id):
+		"""
+		Should be called from IOLoop thread
+		"""
+		if FIREBASE_API_KEY is None:
+			return
+		if len(self.queue) >= settings.PUSH_NOTIFICATION_QUEUE_SIZE:
+			logger.warning("Push queue is full, dropping message %s", message_id)
+			return
+		self.queue.append((room_id, message_id))
+		if self.flush_timeout is None:
+			self.flush_timeout = IOLoop.current().call_later(settings.PUSH_NOTIFICATION_DELAY / 1000, self.flush)
+
+	@gen.coroutine
+	def flush(self):
+		self.flush_timeout = None
+		batch = list(self.queue)
+		self.queue.clear()
+		try:
+			room_users = yield self.db_executor.submit(self.get_room_users, {room_id for room_id, message_id in batch})
+			from chat import global_redis
+			online = yield global_redis.presence.get_rooms_online(room_users.keys())
+			reg_ids = yield self.db_executor.submit(self.save_messages, batch, room_users, online)
+		except Exception:
+			logger.exception("Unable to send pushes for %d messages", len(batch))
+			return
+		self.post_chunks(reg_ids)
+
+	@gen.coroutine
+	def post_due(self):
+		"""
+		Posts delayed pushes whose window has ended, should be called periodically
+		"""
+		if FIREBASE_API_KEY is None:
+			return
+		try:
+			reg_ids = yield self.db_executor.submit(self.claim_due)
+		except Exception:
+			logger.exception("Unable to read delayed pushes")
+			return
+		self.post_chunks(reg_ids)
+
+	def post_chunks(self, reg_ids):
+		for i in range(0, len(reg_ids), FCM_MAX_REGISTRATION_IDS):
+			self.post(reg_ids[i:i + FCM_MAX_REGISTRATION_IDS], 0)
+
+	@staticmethod
+	def get_room_users(room_ids):
+		"""
+		:return: dict room_id -> list of users that have notifications enabled
+		"""
+		res = {}
+		for room_id, user_id in RoomUsers.objects.filter(
+			room_id__in=room_ids,
+			notifications=True
+		).values_list('room_id', 'user_id'):
+			res.setdefault(room_id, []).append(user_id)
+		return res
+
+	@staticmethod
+	def save_messages(batch, room_users, online):
+		"""
+		Adds messages to notifications of subscriptions for get_firebase_playback
+		:param online: room_id -> set of its members that are online
+		:return: registration ids to push now
+		"""
+		offline_room_users = {
+			room_id: [user_id for user_id in users if user_id not in online.get(room_id, ())]
+			for room_id, users in room_users.items()
+		}
+		offline = {user_id for users in offline_room_users.values() for user_id in users}
+		if not offline:
+			return []
+		subscriptions = {}
+		for sub_id, user_id, registration_id in Subscription.objects.filter(
+			user_id__in=offline,
+			inactive=False
+		).values_list('id', 'user_id', 'registration_id'):
+			subscriptions.setdefault(user_id, []).append((sub_id, registration_id))
+		# (subscription_id, room_id) -> [newest message id, number of messages]
+		new_messages = {}
+		reg_ids = {}
+		for room_id, message_id in batch:
+			for user_id in offline_room_users.get(room_id, []):
+				for sub_id, registration_id in subscriptions.get(user_id, []):
+					entry = new_messages.setdefault((sub_id, room_id), [message_id, 0])
+					entry[0] = max(entry[0], message_id)
+					entry[1] += 1
+					reg_ids[sub_id] = registration_id
+		if not new_messages:
+			return []
+		now = get_milliseconds()
+		window = settings.PUSH_NOTIFICATION_WINDOW
+		push_now = set()
+		with transaction.atomic():
+			# missing rows are inserted empty first, so nodes that got messages of the same room
+			# at the same time add their counts to the locked row instead of overwriting each other
+			SubscriptionMessages.objects.bulk_create([SubscriptionMessages(
+				subscription_id=sub_id,
+				room_id=room_id,
+				message_id=message_id,
+				count=0,
+				received=True
+			) for (sub_id, room_id), (message_id, count) in new_messages.items()], ignore_conflicts=True)
+			update = []
+			for sub_mess in SubscriptionMessages.objects.select_for_update().filter(
+				subscription_id__in=reg_ids.keys(),
+				room_id__in={room_id for sub_id, room_id in new_messages}
+			):
+				entry = new_messages.get((sub_mess.subscription_id, sub_mess.room_id))
+				if entry is None:
+					continue
+				message_id, count = entry
+				sub_mess.count = count if sub_mess.received else sub_mess.count + count
+				sub_mess.message_id = max(sub_mess.message_id, message_id)
+				sub_mess.received = False
+				if sub_mess.delayed:
+					pass  # push at the end of the window is already scheduled
+				elif sub_mess.pushed is None or now >= sub_mess.pushed + window:
+					sub_mess.pushed = now
+					push_now.add(reg_ids[sub_mess.subscription_id])
+				else:
+					sub_mess.pushed += window
+					sub_mess.delayed = True
+				update.append(sub_mess)
+			SubscriptionMessages.objects.bulk_update(update, ['message', 'count', 'received', 'pushed', 'delayed'])
+		return list(push_now)
+
+	@staticmethod
+	def claim_due():
+		"""
+		Rows are locked with skip_locked, so every due push is posted by a single process
+		:return: registration ids whose delayed push is due
+		"""
+		with transaction.atomic():
+			due = list(SubscriptionMessages.objects.select_for_update(skip_locked=True).filter(
+				delayed=True,
+				pushed__lte=get_milliseconds()
+			).values_list('id', 'subscription_id'))
+			if not due:
+				return []
+			SubscriptionMessages.objects.filter(id__in=[sm_id for sm_id, sub_id in due]).update(delayed=False)
+		return list(Subscription.objects.filter(
+			id__in={sub_id for sm_id, sub_id in due},
+			inactive=False
+		).values_list('registration_id', flat=True))
+
+	def post(self, reg_ids, attempt):
+		def on_reply(response):
+			if response.error and (response.code >= 500 or response.code == 599):
+				logger.warning("FireBase is unavailable, code %s: %s", response.code, response.error)
+				self.retry(reg_ids, attempt)
+				return
+			try:
+				logger.debug("!! FireBase response: %s", response.body)
+				response_obj = json.loads(response.body)
+				delete = []
+				retry = []
+				for index, elem in enumerate(response_obj['results']):
+					if elem.get('error') in FCM_DELETE_ERRORS:
+						delete.append(reg_ids[index])
+					elif elem.get('error') in FCM_RETRY_ERRORS:
+						retry.append(reg_ids[index])
+				if delete:
+					logger.info("Deactivating subscriptions: %s", delete)
+					self.db_executor.submit(self.deactivate, delete)
+				if retry:
+					self.retry(retry, attempt)
+			except Exception as e:
+				logger.error("Unable to parse response %s", e)
+
+		headers = {"Content-Type": "application/json", "Authorization": "key=%s" % FIREBASE_API_KEY}
+		body = json.dumps({"registration_ids": reg_ids})
+		logger.debug("!! post_fire_message %s", body)
+		r = HTTPRequest(settings.FIREBASE_URL, method="POST", headers=headers, body=body)
+		http_client.fetch(r, callback=on_reply)
+
+	def retry(self, reg_ids, attempt):
+		if attempt >= settings.PUSH_NOTIFICATION_RETRIES:
+			logger.error("Giving up sending pushes to %d subscriptions", len(reg_ids))
+			return
+		delay = settings.PUSH_NOTIFICATION_BACKOFF * 2 ** attempt
+		IOLoop.current().call_later(delay / 1000, self.post, reg_ids, attempt + 1)
+
+	@staticmethod
+	def deactivate(reg_ids):
+		Subscription.objects.filter(registration_id__in=reg_ids).update(inactive=True)
@@ -0,0 +1,190 @@
+import logging
+
+from chat.models import Message
+from chat.tornado.constants import RedisPrefix
+from chat.tornado.message_cache import CACHE_KEY_FIELDS
+
+logger = logging.getLogger(__name__)
+
+# KEYS: state, ids zset, dtos hash, versions hash; ARGV: size, message_id, updated_at, json
+# adds message if ring is built or being built, drops the oldest ones above size
+ADD_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+	return 0
+end
+local version = redis.call('HGET', KEYS[4], ARGV[2])
+if version and tonumber(version) >= tonumber(ARGV[3]) then
+	return 0
+end
+redis.call('ZADD', KEYS[2], ARGV[2], ARGV[2])
+redis.call('HSET', KEYS[3], ARGV[2], ARGV[4])
+redis.call('HSET', KEYS[4], ARGV[2], ARGV[3])
+local excess = redis.call('ZCARD', KEYS[2]) - tonumber(ARGV[1])
+if excess > 0 then
+	local old = redis.call('ZRANGE', KEYS[2], 0, excess - 1)
+	redis.call('ZREMRANGEBYRANK', KEYS[2], 0, excess - 1)
+	redis.call('HDEL', KEYS[3], unpack(old))
+	redis.call('HDEL', KEYS[4], unpack(old))
+end
+return 1
+"""
+
+# KEYS: state, ids zset, dtos hash, versions hash; ARGV: message_id, updated_at, json, ...
+# replaces messages that are in the ring with newer versions, others are ignored
+UPDATE_SCRIPT = """
+for i = 1, #ARGV, 3 do
+	local version = redis.call('HGET', KEYS[4], ARGV[i])
+	if version and tonumber(version) < tonumber(ARGV[i + 1]) then
+		redis.call('HSET', KEYS[3], ARGV[i], ARGV[i + 2])
+		redis.call('HSET', KEYS[4], ARGV[i], ARGV[i + 1])
+	end
+end
+return 1
+"""
+
+# KEYS: state, ids zset, dtos hash
+# returns false if ring is not built, otherwise {id, json, ...} from newest to oldest.
+# ttl isn't prolonged, so even rings that are read all the time are rebuilt from db once in a while
+GET_SCRIPT = """
+if redis.call('GET', KEYS[1]) ~= 'full' then
+	return false
+end
+local ids = redis.call('ZREVRANGE', KEYS[2], 0, -1)
+local result = {}
+if #ids > 0 then
+	local dtos = redis.call('HMGET', KEYS[3], unpack(ids))
+	for i = 1, #ids do
+		table.insert(result, ids[i])
+		table.insert(result, dtos[i])
+	end
+end
+return result
+"""
+
+# KEYS: state, ids zset, dtos hash, versions hash; ARGV: size, ttl, message_id, updated_at, json, ...
+# messages that were added or edited while ring was being built are kept if they are newer than the ones from db
+FINISH_BUILD_SCRIPT = """
+for i = 3, #ARGV, 3 do
+	local version = redis.call('HGET', KEYS[4], ARGV[i])
+	if not version or tonumber(version) < tonumber(ARGV[i + 1]) then
+		redis.call('ZADD', KEYS[2], ARGV[i], ARGV[i])
+		redis.call('HSET', KEYS[3], ARGV[i], ARGV[i + 2])
+		redis.call('HSET', KEYS[4], ARGV[i], ARGV[i + 1])
+	end
+end
+local excess = redis.call('ZCARD', KEYS[2]) - tonumber(ARGV[1])
+if excess > 0 then
+	local old = redis.call('ZRANGE', KEYS[2], 0, excess - 1)
+	redis.call('ZREMRANGEBYRANK', KEYS[2], 0, excess - 1)
+	redis.call('HDEL', KEYS[3], unpack(old))
+	redis.call('HDEL', KEYS[4], unpack(old))
+end
+redis.call('SET', KEYS[1], 'full', 'EX', ARGV[2])
+redis.call('EXPIRE', KEYS[2], ARGV[2])
+redis.call('EXPIRE', KEYS[3], ARGV[2])
+redis.call('EXPIRE', KEYS[4], ARGV[2])
+return 1
+"""
+
+# seconds a ring can stay in 'building' state, if process dies in the middle
+BUILD_TIMEOUT = 60
+
+
+class RoomRing(object):
+	"""
+	Newest messages of every room that are not in threads, the first page of loadMessages.
+	Stored in redis as zset of ids, hash of serialized dtos and hash of their updated_at, at most size of them.
+	Ring is built from db on the first read, and then sending, editing, deleting messages,
+	replying in threads and changing statuses keep it up to date. A dto is only replaced by one with
+	greater updated_at, so writes that come out of order don't bring old content back.
+	Rings expire ttl after they were built. Used from db executor threads, so it reads redis synchronously
+	"""
+
+	def __init__(self, sync_redis, message_cache, size, ttl):
+		self.sync_redis = sync_redis
+		self.message_cache = message_cache
+		self.size = size
+		self.ttl = ttl
+		self.add_script = sync_redis.register_script(ADD_SCRIPT)
+		self.update_script = sync_redis.register_script(UPDATE_SCRIPT)
+		self.get_script = sync_redis.register_script(GET_SCRIPT)
+		self.finish_build_script = sync_redis.register_script(FINISH_BUILD_SCRIPT)
+
+	@staticmethod
+	def get_keys(room_id):
+		return [
+			RedisPrefix.ROOM_RING_STATE_PREFIX + str(room_id),
+			RedisPrefix.ROOM_RING_IDS_PREFIX + str(room_id),
+			RedisPrefix.ROOM_RING_DTOS_PREFIX + str(room_id),
+			RedisPrefix.ROOM_RING_VERSIONS_PREFIX + str(room_id),
+		]
+
+	def get(self, room_id, count):
+		"""
+		:return: list of (message_id, json) of at most count newest messages, built from db if ring doesn't exist.
+		A page shorter than count means that the room has no older messages.
+		None if somebody else is building the ring right now or a dto of the page is missing,
+		then the page should be read from db
+		"""
+		if count > self.size:
+			return None
+		res = self.get_script(keys=self.get_keys(room_id)[:3])
+		if res is None:
+			messages = self.build(room_id)
+			return messages[:count] if messages is not None else None
+		page = []
+		for i in range(0, min(len(res), count * 2), 2):
+			if not res[i + 1]:
+				logger.warning("Ring of room %s misses dto of message %s", room_id, res[i])
+				return None
+			page.append((int(res[i]), res[i + 1].decode('utf-8')))
+		# ring keeps size newest messages, so it's shorter than count only if it contains the whole room
+		return page
+
+	def build(self, room_id):
+		"""
+		:return: list of (message_id, json) from newest to oldest, that ring was built with,
+		None if ring is already being built
+		"""
+		keys = self.get_keys(room_id)
+		if not self.sync_redis.set(keys[0], 'building', ex=BUILD_TIMEOUT, nx=True):
+			return None
+		messages = list(Message.objects.filter(
+			room_id=room_id,
+			parent_message__isnull=True
+		).only(*CACHE_KEY_FIELDS).order_by('-id')[:self.size])
+		res = self.message_cache.get_json_with_ids(messages)
+		args = [self.size, self.ttl] + self.get_versioned_args(messages, res)
+		self.finish_build_script(keys=keys, args=args)
+		logger.debug("Built ring of room %s with %d messages", room_id, len(res))
+		return res
+
+	@staticmethod
+	def get_versioned_args(messages, jsons):
+		"""
+		:param jsons: list of (message_id, json) of messages
+		:return: [message_id, updated_at, json, ...] for ring scripts
+		"""
+		versions = {message.id: message.updated_at for message in messages}
+		args = []
+		for message_id, json in jsons:
+			args.extend((message_id, versions[message_id], json))
+		return args
+
+	def add(self, room_id, message, json):
+		self.add_script(keys=self.get_keys(room_id), args=[self.size, message.id, message.updated_at, json])
+
+	def refresh(self, room_id, message_ids):
+		"""
+		Serializes messages again if they are in the ring, should be called after they are changed in db
+		"""
+		keys = self.get_keys(room_id)
+		pipe = self.sync_redis.pipeline(transaction=False)
+		for message_id in message_ids:
+			pipe.hexists(keys[2], message_id)
+		present = [message_id for message_id, exists in zip(message_ids, pipe.execute()) if exists]
+		if not present:
+			return
+		messages = list(Message.objects.filter(id__in=present).only(*CACHE_KEY_FIELDS))
+		args = self.get_versioned_args(messages, self.message_cache.get_json_with_ids(messages))
+		self.update_script(keys=keys, args=args)
@@ -1,18 +1,18 @@
-import json
 import logging
-from datetime import timedelta
 
 from django.conf import settings
 from django.core.exceptions import ValidationError
-from django.db.models import F, Q, Count
+from django.db.models import F, Q
 from itertools import chain
-from tornado import ioloop, gen
+from tornado import gen
 from tornado.websocket import WebSocketHandler, WebSocketClosedError
 
 from chat.models import User, Message, UserJoinedInfo, Room, RoomUsers, UserProfile, Channel, get_milliseconds
 from chat.py2_3 import str_type
+from chat.tornado import json_codec, msgpack_codec, ws_compression
 from chat.tornado.anti_spam import AntiSpam
 from chat.tornado.constants import VarNames, HandlerNames, Actions, RedisPrefix
+from chat.tornado.db_executor import on_io_loop
 from chat.tornado.message_creator import MessagesCreator, WebRtcMessageCreator
 from chat.tornado.message_handler import MessagesHandler, WebRtcMessageHandler
 from chat.utils import create_id, get_or_create_ip_model
@@ -31,6 +31,11 @@ class TornadoHandler(WebSocketHandler, WebRtcMessageHandler):
 		self.__connected__ = False
 		self.restored_connection = False
 		self.anti_spam = AntiSpam()
+		self.msgpack = False
+		self.opening = None  # future of setup_connection
+		self.closing = False
+		self.adding_connection = None  # future of presence.add_connection, None if it wasn't called
+		self.presence_rooms = []  # rooms user was added to online of
 
 	@property
 	def connected(self):
@@ -43,59 +48,91 @@ class TornadoHandler(WebSocketHandler, WebRtcMessageHandler):
 	def data_received(self, chunk):
 		pass
 
+	def get_compression_options(self):
+		return ws_compression.get_compression_options()
+
+	def get_websocket_protocol(self):
+		websocket_version = self.request.headers.get("Sec-WebSocket-Version")
+		if websocket_version in ("7", "8", "13"):
+			return ws_compression.DeflateThresholdProtocol(self, compression_options=self.get_compression_options())
+
+	def select_subprotocol(self, subprotocols):
+		if msgpack_codec.SUBPROTOCOL in subprotocols and msgpack_codec.msgpack:
+			self.msgpack = True
+			return msgpack_codec.SUBPROTOCOL
+		return None
+
+	@gen.coroutine
 	def on_message(self, json_message):
 		message = None
+		if self.opening is not None and not self.opening.done():
+			# frames are read one by one, so the following ones wait for setup as well
+			try:
+				yield self.opening
+			except Exception:
+				pass  # logged by tornado, connected stays False
 		try:
 			if not self.connected:
 				raise ValidationError('Skipping message %s, as websocket is not initialized yet' % json_message)
 			if not json_message:
 				raise Exception('Skipping null message')
-			# self.anti_spam.check_spam(json_message)
+			self.anti_spam.check_size(json_message)
 			self.logger.debug('<< %.1000s', json_message)
-			message = json.loads(json_message)
+			try:
+				if isinstance(json_message, bytes) and self.msgpack:
+					message = msgpack_codec.decode(json_message)
+				else:
+					message = json_codec.loads(json_message)
+			except ValueError as e:
+				raise ValidationError('Unable to decode frame: {}'.format(e))
 			if message[VarNames.EVENT] not in self.process_ws_message:
 				raise Exception("event {} is unknown".format(message[VarNames.EVENT]))
+			self.anti_spam.check_spam(message[VarNames.EVENT])
 			channel = message.get(VarNames.ROOM_ID)
 			if channel and channel not in self.channels:
 				raise ValidationError('Access denied for channel {}. Allowed channels: {}'.format(channel, self.channels))
-			self.process_ws_message[message[VarNames.EVENT]](message)
+			handled = self.execute_ws_message(message)
+			if handled is not None:  # wait for db or redis before processing next frame, to keep actions in order
+				yield handled
 		except ValidationError as e:
 			error_message = self.message_creator.default(str(e.message), Actions.GROWL_ERROR_MESSAGE, HandlerNames.WS)
 			if message:
 				error_message[VarNames.JS_MESSAGE_ID] = message.get(VarNames.JS_MESSAGE_ID, None)
 			self.ws_write(error_message)
 
+	@gen.coroutine
 	def on_close(self):
-		if self.async_redis.subscribed:
+		self.closing = True
+		self.anti_spam.release()
+		if self.channels:
 			self.logger.info("Close event, unsubscribing from %s", self.channels)
-			self.async_redis.unsubscribe(self.channels)
+			self.pubsub.unsubscribe(self.channels, self)
 		else:
 			self.logger.info("Close event, not subscribed, channels: %s", self.channels)
-		self.async_redis_publisher.srem(RedisPrefix.ONLINE_VAR, self.id)
-		online = self.get_dict_users_from_redis()
-		my_online = online.setdefault(self.user_id, [])
-		if self.id in my_online:
-			my_online.remove(self.id)
-		if self.connected:
-			message = self.message_creator.room_online_logout(online)
-			self.publish(message, settings.ALL_ROOM_ID)
-			UserProfile.objects.filter(id=self.user_id).update(last_time_online=get_milliseconds())
+		room_ids = set(self.presence_rooms).union(self.room_ids)
+		added = False
+		if self.adding_connection is not None:
+			try:
+				yield self.adding_connection  # otherwise it could add the tab after it's removed
+				added = True
+			except Exception as e:
+				self.logger.warning("Connection wasn't added to online: %s", e)
+		if added:
+			version, connections = yield self.presence.remove_connection(self.user_id, self.id, room_ids)
+			if self.connected:
+				message = self.message_creator.room_online_logout(connections, version)
+				self.publish_online_change(message)
+				UserProfile.objects.filter(id=self.user_id).update(last_time_online=get_milliseconds())
 		self.disconnect()
 
-	def disconnect(self, tries=0):
+	def disconnect(self):
 		"""
-		Closes a connection if it's not in proggress, otherwice timeouts closing
-		https://github.com/evilkost/brukva/issues/25#issuecomment-9468227
+		Subscriptions are shared with other websockets via pubsub multiplexer,
+		so there's no redis connection to close here
 		"""
 		self.connected = False
 		self.closed_channels = self.channels
 		self.channels = []
-		if self.async_redis.connection.in_progress and tries < 1000:  # failsafe eternal loop
-			self.logger.debug('Closing a connection timeouts')
-			ioloop.IOLoop.instance().add_timeout(timedelta(0.00001), self.disconnect, tries+1)
-		else:
-			self.logger.info("Close connection result: %s")
-			self.async_redis.disconnect()
 
 	def generate_self_id(self):
 		"""
@@ -114,8 +151,22 @@ class TornadoHandler(WebSocketHandler, WebRtcMessageHandler):
 		self.save_ip()
 
 	def open(self):
+		"""
+		Tornado 4.5 doesn't wait for coroutine open before reading frames,
+		so on_message waits for setup_connection instead
+		"""
+		self.opening = self.setup_connection()
+		return self.opening
+
+	@gen.coroutine
+	def setup_connection(self):
+		"""
+		Socket can be closed during any yield, setup stops then, so closed handler doesn't stay subscribed
+		"""
 		session_key = self.get_argument('sessionId', None)
-		user_id = self.sync_redis.hget('sessions', session_key)
+		user_id = yield self.async_redis.hget('sessions', session_key)
+		if self.closing:
+			return
 		if user_id is None:
 			self.logger.warning('!! Session key %s has been rejected' % session_key)
 			self.close(403, "Session key %s has been rejected" % session_key)
@@ -127,6 +178,7 @@ class TornadoHandler(WebSocketHandler, WebRtcMessageHandler):
 			self.logger.warning('Database has been cleared, but redis %s not. Logging out current user' % session_key)
 			self.close(403, "This user no more longer exists")
 			return
+		self.anti_spam.set_user(self.user_id)
 		self.ip = self.get_client_ip()
 		self.generate_self_id()
 		self.message_creator = WebRtcMessageCreator(self.user_id, self.id)
@@ -135,17 +187,6 @@ class TornadoHandler(WebSocketHandler, WebRtcMessageHandler):
 			'ip': self.ip
 		})
 		self.logger.debug("!! Incoming connection, session %s, thread hash %s", session_key, self.id)
-		self.async_redis.connect()
-		self.async_redis_publisher.sadd(RedisPrefix.ONLINE_VAR, self.id)
-		# since we add user to online first, latest trigger will always show correct online
-
-		online = self.get_dict_users_from_redis()
-		# current user is already online
-		my_online = online.setdefault(self.user_id, [])
-		if self.id not in my_online:
-			my_online.append(self.id)
-
-		was_online = len(online.get(self.user_id)) > 1 # if other tabs are opened
 		user_rooms_query = Room.objects.filter(users__id=self.user_id, disabled=False) \
 			.values('id', 'name', 'creator_id', 'is_main_in_channel', 'channel_id', 'p2p', 'roomusers__notifications', 'roomusers__volume')
 		room_users = [{
@@ -168,9 +209,21 @@ class TornadoHandler(WebSocketHandler, WebRtcMessageHandler):
 			VarNames.CHANNEL_CREATOR_ID: channel.creator_id
 		} for channel in channels_db]
 		room_ids = [room_id[VarNames.ROOM_ID] for room_id in room_users]
+		self.presence_rooms = list(room_ids)
+		self.adding_connection = self.presence.add_connection(self.user_id, self.id, room_ids)
+		version, connections = yield self.adding_connection
+		# since we add user to online first, latest trigger will always show correct online
+		was_online = len(connections) > 1 # if other tabs are opened
+		if self.closing:
+			return
 		rooms_users = RoomUsers.objects.filter(room_id__in=room_ids).values('user_id', 'room_id')
+		room_members = {self.user_id}
 		for ru in rooms_users:
 			user_rooms_dict[ru['room_id']][VarNames.ROOM_USERS].append(ru['user_id'])
+			room_members.add(ru['user_id'])
+		online, online_versions = yield self.presence.get_connections(room_members)
+		if self.closing:
+			return
 		# get all missed messages
 		self.channels = room_ids  # py2 doesn't support clear()
 		self.channels.append(self.channel)
@@ -187,31 +240,19 @@ class TornadoHandler(WebSocketHandler, WebRtcMessageHandler):
 		# 	if o:
 		# 		room[VarNames.LOAD_MESSAGES_OFFLINE] = o
 
-		if settings.SHOW_COUNTRY_CODE:
-			fetched_users  = UserProfile.objects.annotate(user_c=Count('id')).values('id', 'username', 'sex', 'thumbnail', 'userjoinedinfo__ip__country_code', 'userjoinedinfo__ip__country', 'userjoinedinfo__ip__region', 'userjoinedinfo__ip__city')
-			user_dict = [RedisPrefix.set_js_user_structure_flag(
-				user['id'],
-				user['username'],
-				user['sex'],
-				"{0}{1}".format(settings.MEDIA_URL, user['thumbnail']) if user['thumbnail'] else None,
-				user['userjoinedinfo__ip__country_code'],
-				user['userjoinedinfo__ip__country'],
-				user['userjoinedinfo__ip__region'],
-				user['userjoinedinfo__ip__city']
-			) for user in fetched_users]
-		else:
-			fetched_users = UserProfile.objects.values('id', 'username', 'sex', 'photo')
-			user_dict = [RedisPrefix.set_js_user_structure(
-				user['id'],
-				user['username'],
-				user['sex'],
-				"{0}{1}".format(settings.MEDIA_URL, user['thumbnail']) if user['thumbnail'] else None,
-			) for user in fetched_users]
+		users_version = self.get_argument('usersVersion', None)
+		users_version = int(users_version) if users_version and users_version.isdigit() else None
+		users_version, users_json, users_full = yield self.user_directory.get_users(users_version)
+		if self.closing:
+			return
 
-		self.ws_write(self.message_creator.set_room(room_users, user_dict, online, user_db, channels))
-		online_user_names_mes = self.message_creator.room_online_login(online)
-		self.logger.info('!! First tab, sending refresh online for all')
-		self.publish(online_user_names_mes, settings.ALL_ROOM_ID)
+		if self.msgpack:
+			self.write_message(msgpack_codec.keys_message(), binary=True)
+		set_room = self.message_creator.set_room(room_users, users_version, users_full, online, online_versions, user_db, channels)
+		self.ws_write(json_codec.dumps_with_list(set_room, VarNames.ROOM_USERS, users_json))
+		online_user_names_mes = self.message_creator.room_online_login(connections, version)
+		self.logger.info('!! Sending online change to rooms %s', self.room_ids)
+		self.publish_online_change(online_user_names_mes)
 		self.logger.info("!! User %s subscribes for %s", self.user_id, self.channels)
 		self.connected = True
 
@@ -256,7 +297,13 @@ class TornadoHandler(WebSocketHandler, WebRtcMessageHandler):
 				Q(ip__ip=self.ip) & Q(user_id=self.user_id)).exists():
 			ip = yield from get_or_create_ip_model(self.ip, self.logger)
 			UserJoinedInfo.objects.create(ip=ip, user_id=self.user_id)
+			if settings.SHOW_COUNTRY_CODE:
+				yield self.user_directory.patch({
+					VarNames.USER_ID: self.user_id,
+					VarNames.LOCATION: RedisPrefix.set_js_location_structure(ip.country_code, ip.country, ip.region, ip.city)
+				})
 
+	@on_io_loop
 	def ws_write(self, message):
 		"""
 		Tries to send message, doesn't throw exception outside
@@ -265,8 +312,14 @@ class TornadoHandler(WebSocketHandler, WebRtcMessageHandler):
 		"""
 		# self.logger.debug('<< THREAD %s >>', os.getppid())
 		try:
+			if self.msgpack:
+				if isinstance(message, str_type):  # already encoded json, e.g. from message cache
+					message = json_codec.loads(message)
+				self.logger.debug(">> %.1000s", message)
+				self.write_message(msgpack_codec.encode(message), binary=True)
+				return
 			if isinstance(message, dict):
-				message = json.dumps(message)
+				message = json_codec.dumps(message)
 			if not isinstance(message, str_type):
 				raise ValueError('Wrong message type : %s' % str(message))
 			self.logger.debug(">> %.1000s", message)
@@ -274,5 +327,19 @@ class TornadoHandler(WebSocketHandler, WebRtcMessageHandler):
 		except WebSocketClosedError as e:
 			self.logger.warning("%s. Can't send message << %s >> ", e, str(message))
 
+	def ws_write_frame(self, frame):
+		"""
+		Pubsub message, msgpack is encoded once for all websockets of the process
+		:type frame: chat.tornado.pubsub.PubSubFrame
+		"""
+		if not self.msgpack:
+			self.ws_write(frame.raw)
+			return
+		try:
+			self.logger.debug(">> %.1000s", frame.raw)
+			self.write_message(frame.msgpack(), binary=True)
+		except WebSocketClosedError as e:
+			self.logger.warning("%s. Can't send message << %.1000s >> ", e, frame.raw)
+
 	def get_client_ip(self):
 		return self.request.headers.get("X-Real-IP") or self.request.remote_ip
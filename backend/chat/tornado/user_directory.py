@@ -0,0 +1,221 @@
+import logging
+
+from django.conf import settings
+from tornado import gen
+
+from chat.models import UserProfile, get_milliseconds
+from chat.tornado import json_codec
+from chat.tornado.constants import RedisPrefix, VarNames
+
+logger = logging.getLogger(__name__)
+
+# KEYS: base version, version, changes zset, users hash; ARGV: since version
+# returns false if directory is not built yet, otherwise {base, version, user_id, user_version, user_json, ...}
+# with users changed after since version, or all users if since is older than base
+GET_USERS_SCRIPT = """
+local base = redis.call('GET', KEYS[1])
+if not base then
+	return false
+end
+local result = {base, redis.call('GET', KEYS[2])}
+if tonumber(ARGV[1]) >= tonumber(base) then
+	local ids = redis.call('ZRANGEBYSCORE', KEYS[3], '(' .. ARGV[1], '+inf', 'WITHSCORES')
+	for i = 1, #ids, 2 do
+		table.insert(result, ids[i])
+		table.insert(result, ids[i + 1])
+		table.insert(result, redis.call('HGET', KEYS[4], ids[i]))
+	end
+else
+	local users = redis.call('HGETALL', KEYS[4])
+	for i = 1, #users, 2 do
+		table.insert(result, users[i])
+		table.insert(result, redis.call('ZSCORE', KEYS[3], users[i]) or base)
+		table.insert(result, users[i + 1])
+	end
+end
+return result
+"""
+
+# KEYS: base version, version, changes zset, users hash; ARGV: base version, user_id, user_json, ...
+# returns false if directory was already built from newer data, e.g. by another process that started later
+BUILD_SCRIPT = """
+local base = redis.call('GET', KEYS[1])
+if base and tonumber(base) >= tonumber(ARGV[1]) then
+	return false
+end
+redis.call('DEL', KEYS[3], KEYS[4])
+for i = 2, #ARGV, 2 do
+	redis.call('HSET', KEYS[4], ARGV[i], ARGV[i + 1])
+end
+redis.call('SET', KEYS[1], ARGV[1])
+redis.call('SET', KEYS[2], ARGV[1])
+return ARGV[1]
+"""
+
+# KEYS: base version, version, changes zset, users hash; ARGV: user_id, json with changed fields
+# returns new version or false if directory is not built yet, the whole user is loaded from db then
+PATCH_SCRIPT = """
+if not redis.call('GET', KEYS[1]) then
+	return false
+end
+local user = redis.call('HGET', KEYS[4], ARGV[1])
+user = user and cjson.decode(user) or {}
+for key, value in pairs(cjson.decode(ARGV[2])) do
+	user[key] = value
+end
+redis.call('HSET', KEYS[4], ARGV[1], cjson.encode(user))
+local version = redis.call('INCR', KEYS[2])
+redis.call('ZADD', KEYS[3], version, ARGV[1])
+return version
+"""
+
+
+def load_users():
+	"""
+	Reads every user from database, this is the query that user directory saves us from
+	:rtype : Dict[int, dict]
+	"""
+	users = {}
+	if settings.SHOW_COUNTRY_CODE:
+		# user can have a few joined ips, the latest one wins
+		fetched_users = UserProfile.objects.values(
+			'id', 'username', 'sex', 'thumbnail', 'userjoinedinfo__ip__country_code',
+			'userjoinedinfo__ip__country', 'userjoinedinfo__ip__region', 'userjoinedinfo__ip__city'
+		).order_by('userjoinedinfo__id')
+		for user in fetched_users:
+			users[user['id']] = RedisPrefix.set_js_user_structure_flag(
+				user['id'],
+				user['username'],
+				user['sex'],
+				"{0}{1}".format(settings.MEDIA_URL, user['thumbnail']) if user['thumbnail'] else None,
+				user['userjoinedinfo__ip__country_code'],
+				user['userjoinedinfo__ip__country'],
+				user['userjoinedinfo__ip__region'],
+				user['userjoinedinfo__ip__city']
+			)
+	else:
+		for user in UserProfile.objects.values('id', 'username', 'sex', 'thumbnail'):
+			users[user['id']] = RedisPrefix.set_js_user_structure(
+				user['id'],
+				user['username'],
+				user['sex'],
+				"{0}{1}".format(settings.MEDIA_URL, user['thumbnail']) if user['thumbnail'] else None,
+			)
+	return users
+
+
+class UserDirectory(object):
+	"""
+	All users that are sent to client in set_room. Built from database once,
+	stored in redis as a hash of serialized users and in process memory.
+	Every change of a user increments version and is saved in a zset user_id -> version,
+	so a process that's behind only reads users changed since its version.
+	Base version is the timestamp of build, versions only grow after it,
+	so anything older than base means that the directory has been rebuilt.
+	Clients pass the version they hold on reconnect and receive only users changed after it.
+	Users are kept encoded, so set_room splices them into the frame instead of encoding them per connection.
+	"""
+
+	def __init__(self, async_redis):
+		self.async_redis = async_redis
+		self.keys = [
+			RedisPrefix.USER_DIRECTORY_BASE_VAR,
+			RedisPrefix.USER_DIRECTORY_VERSION_VAR,
+			RedisPrefix.USER_DIRECTORY_CHANGES_VAR,
+			RedisPrefix.USER_DIRECTORY_VAR
+		]
+		self.base = 0
+		self.version = 0
+		# user_id -> json of user
+		self.users = {}
+		# user_id -> version when user was changed last time
+		self.users_versions = {}
+		# json of all users of current version
+		self.users_list = []
+		self.building = None
+
+	@gen.coroutine
+	def get_users(self, since=None):
+		"""
+		:param since: version of directory client already has
+		:return: (version, list of json strings of users, whether list contains all users).
+		If since is actual, only users changed after it are returned. Put them to a frame with json_codec.dumps_with_list
+		"""
+		yield self.refresh()
+		if since is not None and self.base <= since <= self.version:
+			changed = [self.users[user_id] for user_id, version in self.users_versions.items() if version > since]
+			return self.version, changed, False
+		return self.version, self.users_list, True
+
+	@gen.coroutine
+	def refresh(self):
+		res = yield self.async_redis.eval(GET_USERS_SCRIPT, self.keys, [self.version])
+		if res is None:
+			yield self.build()
+		else:
+			self.apply(res)
+
+	def apply(self, res):
+		"""
+		:param res: reply of GET_USERS_SCRIPT
+		"""
+		base, version = int(res[0]), int(res[1])
+		if (base, version) <= (self.base, self.version):
+			# overlapping refreshes can finish in any order, the older one must not roll the version back
+			return
+		if self.version < base:
+			self.users = {}
+			self.users_versions = {}
+		for i in range(2, len(res), 3):
+			user_id = int(res[i])
+			self.users_versions[user_id] = int(res[i + 1])
+			self.users[user_id] = res[i + 2]
+		self.base = base
+		self.version = version
+		self.users_list = list(self.users.values())
+		logger.debug("User directory updated to version %d", version)
+
+	@gen.coroutine
+	def build(self):
+		# reconnect storm after flushing redis shouldn't run the big query per connection
+		if self.building is None:
+			self.building = self._build()
+		try:
+			yield self.building
+		finally:
+			self.building = None
+
+	@gen.coroutine
+	def _build(self):
+		from chat.tornado.message_handler import MessagesHandler
+		# taken before the query, so the build that read newer data wins
+		base = get_milliseconds()
+		users = yield MessagesHandler.heavy_db_executor.submit(load_users)
+		users = {user_id: json_codec.dumps(user) for user_id, user in users.items()}
+		args = [base]
+		for user_id, user in users.items():
+			args.append(user_id)
+			args.append(user)
+		version = yield self.async_redis.eval(BUILD_SCRIPT, self.keys, args)
+		if version is None:
+			logger.info("User directory was rebuilt from newer data, reading it")
+			res = yield self.async_redis.eval(GET_USERS_SCRIPT, self.keys, [self.version])
+			if res is not None:
+				self.apply(res)
+			return
+		logger.info("Built user directory of %d users, version %s", len(users), version)
+		self.users = users
+		self.users_list = list(users.values())
+		self.base = self.version = int(version)
+		self.users_versions = {user_id: self.base for user_id in users}
+
+	@gen.coroutine
+	def patch(self, user):
+		"""
+		Updates fields of a user, or adds a new one.
+		Should be called after every change of fields that set_js_user_structure returns
+		:param user: dict with VarNames.USER_ID and any of fields set_js_user_structure_flag returns
+		"""
+		user_id = user[VarNames.USER_ID]
+		version = yield self.async_redis.eval(PATCH_SCRIPT, self.keys, [user_id, json_codec.dumps(user)])
+		logger.debug("Patched user %s in directory, version %s", user_id, version)
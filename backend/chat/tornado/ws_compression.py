@@ -0,0 +1,83 @@
+"""
+permessage-deflate for /ws. Tornado compresses every frame once compression is negotiated,
+while most of our frames (pings, typing, statuses) are a few dozen bytes and only get bigger
+after deflate. Frames shorter than WS_COMPRESSION_MIN_SIZE are sent without RSV1 bit, which
+permessage-deflate allows per message, and the compressor context simply doesn't see them.
+"""
+import logging
+import time
+
+from django.conf import settings
+from tornado.escape import utf8
+from tornado.websocket import WebSocketProtocol13
+
+logger = logging.getLogger(__name__)
+
+
+class CompressionStats(object):
+	"""
+	Counters of all websockets of the process, logged and reset every WS_COMPRESSION_REPORT_INTERVAL
+	"""
+
+	def __init__(self):
+		self.frames = 0
+		self.skipped = 0
+		self.raw_bytes = 0
+		self.compressed_bytes = 0
+		self.compress_time = 0
+
+	def add(self, raw_size, compressed_size, compress_time):
+		self.frames += 1
+		self.raw_bytes += raw_size
+		self.compressed_bytes += compressed_size
+		self.compress_time += compress_time
+
+	def report(self):
+		if self.frames:
+			logger.info(
+				"Compressed %d frames, %d bytes to %d, ratio %.2f, took %.1fms (%.3fms per frame), %d small frames sent raw",
+				self.frames,
+				self.raw_bytes,
+				self.compressed_bytes,
+				self.raw_bytes / self.compressed_bytes,
+				self.compress_time * 1000,
+				self.compress_time * 1000 / self.frames,
+				self.skipped
+			)
+		elif self.skipped:
+			logger.info("%d small frames sent raw, nothing compressed", self.skipped)
+		self.__init__()
+
+
+stats = CompressionStats()
+
+
+def get_compression_options():
+	"""
+	:return: options for WebSocketHandler.get_compression_options, None if compression is disabled
+	"""
+	if settings.WS_COMPRESSION_LEVEL is None:
+		return None
+	return {
+		'compression_level': settings.WS_COMPRESSION_LEVEL,
+		'mem_level': settings.WS_COMPRESSION_MEM_LEVEL,
+	}
+
+
+class DeflateThresholdProtocol(WebSocketProtocol13):
+
+	def write_message(self, message, binary=False):
+		if not self._compressor:
+			return super(DeflateThresholdProtocol, self).write_message(message, binary)
+		opcode = 0x2 if binary else 0x1
+		message = utf8(message)
+		self._message_bytes_out += len(message)
+		if len(message) < settings.WS_COMPRESSION_MIN_SIZE:
+			stats.skipped += 1
+			return self._write_frame(True, opcode, message)
+		# deflate doesn't release the GIL for small chunks and IOLoop does nothing else meanwhile,
+		# so wall time here is the cpu time spent on compression
+		start = time.perf_counter()
+		compressed = self._compressor.compress(message)
+		stats.add(len(message), len(compressed), time.perf_counter() - start)
+		return self._write_frame(True, opcode, compressed, flags=self.RSV1)
@@ -9,6 +9,7 @@ from django.core.exceptions import ValidationError
 from django.core.files.base import ContentFile, File
 from django.db import connection
 from django.db.models import Q
+from django.utils.encoding import filepath_to_uri
 from django.utils.six import BytesIO
 from tornado.httpclient import AsyncHTTPClient, HTTPRequest
 
@@ -137,6 +138,52 @@ def create_id(user_id=0, random=None):
 	return "{:04d}:{}".format(user_id if user_id else 0, random), random
 
 
+def encode_cursor(before_id=None, after_id=None):
+	return 'a{}'.format(after_id) if after_id is not None else 'b{}'.format(before_id)
+
+
+def decode_cursor(cursor):
+	"""
+	:param cursor: continuation token returned by paginate_by_id
+	:return: (before_id, after_id)
+	"""
+	if isinstance(cursor, str) and cursor and cursor[0] in ('b', 'a') and cursor[1:].isdigit():
+		message_id = int(cursor[1:])
+		return (message_id, None) if cursor[0] == 'b' else (None, message_id)
+	raise ValidationError("Invalid cursor {}".format(cursor))
+
+
+def get_int(data, key, default=None):
+	"""
+	Ids, counts and timestamps that client sends
+	:return: data[key] as int or default if it's not set
+	:raises ValidationError: if it's not a non-negative integer, so client gets an error reply
+	"""
+	value = data.get(key)
+	if value is None:
+		return default
+	if isinstance(value, bool) or not isinstance(value, (int, str)) or not str(value).isdigit():
+		raise ValidationError("Invalid {} {}".format(key, value))
+	return int(value)
+
+
+def paginate_by_id(query_set, count, before_id=None, after_id=None):
+	"""
+	Keyset pagination, a page costs the same no matter how deep it is.
+	Newest messages older than before_id, or oldest messages newer than after_id if it's set
+	:return: (list of at most count models, continuation token or None if there's nothing more)
+	"""
+	if after_id is not None:
+		page = list(query_set.filter(id__gt=after_id).order_by('id')[:count])
+		cursor = encode_cursor(after_id=page[-1].id) if len(page) == count else None
+	else:
+		if before_id is not None:
+			query_set = query_set.filter(id__lt=before_id)
+		page = list(query_set.order_by('-id')[:count])
+		cursor = encode_cursor(before_id=page[-1].id) if len(page) == count else None
+	return page, cursor
+
+
 def max_from_2(a, b):
 	if a is None:
 		return b
@@ -210,22 +257,23 @@ def create_thumbnail(input_file, up):
 	up.thumbnail.save(filename + '.jpeg', ContentFile(thumb_io.getvalue()), save=False)
 
 
-def get_message_images_videos(messages):
-	ids = [message.id for message in messages if message.symbol]
-	if ids:
-		images = Image.objects.filter(message_id__in=ids)
-	else:
-		images = []
-	return images
+def get_media_url(name):
+	"""
+	The same as FieldFile.url for default storage, w/o creating a model with a file field
+	"""
+	return "{}{}".format(settings.MEDIA_URL, filepath_to_uri(name))
 
 
-def get_message_tags(messages):
-	ids = [message.id for message in messages if message.symbol]
-	if ids:
-		mentions = MessageMention.objects.filter(message_id__in=ids)
-	else:
-		mentions = []
-	return mentions
+def get_message_images_videos(message_ids):
+	if message_ids:
+		return Image.objects.filter(message_id__in=message_ids).values('id', 'message_id', 'symbol', 'img', 'preview', 'type')
+	return []
+
+
+def get_message_tags(message_ids):
+	if message_ids:
+		return MessageMention.objects.filter(message_id__in=message_ids).values_list('message_id', 'symbol', 'user_id')
+	return []
 
 
 def up_files_to_img(files, message_id):
@@ -440,9 +440,13 @@ export default class DatabaseWrapper implements IStorage {
     });
   }
 
-  public setMessagesStatus(messagesIds: number[], status: MessageStatus): void {
+  public setMessagesStatus(messagesIds: number[], status: MessageStatus, edited?: number): void {
     this.write(t => {
-      this.executeSql(t, `update message set status = ? where id in ${this.idsToString(messagesIds)}`, [status])();
+      if (edited !== undefined) {
+        this.executeSql(t, `update message set status = ?, edited = ? where id in ${this.idsToString(messagesIds)}`, [status, edited])();
+      } else {
+        this.executeSql(t, `update message set status = ? where id in ${this.idsToString(messagesIds)}`, [status])();
+      }
     });
   }
 
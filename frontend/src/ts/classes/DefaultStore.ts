@@ -50,6 +50,7 @@ import {
   SetReceivingFileStatus,
   SetReceivingFileUploaded,
   SetRoomsUsers,
+  SetUserOnline,
   SetSearchStateTo,
   SetSearchTextTo,
   SetSendingFileStatus,
@@ -537,20 +538,25 @@ export class DefaultStore extends VuexModule {
         roomId,
         messagesIds,
         status,
+        edited,
       }: {
         roomId: number;
         messagesIds: number[];
         status: MessageStatus;
+        edited?: number; // server messages only, p2p ones count edits in it
       }
   ) {
     let ids = Object.values(this.roomsDict[roomId].messages)
         .filter(m => messagesIds.includes(m.id))
         .map(m => {
           m.status = status;
+          if (edited !== undefined) {
+            m.edited = edited;
+          }
           return m.id;
     });
     if (ids.length) {
-      this.storage.setMessagesStatus(ids, status);
+      this.storage.setMessagesStatus(ids, status, edited);
     }
   }
 
@@ -632,9 +638,10 @@ export class DefaultStore extends VuexModule {
   }
 
   @Mutation
-  public increaseThreadMessageCount({roomId, messageId}: {roomId: number; messageId: number}) {
+  public increaseThreadMessageCount({roomId, messageId, lastReplyId}: {roomId: number; messageId: number; lastReplyId: number}) {
     let message = this.roomsDict[roomId].messages[messageId];
     message.threadMessagesCount++;
+    Vue.set(message, 'threadLastReplyId', lastReplyId);
     this.storage.setThreadMessageCount(messageId, message.threadMessagesCount);
   }
 
@@ -786,6 +793,15 @@ export class DefaultStore extends VuexModule {
     this.onlineDict = ids;
   }
 
+  @Mutation
+  public setUserOnline(payload: SetUserOnline) {
+    if (payload.online.length === 0) {
+      Vue.delete(this.onlineDict, String(payload.userId));
+    } else {
+      Vue.set(this.onlineDict, String(payload.userId), payload.online);
+    }
+  }
+
   @Mutation
   public setUser(user: UserModel) {
     this.allUsersDict[user.id].user = user.user;
@@ -890,10 +906,10 @@ export class DefaultStore extends VuexModule {
   }
 
   @Action
-  public async showUserIsTyping({userId, roomId}: {userId: number; roomId: number}) {
+  public async showUserIsTyping({userId, roomId, expire}: {userId: number; roomId: number; expire?: number}) {
     let date = Date.now();
     this.setShowITypingUser({userId, roomId, date});
-    await sleep(SHOW_I_TYPING_INTERVAL_SHOW); // lets say 1 second ping
+    await sleep(expire || SHOW_I_TYPING_INTERVAL_SHOW); // server tells when to hide it, otherwise lets say 1 second ping
     if (this.roomsDict[roomId].usersTyping[userId] === date) {
       this.setShowITypingUser({userId, roomId, date: 0});
     }
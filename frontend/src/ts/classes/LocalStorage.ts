@@ -76,7 +76,7 @@ export default class LocalStorage implements IStorage {
   public setUserSettings(settings: CurrentUserSettingsModel)  {}
   public saveRoomUsers(ru: SetRoomsUsers)  {}
   public setUsers(users: UserModel[])  {}
-  public setMessagesStatus(messagesIds: number[], status: MessageStatus) {}
+  public setMessagesStatus(messagesIds: number[], status: MessageStatus, edited?: number) {}
   public saveUser(users: UserModel)  {}
   public markMessageAsSent(m: number[]) {}
 
@@ -0,0 +1,86 @@
+import {
+  decode,
+  encode
+} from '@msgpack/msgpack';
+
+export const MSGPACK_SUBPROTOCOL = 'pychat.msgpack.v1';
+
+export interface SetProtocolKeysMessage {
+  action: 'setProtocolKeys';
+  keys: string[];
+  actions: string[];
+}
+
+/**
+ * Frames of MSGPACK_SUBPROTOCOL. Known keys are replaced with negative ids and actions with ids.
+ * Server generates this table from its constants and sends it in the very first frame.
+ * Decoder converts all map keys to strings, so id -3 comes as '-3', real keys are never negative numbers
+ */
+export class MsgpackCodec {
+  private keys: string[] = [];
+  private actions: string[] = [];
+  private keyIds: Record<string, number> = {};
+  private actionIds: Record<string, number> = {};
+
+  public setKeys(message: SetProtocolKeysMessage) {
+    this.keys = message.keys;
+    this.actions = message.actions;
+    this.keyIds = {};
+    this.actionIds = {};
+    message.keys.forEach((key, i) => this.keyIds[key] = -i - 1);
+    message.actions.forEach((action, i) => this.actionIds[action] = i);
+  }
+
+  public encode(message: object): Uint8Array {
+    return encode(this.compact(message));
+  }
+
+  public decode(data: ArrayBuffer): any {
+    return this.expand(decode(new Uint8Array(data)));
+  }
+
+  private compact(obj: any): any {
+    if (Array.isArray(obj)) {
+      return obj.map(v => this.compact(v));
+    }
+    if (obj === null || typeof obj !== 'object') {
+      return obj;
+    }
+    // Map allows number keys
+    const res: Map<string | number, any> = new Map();
+    Object.keys(obj).forEach(key => {
+      const value = obj[key];
+      if (value === undefined) {
+        return;
+      }
+      const id: number | undefined = this.keyIds[key];
+      if (key === 'action') {
+        const actionId: number | undefined = this.actionIds[value];
+        res.set(id ?? key, actionId ?? value);
+      } else {
+        res.set(id ?? key, this.compact(value));
+      }
+    });
+    return res;
+  }
+
+  private expand(obj: any): any {
+    if (Array.isArray(obj)) {
+      return obj.map(v => this.expand(v));
+    }
+    if (obj === null || typeof obj !== 'object' || obj instanceof Uint8Array) {
+      return obj;
+    }
+    const res: Record<string, any> = {};
+    Object.keys(obj).forEach(key => {
+      let value = obj[key];
+      const realKey = /^-\d+$/.test(key) ? this.keys[-parseInt(key, 10) - 1] : key;
+      if (realKey === 'action') {
+        res[realKey] = typeof value === 'number' ? this.actions[value] : value;
+      } else {
+        res[realKey] = this.expand(value);
+      }
+    });
+    return res;
+  }
+}
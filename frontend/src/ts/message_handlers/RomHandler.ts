@@ -49,9 +49,13 @@ import {
   RemoveOnlineUserMessage,
   SaveChannelSettingsMessage,
   SaveRoomSettingsMessage,
-  ShowITypeMessage
+  ShowITypeMessage,
+  OnlineResponseMessage
 } from '@/ts/types/messages/wsInMessages';
-import {ALL_ROOM_ID} from '@/ts/utils/consts';
+import {
+  ALL_ROOM_ID,
+  ONLINE_SNAPSHOT_INTERVAL
+} from '@/ts/utils/consts';
 import {sub} from '@/ts/instances/subInstance';
 import {Logger} from 'lines-logger';
 import {DefaultStore} from '@/ts/classes/DefaultStore';
@@ -89,6 +93,9 @@ export class RoomHandler extends MessageHandler  {
   private readonly store: DefaultStore;
   private readonly ws: WsHandler;
   private readonly audioPlayer: AudioPlayer;
+  // last online change of every user that shares a room with us, see addOnlineUser
+  private onlineVersions: Record<number, number> = {};
+  private onlineGapDetected: boolean = false;
 
   constructor(
       store: DefaultStore,
@@ -102,6 +109,7 @@ export class RoomHandler extends MessageHandler  {
     this.logger = loggerFactory.getLogger('room');
     this.ws = ws;
     this.audioPlayer = audioPlayer;
+    setInterval(this.syncOnlineIfGap.bind(this), ONLINE_SNAPSHOT_INTERVAL);
   }
 
   public leaveUser(message: LeaveUserMessage) {
@@ -129,10 +137,13 @@ export class RoomHandler extends MessageHandler  {
     this.mutateRoomAddition(message, 'room_created');
   }
   public removeOnlineUser(message: RemoveOnlineUserMessage) {
-    if (message.content[message.userId].length === 0) {
+    if (!this.checkOnlineVersion(message.userId, message.onlineVersion)) {
+      return;
+    }
+    if (message.content.length === 0) {
       this.addChangeOnlineEntry(message.userId, message.time, 'gone offline');
     }
-    this.store.setOnline(message.content);
+    this.store.setUserOnline({userId: message.userId, online: [...message.content]});
   }
 
   public addChannel(message: AddChannelMessage) {
@@ -140,6 +151,7 @@ export class RoomHandler extends MessageHandler  {
   }
 
   public inviteUser(message: InviteUserMessage) {
+    this.onlineGapDetected = true;
     this.store.setRoomsUsers({
       roomId: message.roomId,
       users: message.users
@@ -177,11 +189,14 @@ export class RoomHandler extends MessageHandler  {
   }
 
   public addOnlineUser(message: AddOnlineUserMessage) {
-    if (message.content[message.userId].length === 1) {
+    if (!this.checkOnlineVersion(message.userId, message.onlineVersion)) {
+      return;
+    }
+    if (message.content.length === 1) {
       // exactly 1 device is now offline, so that new that appeared is the first one
       this.addChangeOnlineEntry(message.userId, message.time, 'appeared online');
     }
-    this.store.setOnline({...message.content}); // prevent modifying original object
+    this.store.setUserOnline({userId: message.userId, online: [...message.content]}); // prevent modifying original object
     let payload: ChangeUserOnlineInfoMessage = {
       handler: 'webrtc',
       allowZeroSubscribers: true,
@@ -215,7 +230,7 @@ export class RoomHandler extends MessageHandler  {
 
   public async showIType(message: ShowITypeMessage) {
     if (this.store.myId !== message.userId) {
-      await this.store.showUserIsTyping({userId: message.userId, roomId: message.roomId});
+      await this.store.showUserIsTyping({userId: message.userId, roomId: message.roomId, expire: message.expire});
     }
   }
 
@@ -262,14 +277,16 @@ export class RoomHandler extends MessageHandler  {
 
   public init(m: PubSetRooms) {
 
-    const {rooms, channels, users, online} = m;
+    const {rooms, channels, users, usersFull, online, onlineVersions} = m;
     // otherwise, we will modify value from ws, which will make observable in logs
     // other values from 'm' are converted with convertable
     let ids: PubSetRooms['online'] = JSON.parse(JSON.stringify(online));
     this.store.setOnline(ids);
+    this.onlineVersions = {...onlineVersions};
+    this.onlineGapDetected = false;
 
     this.logger.debug('set users {}', users)();
-    const um: UserDictModel = {};
+    const um: UserDictModel = usersFull ? {} : {...this.store.allUsersDict};
     users.forEach(u => {
       um[u.userId] = convertUser(u);
     });
@@ -302,6 +319,40 @@ export class RoomHandler extends MessageHandler  {
   }
 
 
+  /**
+   * Server sends online change of a user to every room we share with them, so the same event can come a few times.
+   * @return false if this change has been already applied
+   */
+  private checkOnlineVersion(userId: number, version: number): boolean {
+    const known: number | undefined = this.onlineVersions[userId];
+    if (known !== undefined) {
+      if (version <= known) {
+        return false;
+      }
+      if (version > known + 1) {
+        this.logger.warn('Missed online events of user {}, {} -> {}', userId, known, version)();
+        this.onlineGapDetected = true;
+      }
+    }
+    this.onlineVersions[userId] = version;
+    return true;
+  }
+
+  private async syncOnlineIfGap() {
+    if (!this.onlineGapDetected || !this.ws.isWsOpen()) {
+      return;
+    }
+    this.onlineGapDetected = false;
+    try {
+      const response: OnlineResponseMessage = await this.ws.getOnline();
+      this.store.setOnline(JSON.parse(JSON.stringify(response.content)));
+      this.onlineVersions = {...response.onlineVersions};
+    } catch (e) {
+      this.logger.error('Unable to load online {}', e)();
+      this.onlineGapDetected = true;
+    }
+  }
+
   private addChangeOnlineEntry(userId: number, serverTime: number, action: 'appeared online' | 'gone offline') {
     if (this.store.myId == userId) {
       return // do nto display I appear Online
@@ -338,6 +389,7 @@ export class RoomHandler extends MessageHandler  {
   }
 
   private mutateRoomAddition(message: AddRoomBase, type: 'room_created' | 'invited') {
+    this.onlineGapDetected = true; // we don't know online of new room members yet
     if (message.channelId) {
       //as (Omit<AddRoomMessage, 'action'> & {action: 'addChannel'})
       let channelDict: ChannelModel = getChannelDict(message as any);
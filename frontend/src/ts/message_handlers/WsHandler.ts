@@ -1,8 +1,14 @@
 import {
   CLIENT_NO_SERVER_PING_CLOSE_TIMEOUT,
   CONNECTION_RETRY_TIME,
-  IS_DEBUG
+  IS_DEBUG,
+  WS_MSGPACK
 } from '@/ts/utils/consts';
+import {
+  MSGPACK_SUBPROTOCOL,
+  MsgpackCodec,
+  SetProtocolKeysMessage
+} from '@/ts/classes/MsgpackCodec';
 import {
   Logger,
 } from 'lines-logger';
@@ -27,6 +33,7 @@ import {
 import {
   MessageModelDto,
   RoomNoUsersDto,
+  SyncCursor,
   UserProfileDto,
   UserProfileDtoWoImage,
   UserSettingsDto
@@ -52,7 +59,8 @@ import {
   MessagesResponseMessage,
   UserProfileChangedMessage,
   WebRtcSetConnectionIdMessage,
-  SyncHistoryResponseMessage
+  SyncHistoryResponseMessage,
+  OnlineResponseMessage
 } from '@/ts/types/messages/wsInMessages';
 import {
   InternetAppearMessage,
@@ -107,6 +115,10 @@ export default class WsHandler extends MessageHandler implements MessageSupplier
   // };
   // private progressInterval = {}; TODO this was commented along with usage, check if it breaks anything
   private wsConnectionId = '';
+  // version of users directory we have, so server sends only users that changed after it
+  private usersVersion: number | null = null;
+  // set if server accepted msgpack subprotocol for current connection
+  private msgpack: MsgpackCodec | null = null;
 
   constructor(API_URL: string, sessionHolder: SessionHolder, store: DefaultStore) {
     super();
@@ -120,7 +132,7 @@ export default class WsHandler extends MessageHandler implements MessageSupplier
 
   sendRawTextToServer(message: string): boolean {
     if (this.isWsOpen()) {
-      this.ws!.send(message);
+      this.ws!.send(this.msgpack ? this.msgpack.encode(JSON.parse(message)) : message);
       return true;
     } else {
       return false;
@@ -186,12 +198,14 @@ export default class WsHandler extends MessageHandler implements MessageSupplier
   public async search(
       searchString: string,
       roomId: number,
-      offset: number,
+      beforeId: number|null,
+      filters: {senderId?: number; fromTime?: number; toTime?: number} = {}
   ): Promise<MessagesResponseMessage> {
     return this.messageProc.sendToServerAndAwait({
       searchString,
       roomId,
-      offset,
+      beforeId,
+      ...filters,
       action: 'searchMessages'
     });
   }
@@ -264,15 +278,11 @@ export default class WsHandler extends MessageHandler implements MessageSupplier
 
   public async syncHistory(
       roomIds: number[],
-      messagesIds: number[],
-      receivedMessageIds: number[],
-      onServerMessageIds: number[],
+      cursors: Record<number, SyncCursor>,
       lastSynced: number
   ): Promise<SyncHistoryResponseMessage> {
     let payload: SyncHistoryOutMessage = {
-      messagesIds,
-      receivedMessageIds,
-      onServerMessageIds,
+      cursors,
       roomIds,
       lastSynced,
       action: 'syncHistory'
@@ -280,6 +290,12 @@ export default class WsHandler extends MessageHandler implements MessageSupplier
     return this.messageProc.sendToServerAndAwait(payload);
   }
 
+  public async getOnline(): Promise<OnlineResponseMessage> {
+    return this.messageProc.sendToServerAndAwait({
+      action: 'getOnline'
+    });
+  }
+
   public async sendAddChannel(channelName: string, users: number[]): Promise<AddChannelMessage> {
     return this.messageProc.sendToServerAndAwait({
       channelName,
@@ -354,6 +370,7 @@ export default class WsHandler extends MessageHandler implements MessageSupplier
 
   public logout(a: LogoutMessage) {
     this.sessionHolder.session = '';
+    this.usersVersion = null;
     const info = [];
     if (this.listenWsTimeout) {
       this.listenWsTimeout = null;
@@ -399,11 +416,11 @@ export default class WsHandler extends MessageHandler implements MessageSupplier
       roomId: number,
       count: number,
       threadId: number|null,
-      excludeIds: number[]
+      page: {cursor?: string; beforeId?: number; afterId?: number}
   ): Promise<MessagesResponseMessage> {
     return this.messageProc.sendToServerAndAwait({
       count,
-      excludeIds,
+      ...page,
       threadId,
       action: 'loadMessages',
       roomId
@@ -499,6 +516,7 @@ export default class WsHandler extends MessageHandler implements MessageSupplier
 
   public setWsId(message: SetWsIdMessage) {
     this.wsConnectionId = message.opponentWsId;
+    this.usersVersion = message.usersVersion;
     this.setUserInfo(message.userInfo);
     this.setUserSettings(message.userSettings);
     this.setUserImage(message.userInfo.userImage);
@@ -509,7 +527,9 @@ export default class WsHandler extends MessageHandler implements MessageSupplier
       handler: 'room',
       rooms: message.rooms,
       online: message.online,
-      users: message.users
+      onlineVersions: message.onlineVersions,
+      users: message.users,
+      usersFull: message.usersFull
     };
     sub.notify(pubSetRooms);
     const inetAppear: InternetAppearMessage = {
@@ -558,7 +578,17 @@ export default class WsHandler extends MessageHandler implements MessageSupplier
   }
 
   private onWsMessage(message: MessageEvent) {
-    let data = this.messageProc.parseMessage(message.data);
+    let data;
+    if (message.data instanceof ArrayBuffer) {
+      data = this.msgpack!.decode(message.data);
+      this.logger.debug('WS in: {}', data)();
+      if (data.action === 'setProtocolKeys') {
+        this.msgpack!.setKeys(<SetProtocolKeysMessage>data);
+        return;
+      }
+    } else {
+      data = this.messageProc.parseMessage(message.data);
+    }
     if (data) {
       this.messageProc.handleMessage(data);
     }
@@ -640,12 +670,21 @@ export default class WsHandler extends MessageHandler implements MessageSupplier
   }
 
   private listenWS() {
-    const wsUrls = `${this.API_URL}?id=${this.wsConnectionId}&sessionId=${this.sessionHolder.session}`;
+    let wsUrls = `${this.API_URL}?id=${this.wsConnectionId}&sessionId=${this.sessionHolder.session}`;
+    if (this.usersVersion !== null) {
+      wsUrls += `&usersVersion=${this.usersVersion}`;
+    }
 
-    this.ws = new WebSocket(wsUrls);
+    this.ws = WS_MSGPACK ? new WebSocket(wsUrls, MSGPACK_SUBPROTOCOL) : new WebSocket(wsUrls);
+    this.ws.binaryType = 'arraybuffer';
+    this.msgpack = null;
     this.ws.onmessage = this.onWsMessage.bind(this);
     this.ws.onclose = this.onWsClose.bind(this);
     this.ws.onopen = () => {
+      // server may not have msgpack installed, json is used then
+      if (this.ws!.protocol === MSGPACK_SUBPROTOCOL) {
+        this.msgpack = new MsgpackCodec();
+      }
       this.setStatus(true);
       this.startNoPingTimeout();
       this.wsState = WsState.CONNECTED;
@@ -13,7 +13,6 @@ import {
 import {
   FileModel,
   MessageModel,
-  MessageStatus,
   RoomModel
 } from '@/ts/types/model';
 import { Logger } from 'lines-logger';
@@ -21,7 +20,8 @@ import { Logger } from 'lines-logger';
 import {
   FileModelDto,
   MessageModelDto,
-  SaveFileResponse
+  SaveFileResponse,
+  SyncCursor
 } from '@/ts/types/dto';
 import WsHandler from '@/ts/message_handlers/WsHandler';
 import { sub } from '@/ts/instances/subInstance';
@@ -46,7 +46,7 @@ import {
 } from '@/ts/types/messages/wsInMessages';
 import { savedFiles } from '@/ts/utils/htmlApi';
 import { MessageHelper } from '@/ts/message_handlers/MessageHelper';
-import {LAST_SYNCED, MESSAGES_PER_SEARCH} from '@/ts/utils/consts';
+import {LAST_SYNCED, MESSAGES_PER_SEARCH, THREAD_MESSAGES_PER_PAGE} from '@/ts/utils/consts';
 import {convertMessageModelDtoToModel} from '@/ts/types/converters';
 import {checkIfIdIsMissing, getMissingIds} from '@/ts/utils/pureFunctions';
 
@@ -69,6 +69,8 @@ export default class WsMessageHandler extends MessageHandler implements MessageS
   private readonly api: Api;
   private readonly ws: WsHandler;
   private syncMessageLock: boolean = false;
+  // roomId -> continuation token of room history returned by server with the previous page
+  private historyCursors: Record<number, string> = {};
   private readonly messageHelper: MessageHelper;
 
   constructor(
@@ -137,7 +139,10 @@ export default class WsMessageHandler extends MessageHandler implements MessageS
   public async loadUpSearchMessages(roomId: number, count: number, checkIfSet: (found: boolean) => boolean) {
     let room: RoomModel = this.store.roomsDict[roomId];
     if (!room.search.locked) {
-      let response: MessagesResponseMessage = await this.ws.search(room.search.searchText, roomId, Object.keys(room.search.messages).length);
+      // next page starts below the oldest found message
+      let foundIds: number[] = Object.keys(room.search.messages).map(id => parseInt(id, 10));
+      let beforeId: number|null = foundIds.length ? Math.min(...foundIds) : null;
+      let response: MessagesResponseMessage = await this.ws.search(room.search.searchText, roomId, beforeId);
       let messagesDto = response.content;
       this.logger.log("Got {} messages from the server", messagesDto.length)();
       if (checkIfSet(messagesDto.length > 0)) {
@@ -153,25 +158,34 @@ export default class WsMessageHandler extends MessageHandler implements MessageS
 
   public async loadThreadMessages(roomId: number, threadId: number): Promise<void> {
     let room = this.store.roomsDict[roomId];
-    let myids: number[] = Object.values(room.messages)
-        .filter(a => a.parentMessage === threadId && a.id > 0)
-        .map(m => m.id);
-    let lm = await this.ws.sendLoadMessages(roomId, 0, threadId, myids);
-    if (lm.content.length > 0) {
-      this.addMessages(roomId, lm.content);
-    } else {
-      this.logger.error("Got empty messages response from loadThreadMessages")();
+    let parent: MessageModel|undefined = room.messages[threadId];
+    const countReplies = () => Object.values(room.messages).filter(m => m.parentMessage === threadId && m.id > 0).length;
+    const isLoaded = () => !!parent && countReplies() >= parent.threadMessagesCount;
+    if (parent?.threadLastReplyId && room.messages[parent.threadLastReplyId] && isLoaded()) {
+      this.logger.debug("Thread {} is up to date", threadId)();
+      return;
     }
+    // newest replies first, until we have all of them
+    let cursor: string|undefined;
+    do {
+      let lm = await this.ws.sendLoadMessages(roomId, THREAD_MESSAGES_PER_PAGE, threadId, {cursor});
+      if (lm.content.length > 0) {
+        this.addMessages(roomId, lm.content);
+      }
+      cursor = lm.cursor || undefined;
+    } while (cursor && !isLoaded());
   }
 
   public async loadUpMessages(roomId: number, count: number): Promise<void> {
     let room = this.store.roomsDict[roomId];
     if (!room.allLoaded) {
-      let myids: number[] = Object.values(room.messages).map(m => m.id).filter(a => a > 0);
-      let lm = await this.ws.sendLoadMessages(roomId, count, null, myids);
+      let lm = await this.ws.sendLoadMessages(roomId, count, null, {cursor: this.historyCursors[roomId]});
       if (lm.content.length > 0) {
         // backend return messages that don't have thread, so we don't neeed to sync parent message here
         this.addMessages(roomId, lm.content);
+      }
+      if (lm.cursor) {
+        this.historyCursors[roomId] = lm.cursor;
       } else {
         this.store.setAllLoaded(roomId);
       }
@@ -336,7 +350,7 @@ export default class WsMessageHandler extends MessageHandler implements MessageS
     if (checkIfIdIsMissing(message, this.store)) {
       await this.loadMessages(message.roomId, [message.parentMessage!]);
     } else if (inMessage.parentMessage) {
-      this.store.increaseThreadMessageCount({roomId: inMessage.roomId, messageId: message.parentMessage!})
+      this.store.increaseThreadMessageCount({roomId: inMessage.roomId, messageId: message.parentMessage!, lastReplyId: inMessage.id})
     }
   }
 
@@ -349,7 +363,8 @@ export default class WsMessageHandler extends MessageHandler implements MessageS
     this.store.setMessagesStatus({
       roomId: m.roomId,
       status: m.status,
-      messagesIds: m.messagesIds
+      messagesIds: m.messagesIds,
+      edited: m.edited
     });
   }
 
@@ -399,35 +414,17 @@ export default class WsMessageHandler extends MessageHandler implements MessageS
     }
   }
 
-  private setAllMessagesStatus(inMessagesIds: number[], status: MessageStatus) {
-    if (inMessagesIds.length === 0) {
-      return
-    }
-    this.store.roomsArray.forEach(r => {
-      let messagesIds = Object.values(r.messages)
-          .map (m => m.id)
-          .filter(id => inMessagesIds.includes(id));
-      if (messagesIds.length > 0) {
-        this.store.setMessagesStatus({
-          messagesIds,
-          roomId: r.id,
-          status: status
-        });
-      }
-    });
-  }
-
   private async syncHistory() {
     this.logger.log("Syncing history")();
-    let messagesIds: number[] = [];
-    let receivedMessageIds: number[] = [];
-    let onServerMessageIds: number[] = [];
+    let cursors: Record<number, SyncCursor> = {};
     let roomIds: number[] = this.store.roomsArray.map(r => {
       let roomMessage = Object.values(r.messages).filter(m => m.id > 0)
-      messagesIds.push(...roomMessage.map(m => m.id));
-      roomMessage = roomMessage.filter(u => u.userId === this.store.myId);
-      receivedMessageIds.push(...roomMessage.filter(m => m.status === 'received').map(m => m.id));
-      onServerMessageIds.push(...roomMessage.filter(m => m.status === 'on_server').map(m => m.id));
+      roomMessage.forEach(m => {
+        let cursor = cursors[r.id];
+        if (!cursor || m.edited > cursor[0] || (m.edited === cursor[0] && m.id > cursor[1])) {
+          cursors[r.id] = [m.edited, m.id];
+        }
+      });
       return r.id;
     });
 
@@ -438,20 +435,20 @@ export default class WsMessageHandler extends MessageHandler implements MessageS
     }
     joined = parseInt(joined);
 
-    let result: SyncHistoryResponseMessage = await this.ws.syncHistory(
-        roomIds,
-        messagesIds,
-        receivedMessageIds,
-        onServerMessageIds,
-        Date.now() - joined
-    );
+    let result: SyncHistoryResponseMessage;
+    do {
+      result = await this.ws.syncHistory(
+          roomIds,
+          cursors,
+          Date.now() - joined
+      );
 
-    // Updating information if message that I sent were received/read
-    this.setAllMessagesStatus(result.readMessageIds, 'read');
-    this.setAllMessagesStatus(result.receivedMessageIds, 'received');
+      // Persist loaded messages into storage, status changes bump edited, so they come here as well.
+      // setMessageStatus events carry the new edited too, so statuses that were received online are not loaded again
+      this.addRandomMessagesToStorage(result.content);
 
-    // Persist loaded messages into storage
-    this.addRandomMessagesToStorage(result.content);
+      cursors = {...cursors, ...result.cursors};
+    } while (result.hasMore);
 
     localStorage.setItem(LAST_SYNCED, Date.now().toString())
   }
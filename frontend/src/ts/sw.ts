@@ -129,31 +129,37 @@ async function getPlayBack(event: unknown) {
   logger.log('Fetching finished {}', response)();
   const t = await response.text();
   logger.debug('response is {}', t)();
-  const m = JSON.parse(t);
-  logger.log('Parsed response {}', m)();
+  const playback = JSON.parse(t);
+  logger.log('Parsed response {}', playback)();
+  // server returns a notification per room
+  const messages: any[] = Array.isArray(playback) ? playback : [playback];
   const notifications = await (<any>self).registration.getNotifications();
-  let count = 1;
-  if (m.options && m.options.data) {
-    const room = m.options.data.room;
-    const sender = m.options.data.sender;
-    for (let i = 0; i < notifications.length; i++) {
-      if (room && notifications[i].data.room === room
-          || (sender && notifications[i].data.sender === sender)) {
-        notifications[i].close();
-        count += notifications[i].data.replaced || 1;
+  for (const m of messages) {
+    let count = 1;
+    if (m.options && m.options.data) {
+      count = m.options.data.count || 1; // server already collapsed messages that came within a window
+      const room = m.options.data.room;
+      const sender = m.options.data.sender;
+      for (let i = 0; i < notifications.length; i++) {
+        if (room && notifications[i].data.room === room
+            || (sender && notifications[i].data.sender === sender)) {
+          notifications[i].close();
+          count += notifications[i].data.replaced || notifications[i].data.count || 1;
+        }
       }
-    }
-    if (count > 1) {
-      m.options.data.replaced = count;
-      if (room) {
-        m.title = 'Room: ' + room + '(+' + count + ')';
-        m.options.body = sender + ':' + m.options.body;
-      } else if (sender) {
-        m.title = sender + '(+' + count + ')';
+      if (count > 1) {
+        m.options.data.replaced = count;
+        if (room) {
+          m.title = 'Room: ' + room + '(+' + count + ')';
+          m.options.body = sender + ':' + m.options.body;
+        } else if (sender) {
+          m.title = sender + '(+' + count + ')';
+        }
       }
     }
-  }  logger.log('Spawned notification {}', m)();
-  await (<any>self).registration.showNotification(m.title, m.options);
+    logger.log('Spawned notification {}', m)();
+    await (<any>self).registration.showNotification(m.title, m.options);
+  }
 }
 
 self.addEventListener('push', (e: any) => e.waitUntil(getPlayBack(e)));
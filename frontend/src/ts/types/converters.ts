@@ -221,6 +221,7 @@ export function convertMessageModelDtoToModel(message: MessageModelDto, oldMessa
     content: message.content || null,
     symbol: message.symbol || null,
     threadMessagesCount: message.threadMessagesCount,
+    threadLastReplyId: message.threadLastReplyId,
     edited: message.edited,
     isEditingActive: oldMessage ? oldMessage.isEditingActive : false,
     isThreadOpened: oldMessage? oldMessage.isThreadOpened : false,
@@ -117,6 +117,9 @@ export interface FileModelDto {
   preview: string;
 }
 
+// [updatedAt, id] of the last message in room that client has seen
+export type SyncCursor = [number, number];
+
 export interface MessageModelDto {
   id: number;
   time: number;
@@ -129,6 +132,8 @@ export interface MessageModelDto {
   deleted?: boolean;
   giphy?: string;
   threadMessagesCount: number;
+  threadLastReplyId?: number;
+  threadLastReplyTime?: number;
   edited: number;
   roomId: number;
   userId: number;
@@ -10,8 +10,10 @@ import { DefaultWsInMessage } from '@/ts/types/messages/wsInMessages';
 
 
 export interface ChangeUserOnlineBase {
-  content: Record<number, string[]>;
+  content: string[]; // ws ids of the user that are opened now
   userId: number;
+  opponentWsId: string;
+  onlineVersion: number;
   lastTimeOnline: number;
   time: number;
 }
@@ -25,7 +25,9 @@ export interface PubSetRooms extends DefaultInnerSystemMessage<'init', 'room'> {
   rooms:  RoomDto[];
   channels: ChannelDto[];
   users: UserDto[];
+  usersFull: boolean; // otherwise users contains only changed ones
   online: Record<string, string[]>;
+  onlineVersions: Record<number, number>;
 }
 
 export interface InternetAppearMessage extends DefaultInnerSystemMessage<'internetAppear', 'any'> {
@@ -11,7 +11,8 @@ import {
   UserDto,
   UserProfileDto,
   UserProfileDtoWoImage,
-  UserSettingsDto
+  UserSettingsDto,
+  SyncCursor
 } from '@/ts/types/dto';
 
 import {
@@ -39,11 +40,18 @@ export interface DefaultWsInMessage<A extends string, H extends HandlerName> ext
 
 export interface MessagesResponseMessage {
   content: MessageModelDto[];
+  // continuation token of loadMessages, null if there are no more messages
+  cursor?: string|null;
+}
+
+export interface OnlineResponseMessage {
+  content: Record<number, string[]>;
+  onlineVersions: Record<number, number>;
 }
 
 export interface SyncHistoryResponseMessage extends MessagesResponseMessage{
-  readMessageIds: number[];
-  receivedMessageIds: number[];
+  cursors: Record<number, SyncCursor>;
+  hasMore: boolean; // response was cut, sync again from cursors
 }
 
 export interface DeleteMessage extends DefaultWsInMessage<'deleteMessage', 'ws-message'> {
@@ -56,6 +64,8 @@ export interface SetMessageStatusMessage extends DefaultWsInMessage<'setMessageS
   roomId: number;
   status: MessageStatus;
   messagesIds: number[];
+  userId: number;
+  edited: number; // new updated_at of the messages, status change is a change for syncHistory cursors
 }
 
 export interface EditMessage extends DefaultWsInMessage<'editMessage', 'ws-message'> , MessageModelDto  {
@@ -65,7 +75,6 @@ export interface PrintMessage extends DefaultWsInMessage<'printMessage', 'ws-mes
 }
 
 export interface AddOnlineUserMessage extends DefaultWsInMessage<'addOnlineUser', 'room'>, ChangeUserOnlineBase {
-  opponentWsId: string;
 }
 
 export interface CreateNewUsedMessage extends DefaultWsInMessage<'createNewUser', 'room'>, UserDto {
@@ -118,13 +127,17 @@ export interface SaveRoomSettingsMessage extends DefaultWsInMessage<'saveRoomSet
 export interface ShowITypeMessage extends DefaultWsInMessage<'showIType', 'room'> {
   roomId: number;
   userId: number;
+  expire?: number;
 }
 
 export interface SetWsIdMessage extends DefaultWsInMessage<'setWsId', 'ws'>, OpponentWsId {
   rooms:  RoomDto[];
   channels: ChannelDto[];
   users: UserDto[];
+  usersVersion: number;
+  usersFull: boolean;
   online: Record<number, string[]>;
+  onlineVersions: Record<number, number>;
   time: number;
   userInfo: UserProfileDto;
   userSettings: UserSettingsDto;
@@ -5,6 +5,7 @@
 import {
   DefaultMessage
 } from '@/ts/types/messages/baseMessagesInterfaces';
+import {SyncCursor} from '@/ts/types/dto';
 
 export interface DefaultWsOutMessage<A extends string> extends DefaultMessage<A> {
   cbId?: number;
@@ -12,8 +13,6 @@ export interface DefaultWsOutMessage<A extends string> extends DefaultMessage<A>
 
 export interface SyncHistoryOutMessage extends DefaultWsOutMessage<'syncHistory'>{
   roomIds: number[];
-  messagesIds: number[];
-  onServerMessageIds: number[];
-  receivedMessageIds: number[];
+  cursors: Record<number, SyncCursor>;
   lastSynced: number;
 }
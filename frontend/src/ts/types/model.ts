@@ -115,6 +115,7 @@ export interface MessageModel {
   isThreadOpened: boolean; // if thread is opened for this message
   symbol: string|null;
   threadMessagesCount: number;
+  threadLastReplyId?: number; // newest message of the thread on server, if thread isn't empty
   deleted: boolean;
   status: MessageStatus;
   giphy: string|null;
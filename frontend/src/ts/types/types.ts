@@ -196,7 +196,7 @@ export interface IStorage {
   setUserSettings(settings: CurrentUserSettingsModel): void;
   saveRoomUsers(ru: SetRoomsUsers): void;
   setUsers(users: UserModel[]): void;
-  setMessagesStatus(messagesIds: number[], status: MessageStatus): void;
+  setMessagesStatus(messagesIds: number[], status: MessageStatus, edited?: number): void;
   getAllTree(): Promise<SetStateFromStorage|null>;
   saveUser(users: UserModel): void;
   clearStorage(): void;
@@ -275,6 +275,11 @@ export interface SetRoomsUsers {
   users: number[];
 }
 
+export interface SetUserOnline {
+  userId: number;
+  online: string[];
+}
+
 export interface RemoveMessageProgress {
   messageId: number;
   roomId: number;
@@ -25,6 +25,7 @@ export const {
   ELECTRON_IGNORE_SSL,
   CAPTCHA_IFRAME,
   WEBRTC_CONFIG,
+  WS_MSGPACK,
 } = allConsts;
 
 export const PING_CLOSE_JS_DELAY = 5000;
@@ -37,6 +38,7 @@ export const CHROME_EXTENSION_ID = 'cnlplcfdldebgdlcmpkafcialnbopedn';
 export const CHROME_EXTENSION_URL = `https://chrome.google.com/webstore/detail/pychat-screensharing-exte/${CHROME_EXTENSION_ID}`;
 export const PASTED_IMG_CLASS = 'B4j2ContentEditableImg';
 export const MESSAGES_PER_SEARCH = 10;
+export const THREAD_MESSAGES_PER_PAGE = 50;
 export const CONNECTION_ERROR = `Connection error`;
 export const LAST_SYNCED = 'lastSynced';
 export const SEND_CHUNK_SIZE = 16384;
@@ -44,4 +46,5 @@ export const READ_CHUNK_SIZE = SEND_CHUNK_SIZE * 64;
 export const MAX_BUFFER_SIZE = 256;
 export const USERNAME_REGEX = '[a-zA-Z-_0-9]{1,16}';
 export const SHOW_I_TYPING_INTERVAL = 5_000;
+export const ONLINE_SNAPSHOT_INTERVAL = 30_000;
 export const MAX_ACCEPT_FILE_SIZE_WO_FS_API = 268435456; // Math.pow(2, 28) = 256 MB